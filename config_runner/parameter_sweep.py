@@ -0,0 +1,44 @@
+import pandas as pd
+
+from lib.core.ParameterSweep import ParameterSweep
+from lib.helpers.rrule_helper import (get_roll_dates, get_eligible_maturity, weekdays_rule, mondays_wednesdays_fridays_rule, fridays_rule, third_fridays_rule, third_fridays_quarterly_rule)
+
+if __name__ == '__main__':
+    params = {
+        'start_date': '2022-01-01',
+        'end_date': '2023-12-30',
+        'underlying_ticker': 'QQQ',
+        'vol_ticker': 'VXN',
+        'notional': 100,
+        'legs':
+            [{'roll_days': weekdays_rule,
+              'eligible_maturities': weekdays_rule,
+              'maturity_number': 1,
+              'unwind_dates': weekdays_rule,
+              'holding_period': 1,
+              'type': 0,
+              'delta_strike': 0.05,
+              'leverage': -2.5,
+              'delta_hedging_time': ['16:00']},
+             ],
+
+        'delta_fees_bps': 5,
+        'close_time': '16:00',
+        'pnl_explanation': False,
+
+    }
+
+    grid = {
+        'delta_strike': [0.05, 0.10, 0.25],
+        'leverage': [-1, -2.5],
+        'delta_hedging_time': [['16:00'], ['10:00', '12:00', '14:00', '16:00']],
+    }
+
+    sweep = ParameterSweep(params, grid, max_workers=8)
+
+    results = sweep.run()
+
+    print(sweep.errors)
+    results['il'].groupby(level=list(grid.keys())).last().to_clipboard()
+
+    print('end')
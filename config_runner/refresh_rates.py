@@ -0,0 +1,14 @@
+import os
+
+from lib.core.MultiOptions import DATAPATH
+from lib.helpers.rate_store import refresh_rate_store
+
+if __name__ == '__main__':
+    # Incremental refresh of the local rate and dividend store read by the backtests
+    rates_folder = os.path.join(DATAPATH, 'Rates')
+    rf_tickers = ['^IRX']
+    dividend_tickers = ['QQQ', 'SPY']
+
+    refresh_rate_store(rates_folder, rf_tickers=rf_tickers, dividend_tickers=dividend_tickers)
+
+    print('end')
@@ -2,17 +2,31 @@ import pandas as pd
 
 import numpy as np
 
-from lib.helpers.pricing_helpers import price_bs, delta, gamma, vega, theta, rho
-from lib.helpers.rrule_helper import (get_roll_dates, get_eligible_maturity, weekdays_rule, mondays_wednesdays_fridays_rule, fridays_rule, third_fridays_rule, third_fridays_quarterly_rule)
+from lib.helpers.pricing_helpers import greeks, implied_vol_vec
+from lib.helpers.rrule_helper import (get_roll_dates, get_roll_mask, build_observation_calendar, get_eligible_maturity, weekdays_rule, mondays_wednesdays_fridays_rule, fridays_rule, third_fridays_rule, third_fridays_quarterly_rule)
+from lib.helpers.market_data import load_calendar, load_close_series, load_rate_series, load_rf_q_term_structure
+from lib.helpers.rate_store import get_close_store_path, get_dividend_store_path, refresh_close_store, refresh_dividend_store, trailing_dividend_yield, get_rf_q_carry
+from lib.helpers.shared_market_data import attach_series, attach_frame
+from lib.helpers.option_store import get_option_file_name, gather_contracts, QUOTE_COLUMNS
+from lib.helpers.chain_cache import chain_cache, load_option_month, set_chain_cache_budget, ChainPrefetcher
+from lib.helpers.result_writers import get_result_writer, write_result_tables, RowBuffer
+from lib.helpers.checkpoint import fingerprint, params_repr, frame_fingerprint, file_signature, write_checkpoint, read_checkpoint
+from lib.core.PositionLedger import PositionLedger, OpenBook, EXIT_EXPIRED, EXIT_UNWOUND
+from lib.core.RollPlan import RollPlan
 import os
+import time
+import hashlib
 import pytz
-import copy
-import yfinance as yf
 from datetime import datetime
 
 ny_tz = pytz.timezone('America/New_York')
 PATH_SPOT = r'X:\Main Folder\Data\Spot'
 DATAPATH = r"X:\Main Folder\Data"
+# Dumps folder of the project, next to lib
+DUMPPATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'Dumps')
+# Parameters that do not change the results of the timestamps already processed, a checkpoint survives their changes
+RESUMABLE_PARAMS = ['end_date', 'save_results', 'checkpoint_file', 'roll_plan_file', 'shared_market_data', 'chain_cache_bytes', 'prefetch_chains', 'offline',
+                    'output_folder', 'output_formats']
 
 
 class MultiOptionsRoll():
@@ -29,6 +43,12 @@ class MultiOptionsRoll():
         self.rf_ticker = self.params.get("rf_ticker", '^IRX')
         self.notional = self.params.get('notional', None)
         self.pnl_explanation = self.params.get('pnl_explanation', False)
+        self.save_results = self.params.get('save_results', True)
+        # Results are dumped in each format of output_formats ('parquet', 'csv', 'arrow', 'excel') to output_folder
+        self.output_folder = self.params.get('output_folder', DUMPPATH)
+        self.output_formats = self.params.get('output_formats', ['parquet', 'csv'])
+        if isinstance(self.output_formats, str):
+            self.output_formats = [self.output_formats]
         self.close_time = self.params.get('close_time', '16:00')
 
         self.spot = None
@@ -36,6 +56,14 @@ class MultiOptionsRoll():
         self.rf = None
         self.div = None
 
+        # Rates and dividends are read from the local store, offline never downloads missing store files
+        self.rates_folder = self.params.get('rates_folder', os.path.join(DATAPATH, 'Rates'))
+        self.offline = self.params.get('offline', False)
+        # 'dividends' uses the trailing dividend yield, 'rf_q' the carry implied by the rf-q term structure
+        self.carry_source = self.params.get('carry_source', 'dividends')
+        self.rf_q_file = self.params.get('rf_q_file', os.path.join(DATAPATH, 'Options', self.underlying_ticker, 'term_structure.parquet'))
+        self.rf_q_tenor = self.params.get('rf_q_tenor', 30)
+
         self.legs = self.params.get('legs', [])
 
         self.roll_days = self.params.get("roll_days", [])
@@ -53,92 +81,129 @@ class MultiOptionsRoll():
         self.delta_hedging_time = self.params.get("delta_hedging_time", [])
 
         self.roll_calendar = []
+        self.roll_mask = None
+        # Calendar index of the previous day's close of every observation, -1 when there is none
+        self.previous_close_ix = None
+        # Roll dates, target maturities and unwind dates of the legs, reused from roll_plan_file when it matches
+        self.roll_plan = None
+        self.roll_plan_file = self.params.get('roll_plan_file', None)
 
         self.data_folder = os.path.join(DATAPATH, 'Options', self.underlying_ticker, 'Pre Processed')
+        self.store_folder = os.path.join(DATAPATH, 'Options', self.underlying_ticker, 'Store')
+        # 'store' reads the columnar store and falls back to csv for missing months, 'csv' always parses csv
+        self.option_data_source = self.params.get('option_data_source', 'store')
+        # Descriptor of a SharedMarketData published by a parent process, spot and chains are then attached instead of read
+        self.shared_market_data = self.params.get('shared_market_data', None)
         self.opened_file = ''
+        self.opened_file_path = ''
         self.opened_data_file = None
-
-        self.live_portfolio = {}
-        self.expired_portfolio = {}
-        self.unwind_portfolio = {}
-        self.new_options = {}
+        self.opened_month = None
+        self.opened_panel = None
+        # Byte budget of the process wide chain cache, shared with the other backtests of the process
+        if 'chain_cache_bytes' in self.params:
+            set_chain_cache_budget(self.params['chain_cache_bytes'])
+        # Parse the next month file on a background thread while the current one is processed
+        self.prefetch_chains = self.params.get('prefetch_chains', False)
+        self.prefetcher = None
+        # Seconds the backtest waited on option chain files
+        self.chain_stall_time = 0
+        # 'raise' on live options missing from the chain, 'previous' keeps their last known market data
+        self.missing_contract = self.params.get('missing_contract', 'raise')
+        # 'chain' reprices intraday with the chain's implied vol, 'mid' with the vol implied from the previous close Mid
+        self.intraday_vol_source = self.params.get('intraday_vol_source', 'chain')
+
+        # Every option opened during the backtest, live, expired and unwound sets are derived from it
+        self.ledger = None
+        # Options held and accounting state after the last timestamp of a streaming run
+        self.open_book = None
+        self.stream_state = None
+        # Streaming runs save their state at the last timestamp and resume from it when the data has not changed
+        self.checkpoint_file = self.params.get('checkpoint_file', None)
+        # Option chain files read so far, their signatures are part of the checkpoint
+        self.chain_files = set()
 
         self.results = {}
 
-        self.mvop = {}
-        self.cash = {}
-        self.fees = {}
-        self.il = {}
-        self.premiums = {}
-        self.payoffs = {}
-        self.unwinds = {}
-
-        self.hedging_delta = {}
-        self.delta_hedge_pnl = {}
-        self.spot_quantity = {}
-        self.delta_fees = {}
-
-        self.pnl = {}
-        self.pnl_unexplained = {}
-
-        self.portfolio_delta = {}
-        self.portfolio_gamma = {}
-        self.portfolio_vega = {}
-        self.portfolio_theta = {}
-        self.portfolio_rho = {}
-
-        self.pnl_delta = {}
-        self.pnl_gamma = {}
-        self.pnl_vega = {}
-        self.pnl_theta = {}
-        self.pnl_rho = {}
+        self.mvop = None
+        self.cash = None
+        self.fees = None
+        self.il = None
+        self.premiums = None
+        self.payoffs = None
+        self.unwinds = None
+
+        self.hedging_delta = None
+        self.delta_hedge_pnl = None
+        self.spot_quantity = None
+        self.delta_fees = None
+
+        self.pnl = None
+        self.pnl_unexplained = None
+
+        self.portfolio_delta = None
+        self.portfolio_gamma = None
+        self.portfolio_vega = None
+        self.portfolio_theta = None
+        self.portfolio_rho = None
+
+        self.pnl_delta = None
+        self.pnl_gamma = None
+        self.pnl_vega = None
+        self.pnl_theta = None
+        self.pnl_rho = None
 
     def get_calendar(self):
-        observation_times = np.hstack(self.delta_hedging_time)
-        observation_times = sorted(set(observation_times))
+        observation_times = sorted(set(np.hstack(self.delta_hedging_time)))
 
         if self.close_time not in observation_times:
-            if len(observation_times) == 0:
-                observation_times.append(self.close_time)
-            else:
-                observation_times.extend(self.close_time)
+            observation_times.append(self.close_time)
 
-        calendar = pd.read_csv(os.path.join(DATAPATH, 'Options', self.underlying_ticker, f"calendar.csv"))['Index'].values
-        calendar = pd.to_datetime(calendar, utc=False)
+        calendar = load_calendar(os.path.join(DATAPATH, 'Options', self.underlying_ticker, f"calendar.csv"))
         calendar = calendar[(calendar >= self.start_date) & (calendar <= self.end_date)]
 
-        calendar = [[date.replace(hour=int(time.split(':')[0]), minute=int(time.split(':')[1])) for time in observation_times] for date in calendar]
-
-        calendar = sorted(set([item for sublist in calendar for item in sublist]))
+        return build_observation_calendar(calendar, observation_times)
 
-        return pd.DatetimeIndex(calendar, tz=str(ny_tz))
+    def get_previous_close_ix(self):
+        # The 16:00 observation of the day of the last observation before each observation's day
+        local_times = self.calendar.tz_localize(None)
+        day_start = local_times.normalize().tz_localize(ny_tz)
+        previous = np.searchsorted(self.calendar.asi8, day_start.asi8, side='left') - 1
+        previous_close = (local_times[np.maximum(previous, 0)].normalize() + pd.Timedelta(hours=16)).tz_localize(ny_tz)
+        return np.where(previous >= 0, self.calendar.get_indexer(previous_close), -1)
 
-    def get_roll_calendar(self, ix=None):
+    def get_roll_mask(self, ix=None):
+        # Calendar mask of the roll dates of a leg
         if ix is None:
-            roll_calendar = get_roll_dates(self.roll_days, self.calendar)
+            return get_roll_mask(self.roll_days, self.calendar, self.close_time)
         else:
-            roll_calendar = get_roll_dates(self.roll_days[ix], self.calendar)
+            return get_roll_mask(self.roll_days[ix], self.calendar, self.close_time)
+
+    def get_roll_calendar(self, ix=None):
+        return list(self.calendar[self.get_roll_mask(ix)])
 
-        roll_calendar = [date.replace(hour=int(self.close_time.split(':')[0]), minute=int(self.close_time.split(':')[1])) for date in roll_calendar]
+    def get_rate_store_series(self, ticker, file_path, refresh):
+        # Missing store files are downloaded once unless offline
+        if not os.path.exists(file_path):
+            if self.offline:
+                raise FileNotFoundError(f"{file_path} is not in the rate store, refresh it with config_runner/refresh_rates.py")
+            refresh(ticker, self.rates_folder)
+        return load_rate_series(file_path)
 
-        return roll_calendar
+    def get_rf_data(self):
+        return self.get_rate_store_series(self.rf_ticker, get_close_store_path(self.rates_folder, self.rf_ticker), refresh_close_store)
+
+    def get_dividend_data(self):
+        return self.get_rate_store_series(self.underlying_ticker, get_dividend_store_path(self.rates_folder, self.underlying_ticker), refresh_dividend_store)
 
     def get_historical_rf_q(self):
-        start_date = pd.Timestamp('2000-01-01')
-        end_date = pd.Timestamp('2024-05-01')
-        interval = '1d'
-
-        self.rf = yf.Ticker(self.rf_ticker).history(start=start_date, end=end_date, interval=interval)
-        self.rf.index = self.rf.index.map(lambda x: x.tz_convert('America/New_York').replace(hour=16))
-        self.rf = self.rf['Close']
-        self.rf = self.rf.reindex(self.calendar, method='ffill')
-
-        self.div = yf.Ticker(self.underlying_ticker).dividends
-        self.div.index = self.div.index.map(lambda x: x.tz_convert('America/New_York').replace(hour=16))
-        self.div = self.div.reindex(self.calendar, method='ffill')
-        self.div = self.div.rolling(window='365D').sum()
-        self.div = pd.DataFrame(self.div)
-        self.div = self.div.loc[(self.spot.index[0] <= self.div.index) & (self.div.index <= self.spot.index[-1])].apply(lambda x: x / self.spot.loc[x.name], axis=1).reindex(self.spot.index, method='ffill').dropna()['Dividends']
+        self.rf = self.get_rf_data().reindex(self.calendar, method='ffill')
+
+        if self.carry_source == 'rf_q':
+            # q = rf - (rf - q)
+            carry = get_rf_q_carry(load_rf_q_term_structure(self.rf_q_file), self.calendar, self.rf_q_tenor)
+            self.div = self.rf / 100 - carry
+        else:
+            self.div = trailing_dividend_yield(self.get_dividend_data(), self.spot)
 
     def initialize(self):
         # Get each leg's info
@@ -159,36 +224,59 @@ class MultiOptionsRoll():
 
         # Initialize Calendar
         self.calendar = self.get_calendar()
+        self.previous_close_ix = self.get_previous_close_ix()
 
         # Set Roll Schedule
+        self.roll_mask = np.zeros((len(self.calendar), len(self.legs)), dtype=bool)
         for ix, leg in enumerate(self.legs):
-            self.roll_calendar.append(self.get_roll_calendar(ix))
+            self.roll_mask[:, ix] = self.get_roll_mask(ix)
+            self.roll_calendar.append(list(self.calendar[self.roll_mask[:, ix]]))
+        self.roll_plan = self.get_roll_plan()
 
         # Get Intraday Spot Data
         spot_file_name = f"{self.underlying_ticker} Intraday.csv"
-        self.spot = pd.read_csv(os.path.join(DATAPATH, 'Spot', spot_file_name), index_col=0)['Close']
-        self.spot.index = pd.to_datetime(self.spot.index, utc=False)
+        spot_file_path = os.path.join(DATAPATH, 'Spot', spot_file_name)
+        if self.shared_market_data is not None and spot_file_path in self.shared_market_data['spot']:
+            self.spot = attach_series(self.shared_market_data['spot'][spot_file_path])
+        else:
+            self.spot = load_close_series(spot_file_path)
         self.spot = self.spot.reindex(self.calendar, method='ffill')
 
         # Get VIX Data
         vix_file_name = f"{self.vol_ticker} Daily.csv"
-        self.vix = pd.read_csv(os.path.join(DATAPATH, 'Spot', vix_file_name), index_col=0)['Close']
-        self.vix.index = pd.to_datetime(self.vix.index, utc=False)
+        self.vix = load_close_series(os.path.join(DATAPATH, 'Spot', vix_file_name))
 
         # Get Risk Free Rate and Dividend Yield
         self.get_historical_rf_q()
 
+    def get_roll_plan_key(self):
+        # Identifies the calendar and leg rules a roll plan is compiled from
+        description = repr((self.calendar[0], self.calendar[-1], len(self.calendar), self.close_time, self.roll_days, self.eligible_maturities,
+                            self.maturity_number, self.unwind_dates, self.holding_period)) if len(self.calendar) > 0 else ''
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def get_roll_plan(self):
+        key = self.get_roll_plan_key()
+        if self.roll_plan_file is not None and os.path.exists(self.roll_plan_file):
+            roll_plan = RollPlan.load(self.roll_plan_file)
+            if roll_plan.key == key:
+                return roll_plan
+        roll_plan = RollPlan.compile(self.calendar, self.roll_mask, self.eligible_maturities, self.maturity_number, self.unwind_dates, self.holding_period, self.close_time, key)
+        if self.roll_plan_file is not None:
+            roll_plan.save(self.roll_plan_file)
+        return roll_plan
+
     def get_target_maturity(self, date, ix=None):
         if ix is None:
             return get_eligible_maturity(self.eligible_maturities, date, self.maturity_number).replace(hour=int(self.close_time.split(":")[0]), minute=int(self.close_time.split(":")[1]))
         else:
-            return get_eligible_maturity(self.eligible_maturities[ix], date, self.maturity_number[ix]).replace(hour=int(self.close_time.split(":")[0]), minute=int(self.close_time.split(":")[1]))
+            return self.roll_plan.target_maturity(ix, date)
 
     def get_unwind_date(self, date, ix=None):
         if ix is None:
             return pd.Timestamp(get_eligible_maturity(self.unwind_dates, date, self.holding_period)).replace(hour=int(self.close_time.split(":")[0]), minute=int(self.close_time.split(":")[1]))
         else:
-            return pd.Timestamp(get_eligible_maturity(self.unwind_dates[ix], date, self.holding_period[ix])).replace(hour=int(self.close_time.split(":")[0]), minute=int(self.close_time.split(":")[1]))
+            return self.roll_plan.unwind(ix, date)
 
     def get_quantity(self, date, ix=None):
         if ix is None:
@@ -197,13 +285,6 @@ class MultiOptionsRoll():
             return self.leverage[ix] * self.notional / self.spot.loc[date]
 
     def get_new_options(self, date, ix=None):
-        # get today's option data and spot close
-        spot = self.spot.loc[date]
-        data = self.get_option_data(date)
-
-        # List of options to return
-        new_options = []
-
         # Set options characteristics
         if ix is None:
             type = self.type
@@ -220,21 +301,8 @@ class MultiOptionsRoll():
             unwind = self.get_unwind_date(date, ix)
             quantity = self.get_quantity(date, ix)
 
-        # select closest higher or equal maturity available
-        maturity = data['Maturity'].loc[(data['Maturity'].apply(lambda x: x.date()) >= target_maturity.date()) & (data['Type'] == type)].min()
-        data = data.loc[(data['Maturity'] == maturity) & (data['Type'] == type)]
-        if type == 0:
-            if moneyness is not None:
-                strike = data['Strike'].loc[(data['Strike'] <= spot * moneyness) & (data['Type'] == type)].max()
-            if delta_strike is not None:
-                delta = data['Delta'].loc[(data['Delta'].apply(abs) <= delta_strike) & (data['Type'] == type)].min()
-                strike = data['Strike'].loc[data['Delta'] == delta].iloc[0]
-        else:
-            if moneyness is not None:
-                strike = data['Strike'].loc[(data['Strike'] >= spot * moneyness) & (data['Type'] == type)].min()
-            if delta_strike is not None:
-                delta = data['Delta'].loc[(data['Delta'].apply(abs) <= delta_strike) & (data['Type'] == type)].max()
-                strike = data['Strike'].loc[data['Delta'] == delta].iloc[0]
+        # closest higher or equal maturity available, then strike by moneyness or delta with binary searches on today's chain
+        maturity, strike = self.get_selection_index(date).select(type, target_maturity, self.spot.loc[date], moneyness, delta_strike)
 
         # Select Option
         option = {'Strike_date': date,
@@ -245,182 +313,195 @@ class MultiOptionsRoll():
                   'Quantity': quantity,
                   'index': ix}
 
-        new_options.append(option)
-        return new_options
+        return [option]
 
     def build_rolling_portfolios(self):
+        self.ledger = PositionLedger(self.calendar)
         for t, date in enumerate(self.calendar):
-            # select the correct previous date and previous portfolio
-            if t == 0:
-                prev_portfolio = {}
-            else:
-                prev_date = self.calendar[t - 1]
-                prev_portfolio = self.live_portfolio[prev_date]
-
-            # Keep only live options today
-            live_portfolio = [option for option in copy.deepcopy(prev_portfolio) if (option['Maturity'] > date and option['Unwind'] > date)]
-
-            # Get new opened positions
-            self.new_options[date] = []
+            # Open new positions, live, expired and unwound options follow from their maturity and unwind dates
+            # Legs rolling on the same date share its chain month and selection index
             for ix in range(len(self.legs)):
-                if date in self.roll_calendar[ix]:
-                    self.new_options[date].extend(self.get_new_options(date, ix))
-
-            # Construct live portfolio for today
-            self.live_portfolio[date] = live_portfolio + self.new_options[date]
-            # Add expired options portfolio for today
-            self.expired_portfolio[date] = [option for option in copy.deepcopy(prev_portfolio) if (option['Maturity'] == date)]
-            # Add unwind options portfolio for today
-            self.unwind_portfolio[date] = [option for option in copy.deepcopy(prev_portfolio) if ((option['Maturity'] > date) and (date == option['Unwind']))]
+                if self.roll_mask[t, ix]:
+                    for option in self.get_new_options(date, ix):
+                        self.ledger.open_position(t, option)
+        self.ledger.finalize()
+
+    def open_option_month(self, date):
+        file_name = get_option_file_name(self.underlying_ticker, date)
+
+        if file_name != self.opened_file:
+            # Use new file, parsed months are cached for the whole process
+            start = time.perf_counter()
+            self.opened_file = file_name
+            if self.shared_market_data is not None and file_name in self.shared_market_data['chains']:
+                # Zero copy view of the chain published by the parent process
+                descriptor = self.shared_market_data['chains'][file_name]
+                self.opened_month = chain_cache.get_month((file_name, descriptor['index'][0]), lambda key: attach_frame(descriptor))
+            else:
+                # From the columnar store unless the csv fallback is requested
+                use_store = self.option_data_source == 'store'
+                self.opened_month = load_option_month(self.underlying_ticker, date, self.store_folder, self.data_folder, use_store=use_store, prefetcher=self.prefetcher)
+                if self.prefetcher is not None:
+                    next_month = (date.tz_localize(None).to_period('M') + 1).to_timestamp()
+                    self.prefetcher.prefetch(self.underlying_ticker, next_month, self.store_folder, self.data_folder, use_store=use_store)
+            self.opened_file_path, self.opened_data_file = self.opened_month.file_path, self.opened_month.data
+            self.chain_files.add(self.opened_month.file_path)
+            # Contract keyed panel of the month, used to gather quotes of held options
+            self.opened_panel = chain_cache.get_panel(self.opened_month)
+            self.chain_stall_time += time.perf_counter() - start
 
     def get_option_data(self, date):
-        file_name = f'{self.underlying_ticker.lower()}_eod_{date.strftime('%Y%m')}.csv'
-        file_path = os.path.join(self.data_folder, file_name)
-
-        if file_path != self.opened_file:
-            # Use new file
-            self.opened_file = file_path
-            self.opened_data_file = pd.read_csv(self.opened_file, index_col=0)
-            # Reformat index to close NY
-            self.opened_data_file.index = pd.to_datetime(self.opened_data_file.index)
-            self.opened_data_file.index = self.opened_data_file.index.normalize() + pd.Timedelta(hours=16)
-            self.opened_data_file.index = self.opened_data_file.index.tz_localize(ny_tz)
-            # Reformat Maturity to close NY
-            self.opened_data_file.loc[:, 'Maturity'] = pd.to_datetime(self.opened_data_file['Maturity']).apply(lambda x: x.normalize().tz_localize(ny_tz) + pd.Timedelta(hours=16))
-            # format the rest
-            self.opened_data_file.loc[:, 'Strike'] = pd.to_numeric(self.opened_data_file['Strike'], errors='coerce')
-            self.opened_data_file.loc[:, 'Bid'] = pd.to_numeric(self.opened_data_file['Bid'], errors='coerce')
-            self.opened_data_file.loc[:, 'Ask'] = pd.to_numeric(self.opened_data_file['Ask'], errors='coerce')
-            self.opened_data_file.loc[:, 'Spot'] = pd.to_numeric(self.opened_data_file['Spot'], errors='coerce')
-            self.opened_data_file.loc[:, 'Volume'] = pd.to_numeric(self.opened_data_file['Volume'], errors='coerce')
-            self.opened_data_file.loc[:, 'Implied Vol'] = pd.to_numeric(self.opened_data_file['Implied Vol'], errors='coerce')
-            self.opened_data_file.loc[:, 'Delta'] = pd.to_numeric(self.opened_data_file['Delta'], errors='coerce')
-            self.opened_data_file.loc[:, 'Gamma'] = pd.to_numeric(self.opened_data_file['Gamma'], errors='coerce')
-            self.opened_data_file.loc[:, 'Vega'] = pd.to_numeric(self.opened_data_file['Vega'], errors='coerce')
-            self.opened_data_file.loc[:, 'Theta'] = pd.to_numeric(self.opened_data_file['Theta'], errors='coerce')
-            self.opened_data_file.loc[:, 'Rho'] = pd.to_numeric(self.opened_data_file['Rho'], errors='coerce')
-            self.opened_data_file.loc[:, 'Type'] = pd.to_numeric(self.opened_data_file['Type'], errors='coerce')
-            self.opened_data_file.loc[:, 'Mid'] = (self.opened_data_file.loc[:, 'Bid'] + self.opened_data_file.loc[:, 'Ask']) / 2
-            self.opened_data_file.loc[:, 'Spread'] = self.opened_data_file.loc[:, 'Ask'] - self.opened_data_file.loc[:, 'Bid']
-
-        return self.opened_data_file.loc[date].dropna(subset=['Mid'])
+        self.open_option_month(date)
+        return chain_cache.get_date_slice(self.opened_month, date)
+
+    def get_selection_index(self, date):
+        self.open_option_month(date)
+        return chain_cache.get_selection_index(self.opened_month, date)
+
+    def get_quotes(self, date, maturity, op_type, strike):
+        # Gather quotes of many contracts at once, returns the quotes and a mask of the contracts found
+        self.open_option_month(date)
+        return gather_contracts(self.opened_panel, date, maturity, op_type, strike)
+
+    def get_contract_data(self, date, positions):
+        return self.get_quotes(date, self.ledger.maturity[positions], self.ledger.type[positions], self.ledger.strike[positions])
+
+    def fill_missing_quotes(self, date, quotes, found, previous, has_previous, maturity, op_type, strike):
+        # Live options missing from the chain keep their previous market data with the 'previous' policy
+        if found.all():
+            return quotes
+        missing = np.flatnonzero(~found)
+        if self.missing_contract == 'previous' and has_previous[missing].all():
+            quotes[missing] = previous[missing]
+            return quotes
+        ix = missing[0]
+        raise KeyError(f"No market data on {date} for live option {op_type[ix]} {strike[ix]} {maturity[ix]}")
+
+    def settle_at_intrinsic(self, date, quotes, found, op_type, strike):
+        # Expired and unwound options without a quote are settled at intrinsic value
+        if found.all():
+            return quotes
+        spot = self.spot[date]
+        intrinsic = op_type * np.maximum(spot - strike, 0) + (1 - op_type) * np.maximum(strike - spot, 0)
+        settled = np.zeros_like(quotes)
+        settled[:, QUOTE_COLUMNS.index('Mid')] = intrinsic
+        settled[:, QUOTE_COLUMNS.index('Delta')] = (spot > strike) * (op_type - 0.5) * 2
+        return np.where(found[:, None], quotes, settled)
+
+    def reprice_intraday(self, t, date, close_ix, quotes, maturity, op_type, strike, values):
+        # Use Previous day's Implied Vol to compute greeks now using current spot
+        spot, close_date = values['spot'], self.calendar[close_ix]
+        time_to_maturity = (maturity - date).total_seconds().values / 3600 / 24
+        vol = quotes[:, QUOTE_COLUMNS.index('Implied Vol')]
+        rate, dividend = values['rf'][close_ix] / 100, values['div'][close_ix]
+        if self.intraday_vol_source == 'mid':
+            # Vol implied from the previous close Mid with our own pricer, the chain's vol is kept where it is undefined
+            close_maturity = (maturity - close_date).total_seconds().values / 3600 / 24
+            implied = implied_vol_vec(spot[close_ix], strike, close_maturity, rate, dividend, quotes[:, QUOTE_COLUMNS.index('Mid')], op_type)
+            vol = np.where(np.isnan(implied), vol, implied)
+
+        quotes = quotes.copy()
+        mids, deltas, gammas, vegas, thetas, rhos = greeks(spot[t], strike, time_to_maturity, rate, dividend, vol, op_type)
+        for column, column_values in zip(['Implied Vol', 'Mid', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho'], [vol, mids, deltas, gammas, vegas, thetas, rhos]):
+            quotes[:, QUOTE_COLUMNS.index(column)] = column_values
+        return quotes
+
+    def get_previous_close(self, t, date):
+        close_ix = self.previous_close_ix[t]
+        if close_ix < 0:
+            raise KeyError(f"No previous close in the calendar for {date}")
+        return close_ix, self.calendar[close_ix]
+
+    def get_calendar_values(self):
+        # Market data and hedging schedule on the calendar as arrays
+        return {'spot': self.spot.reindex(self.calendar).to_numpy(dtype=float),
+                'rf': self.rf.reindex(self.calendar).to_numpy(dtype=float),
+                'div': self.div.reindex(self.calendar).to_numpy(dtype=float),
+                'vix': self.vix.reindex(self.calendar, method='ffill').to_numpy(dtype=float),
+                'hedging': self.get_hedging_mask()}
+
+    def attach_live_data(self, t, date, live):
+        # Quotes on date of the entries live at timestamp t
+        ledger = self.ledger
+        positions = ledger.entry_pos[live]
+        if len(positions) == 0:
+            return
+        quotes, found = self.get_contract_data(date, positions)
+        if not found.all():
+            previous = ledger.previous_entries(t, positions)
+            quotes = self.fill_missing_quotes(date, quotes, found, ledger.live_data[np.maximum(previous, 0)], previous >= 0,
+                                              ledger.maturity[positions], ledger.type[positions], ledger.strike[positions])
+        ledger.live_data[live] = quotes
+
+    def attach_closing_data(self, date, positions):
+        if len(positions) == 0:
+            return
+        quotes, found = self.get_contract_data(date, positions)
+        self.ledger.exit_data[positions] = self.settle_at_intrinsic(date, quotes, found, self.ledger.type[positions], self.ledger.strike[positions])
 
     def attach_market_data(self):
-        for date in self.calendar:
+        ledger = self.ledger
+        values = self.get_calendar_values()
+        for t, date in enumerate(self.calendar):
             print(date)
+            live = ledger.live(t)
             # if date is in the close use option metrics
             if date.hour == 16 and date.minute == 0:
-                data = self.get_option_data(date)
-                # Get live portfolio data
-                options = []
-                for option in self.live_portfolio[date]:
-                    option_data = data.loc[(data['Strike'] == option['Strike']) & (data['Type'] == option['Type']) & (data['Maturity'] == option['Maturity'])]
-                    option['Mid'], option['Spread'], option['Implied Vol'], option['Delta'], option['Gamma'], option['Vega'], option['Theta'], option['Rho'] = \
-                        option_data[['Mid', 'Spread', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']].iloc[0]
-                    options.append(option)
-                self.live_portfolio[date] = options
-                # Get expired portfolio data
-                options = []
-                for option in self.expired_portfolio[date]:
-                    option_data = data.loc[(data['Strike'] == option['Strike']) & (data['Type'] == option['Type']) & (data['Maturity'] == option['Maturity'])]
-                    if len(option_data) == 0:
-                        option['Mid'] = option["Type"] * max(self.spot[date] - option['Strike'], 0) + (1 - option["Type"]) * max(option['Strike'] - self.spot[date], 0)
-                        option['Spread'], option['Implied Vol'], option['Delta'], option['Gamma'], option['Vega'], option['Theta'], option['Rho'] = 0, 0, (self.spot[date] > option['Strike']) * (option['Type'] - 0.5) * 2, 0, 0, 0, 0
-                    else:
-                        option['Mid'], option['Spread'], option['Implied Vol'], option['Delta'], option['Gamma'], option['Vega'], option['Theta'], option['Rho'] = option_data[['Mid', 'Spread', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']].iloc[0]
-                    options.append(option)
-                self.expired_portfolio[date] = options
-                # Get unwind portfolio data
-                options = []
-                for option in self.unwind_portfolio[date]:
-                    option_data = data.loc[(data['Strike'] == option['Strike']) & (data['Type'] == option['Type']) & (data['Maturity'] == option['Maturity'])]
-                    if len(option_data) == 0:
-                        option['Mid'] = option["Type"] * max(spot - option['Strike'], 0) + (1 - option["Type"]) * max(option['Strike'] - spot, 0)
-                        option['Spread'], option['Implied Vol'], option['Delta'], option['Gamma'], option['Vega'], option['Theta'], option['Rho'] = 0, 0, (spot > option['Strike']) * (option['Type'] - 0.5) * 2, 0, 0, 0, 0
-                    else:
-                        option['Mid'], option['Spread'], option['Implied Vol'], option['Delta'], option['Gamma'], option['Vega'], option['Theta'], option['Rho'] = option_data[['Mid', 'Spread', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']].iloc[0]
-                    options.append(option)
-                self.unwind_portfolio[date] = options
+                self.attach_live_data(t, date, live)
+                self.attach_closing_data(date, ledger.exited(t))
             # if time is not close : intraday delta hedging : no expiration and unwind, compute metrics for intraday delta hedging
             else:
-                if date.replace(hour=0, minute=0) < min(self.calendar):
-                    options = []
-                    self.live_portfolio[date] = options
-                    self.expired_portfolio[date] = options
-                    self.unwind_portfolio[date] = options
+                positions = ledger.entry_pos[live]
+                if len(positions) == 0:
                     continue
                 # Get previous day's Close data
-                dt = max([dt for dt in self.calendar if dt < date.replace(hour=0, minute=0)])
-                data = self.get_option_data(dt.replace(hour=16, minute=0))
-
-                options = []
-                for option in self.live_portfolio[date]:
-                    option_data = data.loc[(data['Strike'] == option['Strike']) & (data['Type'] == option['Type']) & (data['Maturity'] == option['Maturity'])]
-                    # Use Previous day's Implied Vol to compute greeks now using current spot
-                    option['Implied Vol'] = option_data['Implied Vol'].iloc[0]
-                    spot, strike, maturity, rate, div, vol, op_type = self.spot[date], option['Strike'], (option['Maturity'] - date).total_seconds() / 3600 / 24, self.rf.loc[dt.replace(hour=16, minute=0)] / 100, self.div.loc[dt.replace(hour=16, minute=0)], option['Implied Vol'], option['Type']
-
-                    option['Mid'] = price_bs(spot, strike, maturity, rate, div, vol, op_type)
-                    option['Delta'] = delta(spot, strike, maturity, rate, div, vol, op_type)
-                    option['Gamma'] = gamma(spot, strike, maturity, rate, div, vol, op_type)
-                    option['Vega'] = vega(spot, strike, maturity, rate, div, vol, op_type)
-                    option['Theta'] = theta(spot, strike, maturity, rate, div, vol, op_type)
-                    option['Rho'] = rho(spot, strike, maturity, rate, div, vol, op_type)
+                close_ix, close_date = self.get_previous_close(t, date)
+                self.attach_live_data(t, close_date, live)
+                ledger.live_data[live] = self.reprice_intraday(t, date, close_ix, ledger.live_data[live], ledger.maturity[positions], ledger.type[positions], ledger.strike[positions], values)
 
-                    options.append(option)
-
-                self.live_portfolio[date] = options
+    def get_hedging_mask(self):
+        # Calendar x legs mask of the timestamps at which each leg is delta hedged
+        times = self.calendar.strftime('%H:%M')
+        return np.stack([times.isin(hedging_times) for hedging_times in self.delta_hedging_time], axis=1)
 
     def compute_pnl(self):
-        hedging_delta = {}
-        spot_quantity = {}
-        delta_hedge_pnl = {}
-        delta_fees = {}
-        premiums = {}
-        payoffs = {}
-        unwinds = {}
-        mvop = {}
-        cash = {}
-        fees = {}
-        il = {}
-
-        for t, date in enumerate(self.calendar):
-            # MVOP is equal to the new valuation at mid of current live options
-            mvop[date] = sum(option['Mid'] * option['Quantity'] for option in self.live_portfolio[date])
-
-            # Initialize cash = Notional or previous cash level
-            if date == self.calendar[0]:
-                prev_date = date
-                cash[date] = self.notional
-                spot_quantity[date] = 0
-            else:
-                prev_date = self.calendar[t - 1]
-                cash[date] = cash[prev_date]
-
-            # Adjust cash balance to latest options added removed at Mid
-            premiums[date] = - sum(option['Mid'] * option['Quantity'] for option in self.new_options[date])
-            payoffs[date] = sum(option['Mid'] * option['Quantity'] for option in self.expired_portfolio[date])
-            unwinds[date] = sum(option['Mid'] * option['Quantity'] for option in self.unwind_portfolio[date])
-
-            cash[date] = (cash[date] + premiums[date] + payoffs[date] + unwinds[date])
-            # Compute Daily Execution fees
-            fees[date] = (sum(0.5 * option['Spread'] * abs(option['Quantity']) for option in self.new_options[date])
-                          + sum(0.5 * option['Spread'] * abs(option['Quantity']) for option in self.unwind_portfolio[date])
-                          + sum(0.5 * option['Spread'] * abs(option['Quantity']) for option in self.expired_portfolio[date]))
-
-            # Delta Hedging
-            # Compute PnL from previous delta hedge
-            delta_hedge_pnl[date] = spot_quantity[prev_date] * (self.spot[date] - self.spot[prev_date])  # Delta hedging PnL from the spot portfolio
-            # Compute current delta to be hedged and number of underlying
-            hedging_delta[date] = sum(option['Delta'] * option['Quantity'] for option in self.live_portfolio[date] if (date.strftime('%H:%M') in self.delta_hedging_time[option['index']]))
-            spot_quantity[date] = hedging_delta[date]
-            # Compute delta hedge fees
-            delta_fees[date] = abs(spot_quantity[date] - spot_quantity[prev_date]) * self.spot[date] * self.delta_fees_bps
-
-            # Remove execution fees and delta hedging fees and adding hedging pnl to cash balance
-            cash[date] = cash[date] - fees[date] - delta_fees[date] + delta_hedge_pnl[date]
-            # Compute Index Level
-            il[date] = cash[date] + mvop[date]
+        ledger = self.ledger
+        live_mid, live_spread, live_delta = (ledger.live_data[:, QUOTE_COLUMNS.index(column)] for column in ['Mid', 'Spread', 'Delta'])
+        exit_mid, exit_spread = (ledger.exit_data[:, QUOTE_COLUMNS.index(column)] for column in ['Mid', 'Spread'])
+        quantity = ledger.quantity[ledger.entry_pos]
+        # New options are the live entries opened at their timestamp, expired and unwound options carry their closing data
+        new = ledger.new_entries()
+        spot = self.spot.reindex(self.calendar).to_numpy(dtype=float)
+
+        # MVOP is equal to the new valuation at mid of current live options
+        mvop = ledger.sum_live(live_mid * quantity)
+
+        # Options added removed at Mid
+        premiums = - ledger.sum_live(live_mid * quantity, new)
+        payoffs = ledger.sum_exits(exit_mid * ledger.quantity, EXIT_EXPIRED)
+        unwinds = ledger.sum_exits(exit_mid * ledger.quantity, EXIT_UNWOUND)
+
+        # Compute Daily Execution fees
+        fees = (ledger.sum_live(0.5 * live_spread * np.abs(quantity), new)
+                + ledger.sum_exits(0.5 * exit_spread * np.abs(ledger.quantity), EXIT_UNWOUND)
+                + ledger.sum_exits(0.5 * exit_spread * np.abs(ledger.quantity), EXIT_EXPIRED))
+
+        # Delta Hedging
+        # Current delta to be hedged, only legs hedged at the timestamp count
+        hedged = self.get_hedging_mask()[ledger.entry_t, ledger.leg[ledger.entry_pos]]
+        hedging_delta = ledger.sum_live(live_delta * quantity, hedged)
+        spot_quantity = hedging_delta
+        # Previous hedge and spot, the first timestamp is its own previous one so its hedge pnl and delta fees are zero
+        prev_spot_quantity = np.concatenate([spot_quantity[:1], spot_quantity[:-1]])
+        prev_spot = np.concatenate([spot[:1], spot[:-1]])
+        # PnL from previous delta hedge and delta hedge fees
+        delta_hedge_pnl = prev_spot_quantity * (spot - prev_spot)
+        delta_fees = np.abs(spot_quantity - prev_spot_quantity) * spot * self.delta_fees_bps
+
+        # Cash starts at the notional and accumulates premiums, payoffs, unwinds, fees and hedging pnl
+        cash = self.notional + np.cumsum(premiums + payoffs + unwinds - fees - delta_fees + delta_hedge_pnl)
+        # Compute Index Level
+        il = cash + mvop
 
         self.hedging_delta = hedging_delta
         self.delta_hedge_pnl = delta_hedge_pnl
@@ -435,68 +516,41 @@ class MultiOptionsRoll():
         self.il = il
 
     def explain_pnl(self):
-        pnl = {}
-        pnl_unexplained = {}
-
-        portfolio_delta = {}
-        portfolio_gamma = {}
-        portfolio_vega = {}
-        portfolio_theta = {}
-        portfolio_rho = {}
-
-        pnl_delta = {}
-        pnl_gamma = {}
-        pnl_vega = {}
-        pnl_theta = {}
-        pnl_rho = {}
-
-        for ix, date in enumerate(self.calendar):
-            if ix == 0:
-                pnl[date] = 0
-                pnl_unexplained[date] = 0
-                portfolio_delta[date] = 0
-                portfolio_gamma[date] = 0
-                portfolio_vega[date] = 0
-
-                portfolio_theta[date] = 0
-                portfolio_rho[date] = 0
-                pnl_delta[date] = 0
-                pnl_gamma[date] = 0
-                pnl_vega[date] = 0
-                pnl_theta[date] = 0
-                pnl_rho[date] = 0
-
-            else:
-                prev_date = self.calendar[ix - 1]
-                pnl[date] = self.il[date] - self.il[prev_date]
-
-                # Compute Greeks for the portfolio
-                portfolio_delta[date] = sum(option['Delta'] * option['Quantity'] for option in self.live_portfolio[prev_date])
-                portfolio_gamma[date] = sum(option['Gamma'] * option['Quantity'] for option in self.live_portfolio[prev_date])
-                portfolio_vega[date] = sum(option['Vega'] * option['Quantity'] for option in self.live_portfolio[prev_date])
-                portfolio_theta[date] = sum(option['Theta'] * option['Quantity'] for option in self.live_portfolio[prev_date])
-                portfolio_rho[date] = sum(option['Rho'] * option['Quantity'] for option in self.live_portfolio[prev_date])
+        ledger = self.ledger
+        quantity = ledger.quantity[ledger.entry_pos]
+        spot = self.spot.reindex(self.calendar).to_numpy(dtype=float)
+        rf = self.rf.reindex(self.calendar).to_numpy(dtype=float)
+        spot_change = np.diff(spot, prepend=spot[0])
 
-                # PnL Attribution
-                pnl_delta[date] = (portfolio_delta[prev_date] - self.hedging_delta[prev_date]) * (self.spot.loc[date] - self.spot.loc[prev_date])
+        def lag(values):
+            return np.concatenate([[0], values[:-1]])
 
-                pnl_gamma[date] = 0.5 * portfolio_gamma[prev_date] * ((self.spot.loc[date] - self.spot.loc[prev_date]) ** 2)
+        pnl = np.diff(self.il, prepend=self.il[0])
 
-                pnl_vega[date] = 0
+        # Greeks of the portfolio held at the previous timestamp
+        portfolio_delta, portfolio_gamma, portfolio_vega, portfolio_theta, portfolio_rho = (lag(ledger.sum_live(ledger.live_data[:, QUOTE_COLUMNS.index(column)] * quantity))
+                                                                                           for column in ['Delta', 'Gamma', 'Vega', 'Theta', 'Rho'])
 
-                for option in self.live_portfolio[prev_date]:
-                    if option['Maturity'] > date and option['Unwind'] > date:
-                        for option_ in self.live_portfolio[date]:
-                            if option_['Strike'] == option['Strike'] and option_['Type'] == option['Type'] and option_['Maturity'] == option['Maturity'] and option_['Unwind'] == option['Unwind']:
-                                pnl_vega[date] += option['Quantity'] * option['Vega'] * (option_['Implied Vol'] - option['Implied Vol'])
+        # PnL Attribution
+        pnl_delta = (lag(portfolio_delta) - lag(self.hedging_delta)) * spot_change
+        pnl_gamma = 0.5 * lag(portfolio_gamma) * spot_change ** 2
 
-                pnl_theta[date] = portfolio_theta[prev_date] * (date - prev_date).total_seconds() / 3600 / 24 / 365
+        # Vol changes of each option still held, matched to its previous timestamp by position
+        previous = ledger.previous_entry()
+        held = previous >= 0
+        vega, vol = ledger.live_data[:, QUOTE_COLUMNS.index('Vega')], ledger.live_data[:, QUOTE_COLUMNS.index('Implied Vol')]
+        pnl_vega = ledger.sum_live(quantity * vega[previous] * (vol - vol[previous]), held)
 
-                pnl_rho[date] = portfolio_rho[prev_date] * (self.rf[date] - self.rf[prev_date]) / 100
+        elapsed = np.diff(self.calendar.asi8, prepend=self.calendar.asi8[0]) / 1e9 / 3600 / 24 / 365
+        pnl_theta = lag(portfolio_theta) * elapsed
+        pnl_rho = lag(portfolio_rho) * np.diff(rf, prepend=rf[0]) / 100
 
-                pnl_unexplained[date] = pnl[date] - pnl_delta[date] - pnl_gamma[date] - pnl_vega[date] - pnl_theta[date] - pnl_rho[date]
+        pnl_unexplained = pnl - pnl_delta - pnl_gamma - pnl_vega - pnl_theta - pnl_rho
+        pnl_unexplained = pnl_unexplained - self.payoffs - self.premiums - self.unwinds - self.delta_hedge_pnl
 
-                pnl_unexplained[date] = pnl_unexplained[date] - self.payoffs[date] - self.premiums[date] - self.unwinds[date] - self.delta_hedge_pnl[date]
+        # Nothing to explain on the first timestamp
+        for series in [pnl, pnl_unexplained, pnl_delta, pnl_gamma, pnl_vega, pnl_theta, pnl_rho]:
+            series[0] = 0
 
         self.pnl = pnl
         self.pnl_unexplained = pnl_unexplained
@@ -513,140 +567,246 @@ class MultiOptionsRoll():
         self.pnl_theta = pnl_theta
         self.pnl_rho = pnl_rho
 
-    def create_report(self):
-        self.results = pd.DataFrame(index=self.calendar)
-        self.results.loc[:, "il"] = self.il
-
-        self.results.loc[:, "mvop"] = self.mvop
-        self.results.loc[:, "cash"] = self.cash
-        self.results.loc[:, "premiums"] = self.premiums
-        self.results.loc[:, "payoffs"] = self.payoffs
-        self.results.loc[:, "unwinds"] = self.unwinds
-        self.results.loc[:, "fees"] = self.fees
+    def stream_step(self, t, date, book, state, values):
+        """
+        Moves the book of open options to timestamp t: closes expired and unwound options, opens the new ones, prices
+        the book and accounts for the timestamp. Same results as the batch backtest for that timestamp.
+
+        Parameters:
+            t (int): Calendar index of date.
+            book (OpenBook): Options held after the previous timestamp, with their market data.
+            state (dict): Accounting state after the previous timestamp, None before the first one.
+            values (dict): Output of get_calendar_values.
+
+        Returns:
+            tuple: The book and state after t, and the result row of t.
+        """
+        spot, rf = values['spot'], values['rf']
+        first = state is None
+
+        # Options leave the book before new ones are opened, a position never closes on its opening timestamp
+        held, expired, unwound = book.split(date.value)
+        new_options = [option for ix in range(len(self.legs)) if self.roll_mask[t, ix] for option in self.get_new_options(date, ix)]
+        live = held.concat(OpenBook.from_options(new_options))
+        previous = live.quotes
+        has_previous = np.arange(len(live)) < len(held)
+        maturity = live.maturity_index()
+
+        exits = expired.concat(unwound)
+        exits.quotes = np.full_like(exits.quotes, np.nan)
+        if date.hour == 16 and date.minute == 0:
+            if len(live) > 0:
+                quotes, found = self.get_quotes(date, maturity, live.type, live.strike)
+                live.quotes = self.fill_missing_quotes(date, quotes, found, previous, has_previous, maturity, live.type, live.strike)
+            if len(exits) > 0:
+                quotes, found = self.get_quotes(date, exits.maturity_index(), exits.type, exits.strike)
+                exits.quotes = self.settle_at_intrinsic(date, quotes, found, exits.type, exits.strike)
+        elif len(live) > 0:
+            close_ix, close_date = self.get_previous_close(t, date)
+            quotes, found = self.get_quotes(close_date, maturity, live.type, live.strike)
+            quotes = self.fill_missing_quotes(close_date, quotes, found, previous, has_previous, maturity, live.type, live.strike)
+            live.quotes = self.reprice_intraday(t, date, close_ix, quotes, maturity, live.type, live.strike, values)
+
+        mid, spread, delta = (live.quotes[:, QUOTE_COLUMNS.index(column)] for column in ['Mid', 'Spread', 'Delta'])
+        exit_mid, exit_spread = (exits.quotes[:, QUOTE_COLUMNS.index(column)] for column in ['Mid', 'Spread'])
+        quantity = live.quantity
+        new = ~has_previous
+        expiring = np.arange(len(exits)) < len(expired)
+
+        mvop = np.sum(mid * quantity)
+        premiums = - np.sum(mid[new] * quantity[new])
+        payoffs = np.sum(exit_mid[expiring] * exits.quantity[expiring])
+        unwinds = np.sum(exit_mid[~expiring] * exits.quantity[~expiring])
+        fees = np.sum(0.5 * spread[new] * np.abs(quantity[new])) + np.sum(0.5 * exit_spread * np.abs(exits.quantity))
+
+        hedged = values['hedging'][t, live.leg]
+        hedging_delta = np.sum(delta[hedged] * quantity[hedged])
+        prev_spot_quantity = hedging_delta if first else state['spot_quantity']
+        prev_spot = spot[t] if first else state['spot']
+        delta_hedge_pnl = prev_spot_quantity * (spot[t] - prev_spot)
+        delta_fees = np.abs(hedging_delta - prev_spot_quantity) * spot[t] * self.delta_fees_bps
+        cash = (self.notional if first else state['cash']) + premiums + payoffs + unwinds - fees - delta_fees + delta_hedge_pnl
+        il = cash + mvop
+
+        row = {'il': il, 'mvop': mvop, 'cash': cash, 'premiums': premiums, 'payoffs': payoffs, 'unwinds': unwinds, 'fees': fees,
+               'hedging_delta': hedging_delta, 'spot_quantity': hedging_delta, 'delta_hedge_pnl': delta_hedge_pnl, 'delta_fees': delta_fees,
+               'spot': spot[t], 'vix': values['vix'][t]}
+
+        # Greeks of the book now, reported as the portfolio greeks of the next timestamp
+        greek_columns = [QUOTE_COLUMNS.index(column) for column in ['Delta', 'Gamma', 'Vega', 'Theta', 'Rho']]
+        book_greeks = np.sum(live.quotes[:, greek_columns] * quantity[:, None], axis=0)
+        portfolio = np.zeros(len(greek_columns)) if first else state['book_greeks']
+        if self.pnl_explanation:
+            if first:
+                explanation = np.zeros(7)
+            else:
+                lagged = state['portfolio']
+                spot_change = spot[t] - state['spot']
+                pnl = il - state['il']
+                pnl_delta = (lagged[0] - state['spot_quantity']) * spot_change
+                pnl_gamma = 0.5 * lagged[1] * spot_change ** 2
+                vega, vol = previous[has_previous, greek_columns[2]], previous[has_previous, QUOTE_COLUMNS.index('Implied Vol')]
+                pnl_vega = np.sum(quantity[has_previous] * vega * (live.quotes[has_previous, QUOTE_COLUMNS.index('Implied Vol')] - vol))
+                pnl_theta = lagged[3] * (date.value - state['date']) / 1e9 / 3600 / 24 / 365
+                pnl_rho = lagged[4] * (rf[t] - state['rf']) / 100
+                pnl_unexplained = pnl - pnl_delta - pnl_gamma - pnl_vega - pnl_theta - pnl_rho - payoffs - premiums - unwinds - delta_hedge_pnl
+                explanation = [pnl, pnl_unexplained, pnl_delta, pnl_gamma, pnl_vega, pnl_theta, pnl_rho]
+            row.update(zip(['pnl', 'pnl_unexplained'], explanation[:2]))
+            row.update(zip(['portfolio_delta', 'portfolio_gamma', 'portfolio_vega', 'portfolio_theta', 'portfolio_rho'], portfolio))
+            row.update(zip(['pnl_delta', 'pnl_gamma', 'pnl_vega', 'pnl_theta', 'pnl_rho'], explanation[2:]))
+
+        state = {'date': date.value, 'spot': spot[t], 'rf': rf[t], 'cash': cash, 'il': il, 'spot_quantity': hedging_delta,
+                 'book_greeks': book_greeks, 'portfolio': portfolio}
+        return live, state, row
+
+    def get_data_fingerprint(self, t, values):
+        # Parameters, calendar and market data the results up to timestamp t depend on
+        return fingerprint(params_repr(self.params, RESUMABLE_PARAMS), self.calendar.asi8[:t + 1],
+                           *(values[name][:t + 1] for name in ['spot', 'rf', 'div', 'vix']))
+
+    def get_chain_fingerprint(self, date):
+        # The month file of the checkpoint may still be extended, only its rows up to the checkpoint count
+        self.open_option_month(date)
+        data = self.opened_month.data
+        return self.opened_month.file_path, frame_fingerprint(data[data.index <= date])
+
+    def save_checkpoint(self, t, book, state, values, sink):
+        date = self.calendar[t]
+        chain_file, chain_rows = self.get_chain_fingerprint(date)
+        # Signature of the result file with its rows up to date, a run stopped between replacing the result file and
+        # writing the checkpoint leaves a checkpoint that no longer matches it
+        write_checkpoint(self.checkpoint_file, {'date': date,
+                                                'sink': file_signature(sink) if isinstance(sink, str) else None,
+                                                'fingerprint': self.get_data_fingerprint(t, values),
+                                                'chain_files': {file_path: file_signature(file_path) for file_path in self.chain_files if file_path != chain_file},
+                                                'chain_file': chain_file,
+                                                'chain_rows': chain_rows,
+                                                'book': book.to_dict(),
+                                                'state': state})
+
+    def load_checkpoint(self, values, sink):
+        """
+        Calendar index, book and state to resume a streaming run from, None when there is no checkpoint or it does not
+        match the parameters and data of this run anymore.
+        """
+        checkpoint = read_checkpoint(self.checkpoint_file)
+        if checkpoint is None:
+            return None
+
+        t = self.calendar.get_indexer([checkpoint['date']])[0]
+        if isinstance(sink, str) and not os.path.exists(sink):
+            reason = f"{sink} does not exist"
+        elif isinstance(sink, str) and file_signature(sink) != checkpoint['sink']:
+            reason = f"{sink} changed since the checkpoint"
+        elif t < 0:
+            reason = f"{checkpoint['date']} is not in the calendar"
+        elif checkpoint['fingerprint'] != self.get_data_fingerprint(t, values):
+            reason = "parameters or market data changed"
+        elif any(file_signature(file_path) != signature for file_path, signature in checkpoint['chain_files'].items()):
+            reason = "option chain files changed"
+        elif (checkpoint['chain_file'], checkpoint['chain_rows']) != self.get_chain_fingerprint(checkpoint['date']):
+            reason = f"option chains changed up to {checkpoint['date']}"
+        else:
+            self.chain_files.update(checkpoint['chain_files'])
+            print(f"Resuming from the checkpoint at {checkpoint['date']}")
+            return t + 1, OpenBook.from_dict(checkpoint['book']), checkpoint['state']
+
+        print(f"Ignoring checkpoint {self.checkpoint_file}: {reason}")
+        return None
+
+    def run_streaming(self, sink, chunk_rows=1000):
+        """
+        Backtest in a single pass over the calendar that only keeps the options held and the accounting state of the
+        last timestamp. Result rows are sent to sink in chunks of chunk_rows instead of being kept in self.results.
+
+        With a checkpoint_file, the state at the last timestamp is saved and a later run resumes from it when only
+        end_date changed and the data up to the checkpoint is the same, its rows are then added to those of the sink.
+        A sink file changed since the checkpoint was saved is written again from the start.
+
+        Parameters:
+            sink: A .csv or .parquet file path, a function called with every chunk of rows as a DataFrame, or a
+                result writer (see lib.helpers.result_writers).
+        """
+        self.initialize()
+        values = self.get_calendar_values()
+        if self.prefetch_chains:
+            self.prefetcher = ChainPrefetcher()
+        try:
+            checkpoint = self.load_checkpoint(values, sink) if self.checkpoint_file is not None else None
+            start, book, state = (0, OpenBook(), None) if checkpoint is None else checkpoint
+            rows = RowBuffer(get_result_writer(sink, append=checkpoint is not None), chunk_rows)
+            try:
+                for t in range(start, len(self.calendar)):
+                    date = self.calendar[t]
+                    print(date)
+                    book, state, row = self.stream_step(t, date, book, state, values)
+                    rows.append(date, row)
+            except BaseException:
+                rows.abort()
+                raise
+            rows.close()
+            if self.checkpoint_file is not None and state is not None:
+                self.save_checkpoint(len(self.calendar) - 1, book, state, values, sink)
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+                self.prefetcher = None
+        print(f"Waited {self.chain_stall_time:.2f}s on option chain files")
+        self.open_book, self.stream_state = book, state
 
-        self.results.loc[:, "hedging_delta"] = self.hedging_delta
-        self.results.loc[:, "spot_quantity"] = self.spot_quantity
-        self.results.loc[:, "delta_hedge_pnl"] = self.delta_hedge_pnl
-        self.results.loc[:, "delta_fees"] = self.delta_fees
+    def create_report(self):
+        self.results = pd.DataFrame({'il': self.il,
+                                     'mvop': self.mvop,
+                                     'cash': self.cash,
+                                     'premiums': self.premiums,
+                                     'payoffs': self.payoffs,
+                                     'unwinds': self.unwinds,
+                                     'fees': self.fees,
+                                     'hedging_delta': self.hedging_delta,
+                                     'spot_quantity': self.spot_quantity,
+                                     'delta_hedge_pnl': self.delta_hedge_pnl,
+                                     'delta_fees': self.delta_fees}, index=self.calendar)
 
         self.results.loc[:, "spot"] = self.spot.loc[self.calendar]
         self.results.loc[:, "vix"] = self.vix.reindex(self.calendar, method='ffill')
 
         if self.pnl_explanation:
-            self.results.loc[:, 'pnl'] = self.pnl
-            self.results.loc[:, 'pnl_unexplained'] = self.pnl_unexplained
-
-            self.results.loc[:, 'portfolio_delta'] = self.portfolio_delta
-            self.results.loc[:, 'portfolio_gamma'] = self.portfolio_gamma
-            self.results.loc[:, 'portfolio_vega'] = self.portfolio_vega
-            self.results.loc[:, 'portfolio_theta'] = self.portfolio_theta
-            self.results.loc[:, 'portfolio_rho'] = self.portfolio_rho
-
-            self.results.loc[:, 'pnl_delta'] = self.pnl_delta
-            self.results.loc[:, 'pnl_gamma'] = self.pnl_gamma
-            self.results.loc[:, 'pnl_vega'] = self.pnl_vega
-            self.results.loc[:, 'pnl_theta'] = self.pnl_theta
-            self.results.loc[:, 'pnl_rho'] = self.pnl_rho
+            explanation = pd.DataFrame({'pnl': self.pnl,
+                                        'pnl_unexplained': self.pnl_unexplained,
+                                        'portfolio_delta': self.portfolio_delta,
+                                        'portfolio_gamma': self.portfolio_gamma,
+                                        'portfolio_vega': self.portfolio_vega,
+                                        'portfolio_theta': self.portfolio_theta,
+                                        'portfolio_rho': self.portfolio_rho,
+                                        'pnl_delta': self.pnl_delta,
+                                        'pnl_gamma': self.pnl_gamma,
+                                        'pnl_vega': self.pnl_vega,
+                                        'pnl_theta': self.pnl_theta,
+                                        'pnl_rho': self.pnl_rho}, index=self.calendar)
+            self.results = pd.concat([self.results, explanation], axis=1)
 
     def dump_results(self):
-        file_path = os.path.join(r"X:\Main Folder\Pycharm Projects\mugiwara_intraday_delta_hedge\Dumps", f"Backtest Multi {datetime.now().strftime('%Y-%m-%d %H%M%S')}.xlsx")
-
-        live_strikes = []
-        live_types = []
-        live_maturities = []
-        live_unwinds = []
-        live_quantities = []
-        live_mids = []
-        live_spreads = []
-        index = []
-
-        for key, options in self.live_portfolio.items():
-            index.append(key)
-
-            strikes = []
-            types = []
-            maturities = []
-            unwinds = []
-            quantities = []
-            mids = []
-            spreads = []
-
-            for option in options:
-                strikes.append(option["Strike"])
-                types.append(option["Type"])
-                maturities.append(option["Maturity"])
-                unwinds.append(option["Unwind"])
-                quantities.append(option["Quantity"])
-                mids.append(option["Mid"])
-                # spreads.append(option["Spread"])
-
-            live_strikes.append(strikes)
-            live_types.append(types)
-            live_maturities.append(maturities)
-            live_unwinds.append(unwinds)
-            live_quantities.append(quantities)
-            live_mids.append(mids)
-            # live_spreads.append(spreads)
-
-        live_strikes = pd.DataFrame(live_strikes, index=index)
-        live_types = pd.DataFrame(live_types, index=index)
-        live_maturities = pd.DataFrame(live_maturities, index=index)
-        live_unwinds = pd.DataFrame(live_unwinds, index=index)
-        live_quantities = pd.DataFrame(live_quantities, index=index)
-        live_mids = pd.DataFrame(live_mids, index=index)
-        # live_spreads = pd.DataFrame(live_spreads, index=index)
-
-        def force_str(x):
-            try:
-                x = x.replace(tzinfo=None)
-                return x.strftime('%Y-%m-%d %H:%M')
-            except:
-                return x
-
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-
-            self.results = self.results.map(force_str)
-            self.results.index = self.results.index.map(force_str)
-            self.results.to_excel(writer, sheet_name='results', index=True)
-
-            live_strikes = live_strikes.map(force_str)
-            live_strikes.index = live_strikes.index.map(force_str)
-            live_strikes.to_excel(writer, sheet_name='live_strikes', index=True)
-
-            live_types = live_types.map(force_str)
-            live_types.index = live_types.index.map(force_str)
-            live_types.to_excel(writer, sheet_name='live_types', index=True)
-
-            live_maturities = live_maturities.map(force_str)
-            live_maturities.index = live_maturities.index.map(force_str)
-            live_maturities.to_excel(writer, sheet_name='live_maturities', index=True)
-
-            live_unwinds = live_unwinds.map(force_str)
-            live_unwinds.index = live_unwinds.index.map(force_str)
-            live_unwinds.to_excel(writer, sheet_name='live_unwinds', index=True)
-
-            live_quantities = live_quantities.map(force_str)
-            live_quantities.index = live_quantities.index.map(force_str)
-            live_quantities.to_excel(writer, sheet_name='live_quantities', index=True)
-
-            live_mids = live_mids.map(force_str)
-            live_mids.index = live_mids.index.map(force_str)
-            live_mids.to_excel(writer, sheet_name='live_mids', index=True)
-
-            # live_spreads = live_spreads.map(force_str)
-            # live_spreads.index = live_spreads.index.map(force_str)
-            # live_spreads.to_excel(writer, sheet_name='live_spreads', index=True)
-
-        print(f"DataFrames written to {file_path}")
+        name = f"Backtest Multi {datetime.now().strftime('%Y-%m-%d %H%M%S')}"
+        tables = {'results': self.results.rename_axis('date'), 'positions': self.ledger.live_table()}
+        for file_path in write_result_tables(tables, self.output_folder, name, self.output_formats):
+            print(f"Results written to {file_path}")
 
     def run_backtest(self):
         self.initialize()
-        self.get_historical_rf_q()
-        self.build_rolling_portfolios()
-        self.attach_market_data()
+        if self.prefetch_chains:
+            self.prefetcher = ChainPrefetcher()
+        try:
+            self.build_rolling_portfolios()
+            self.attach_market_data()
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+                self.prefetcher = None
+        print(f"Waited {self.chain_stall_time:.2f}s on option chain files")
         self.compute_pnl()
         if self.pnl_explanation:
             self.explain_pnl()
         self.create_report()
-        self.dump_results()
+        if self.save_results:
+            self.dump_results()
 
@@ -0,0 +1,124 @@
+import copy
+import itertools
+import os
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.core.MultiOptions import MultiOptionsRoll, DATAPATH
+from lib.helpers.market_data import load_calendar, load_close_series, load_rate_series
+from lib.helpers.rate_store import get_close_store_path, get_dividend_store_path
+from lib.helpers.shared_market_data import SharedMarketData
+
+
+# Parameters MultiOptionsRoll reads from each leg, they are never set at the top level
+LEG_PARAMS = ['roll_days', 'eligible_maturities', 'maturity_number', 'unwind_dates', 'holding_period', 'moneyness', 'delta_strike',
+              'type', 'leverage', 'delta_hedging_time']
+
+
+def set_param(params, name, value):
+    # 'legs.1.leverage' sets one leg, a leg parameter without index sets the legs that have it, anything else is top level
+    keys = name.split('.')
+    if keys[0] == 'legs' and len(keys) == 3:
+        params['legs'][int(keys[1])][keys[2]] = value
+    elif name in LEG_PARAMS:
+        legs = [leg for leg in params.get('legs', []) if name in leg]
+        if len(legs) == 0:
+            raise ValueError(f"No leg has a {name} parameter, sweep it on one leg with 'legs.<index>.{name}'")
+        for leg in legs:
+            leg[name] = value
+    else:
+        params[name] = value
+
+
+def preload_market_data(params):
+    # Warm the per process caches with the files every variant reads
+    ticker = params['underlying_ticker']
+    load_calendar(os.path.join(DATAPATH, 'Options', ticker, "calendar.csv"))
+    load_close_series(os.path.join(DATAPATH, 'Spot', f"{ticker} Intraday.csv"))
+    load_close_series(os.path.join(DATAPATH, 'Spot', f"{params.get('vol_ticker', 'VIX')} Daily.csv"))
+    rates_folder = params.get('rates_folder', os.path.join(DATAPATH, 'Rates'))
+    for file_path in [get_close_store_path(rates_folder, params.get('rf_ticker', '^IRX')), get_dividend_store_path(rates_folder, ticker)]:
+        if os.path.exists(file_path):
+            load_rate_series(file_path)
+
+
+def run_variant(engine, params):
+    # Failures are returned rather than raised so that one variant cannot stop the sweep
+    try:
+        bt = engine(params)
+        bt.run_backtest()
+        return bt.results, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class ParameterSweep():
+    def __init__(self, base_params, grid, max_workers=None, engine=MultiOptionsRoll, share_market_data=False):
+        self.base_params = base_params
+        self.grid = grid
+        self.max_workers = max_workers
+        self.engine = engine
+        # Publish spot and chains once in shared memory instead of letting every worker parse its own copy
+        self.share_market_data = share_market_data
+
+        self.keys = list(self.grid.keys())
+        self.results = None
+        self.errors = None
+
+    def get_variants(self):
+        variants = []
+        for values in itertools.product(*self.grid.values()):
+            params = copy.deepcopy(self.base_params)
+            params['save_results'] = False
+            for name, value in zip(self.keys, values):
+                set_param(params, name, copy.deepcopy(value))
+            # lists (e.g. delta_hedging_time) are keyed as tuples
+            key = tuple(tuple(value) if isinstance(value, list) else value for value in values)
+            variants.append((key, params))
+        return variants
+
+    def prepare_rate_store(self):
+        # Download missing rate store files before the workers start rather than in every worker
+        bt = self.engine(self.base_params)
+        bt.get_rf_data()
+        if bt.carry_source == 'dividends':
+            bt.get_dividend_data()
+
+    def publish_market_data(self):
+        bt = self.engine(self.base_params)
+        shared = SharedMarketData()
+        spot_file_path = os.path.join(DATAPATH, 'Spot', f"{bt.underlying_ticker} Intraday.csv")
+        shared.publish_spot(spot_file_path, load_close_series(spot_file_path))
+        shared.publish_chains(bt.underlying_ticker, bt.start_date, bt.end_date, bt.store_folder, bt.data_folder, use_store=bt.option_data_source == 'store')
+        return shared
+
+    def run(self):
+        variants = self.get_variants()
+        self.prepare_rate_store()
+
+        shared = self.publish_market_data() if self.share_market_data else None
+        try:
+            if shared is not None:
+                for key, params in variants:
+                    params['shared_market_data'] = shared.descriptor
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=preload_market_data, initargs=(self.base_params,)) as executor:
+                futures = [executor.submit(run_variant, self.engine, params) for key, params in variants]
+                outcomes = [future.result() for future in futures]
+        finally:
+            if shared is not None:
+                shared.close()
+
+        results = {}
+        errors = []
+        for (key, params), (result, error) in zip(variants, outcomes):
+            if error is None:
+                results[key] = result
+            else:
+                errors.append(list(key) + [error])
+                print(f"Variant {dict(zip(self.keys, key))} failed:\n{error}")
+
+        # One tidy table indexed by the parameter values and the date
+        self.results = pd.concat(results, names=self.keys + ['date']) if len(results) > 0 else pd.DataFrame()
+        self.errors = pd.DataFrame(errors, columns=self.keys + ['error'])
+        return self.results
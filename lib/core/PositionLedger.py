@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+import pytz
+
+from lib.helpers.option_store import QUOTE_COLUMNS
+
+ny_tz = pytz.timezone('America/New_York')
+
+# How a position leaves the live book
+EXIT_NONE = 0
+EXIT_EXPIRED = 1
+EXIT_UNWOUND = 2
+
+
+class PositionLedger():
+    """
+    Array backed book of every option opened during a backtest.
+
+    Each position is stored once with the calendar index at which it is opened and the one at which it leaves the
+    live book, the first timestamp at or after its maturity or unwind date. Live, new, expired and unwound options
+    of a timestamp are derived from these indices instead of being copied at every timestamp.
+
+    Market data of live options is kept in `live_data`, one row per (timestamp, live position) entry ordered by
+    timestamp then position, columns ordered as QUOTE_COLUMNS. Market data at expiry or unwind is kept in
+    `exit_data`, one row per position.
+    """
+
+    def __init__(self, calendar):
+        self.calendar = calendar
+        self.calendar_ns = pd.DatetimeIndex(calendar).asi8
+
+        self._positions = {'open_ix': [], 'maturity': [], 'unwind': [], 'strike': [], 'type': [], 'quantity': [], 'leg': []}
+
+        self.open_ix = None
+        self.close_ix = None
+        self.exit_kind = None
+        self.maturity = None
+        self.unwind = None
+        self.strike = None
+        self.type = None
+        self.quantity = None
+        self.leg = None
+
+        self.entry_t = None
+        self.entry_pos = None
+        self.live_ptr = None
+        self.open_ptr = None
+        self.close_order = None
+        self.close_ptr = None
+
+        self.live_data = None
+        self.exit_data = None
+
+    def open_position(self, t, option):
+        # Positions must be opened in calendar order
+        self._positions['open_ix'].append(t)
+        self._positions['maturity'].append(option['Maturity'])
+        self._positions['unwind'].append(option['Unwind'])
+        self._positions['strike'].append(option['Strike'])
+        self._positions['type'].append(option['Type'])
+        self._positions['quantity'].append(option['Quantity'])
+        self._positions['leg'].append(option['index'])
+
+    def finalize(self):
+        positions = self._positions
+        n_dates = len(self.calendar_ns)
+
+        self.open_ix = np.array(positions['open_ix'], dtype=np.int64)
+        self.maturity = pd.to_datetime(pd.Index(positions['maturity'], dtype=object), utc=True).tz_convert(ny_tz)
+        self.unwind = pd.to_datetime(pd.Index(positions['unwind'], dtype=object), utc=True).tz_convert(ny_tz)
+        self.strike = np.array(positions['strike'], dtype=float)
+        self.type = np.array(positions['type'], dtype=np.int64)
+        self.quantity = np.array(positions['quantity'], dtype=float)
+        self.leg = np.array(positions['leg'], dtype=np.int64)
+
+        # A position is live from its opening until the first timestamp at or after its maturity or unwind date
+        maturity_ns, unwind_ns = self.maturity.asi8, self.unwind.asi8
+        self.close_ix = np.maximum(np.searchsorted(self.calendar_ns, np.minimum(maturity_ns, unwind_ns), side='left'), self.open_ix + 1)
+        close_ns = self.calendar_ns[np.minimum(self.close_ix, n_dates - 1)]
+        in_calendar = self.close_ix < n_dates
+        self.exit_kind = np.full(len(self.open_ix), EXIT_NONE, dtype=np.int8)
+        self.exit_kind[in_calendar & (close_ns == maturity_ns)] = EXIT_EXPIRED
+        self.exit_kind[in_calendar & (close_ns == unwind_ns) & (maturity_ns > close_ns)] = EXIT_UNWOUND
+
+        # One entry per live (timestamp, position), sorted by timestamp then position
+        durations = np.minimum(self.close_ix, n_dates) - self.open_ix
+        entry_pos = np.repeat(np.arange(len(self.open_ix)), durations)
+        entry_t = np.arange(len(entry_pos)) - np.repeat(np.cumsum(durations) - durations, durations) + np.repeat(self.open_ix, durations)
+        order = np.lexsort((entry_pos, entry_t))
+        self.entry_t, self.entry_pos = entry_t[order], entry_pos[order]
+
+        steps = np.arange(n_dates + 1)
+        self.live_ptr = np.searchsorted(self.entry_t, steps)
+        self.open_ptr = np.searchsorted(self.open_ix, steps)
+        self.close_order = np.argsort(self.close_ix, kind='stable')
+        self.close_ptr = np.searchsorted(self.close_ix[self.close_order], steps)
+
+        self.live_data = np.full((len(self.entry_pos), len(QUOTE_COLUMNS)), np.nan)
+        self.exit_data = np.full((len(self.open_ix), len(QUOTE_COLUMNS)), np.nan)
+        self._positions = None
+
+    def live(self, t):
+        # Slice of the live entries at timestamp t
+        return slice(self.live_ptr[t], self.live_ptr[t + 1])
+
+    def opened(self, t):
+        return np.arange(self.open_ptr[t], self.open_ptr[t + 1])
+
+    def closed(self, t):
+        return self.close_order[self.close_ptr[t]:self.close_ptr[t + 1]]
+
+    def expired(self, t):
+        closed = self.closed(t)
+        return closed[self.exit_kind[closed] == EXIT_EXPIRED]
+
+    def unwound(self, t):
+        closed = self.closed(t)
+        return closed[self.exit_kind[closed] == EXIT_UNWOUND]
+
+    def exited(self, t):
+        closed = self.closed(t)
+        return closed[self.exit_kind[closed] != EXIT_NONE]
+
+    def new_entries(self):
+        # Mask of the live entries at the timestamp their position is opened
+        return self.open_ix[self.entry_pos] == self.entry_t
+
+    def previous_entry(self):
+        # Entry at the previous timestamp of the same position for every live entry, -1 for new entries
+        order = np.lexsort((self.entry_t, self.entry_pos))
+        previous = np.full(len(order), -1)
+        same_position = self.entry_pos[order[1:]] == self.entry_pos[order[:-1]]
+        previous[order[1:][same_position]] = order[:-1][same_position]
+        return previous
+
+    def sum_live(self, values, mask=None):
+        # Per timestamp sum over the live entries of a value given per entry
+        if mask is None:
+            return np.bincount(self.entry_t, weights=values, minlength=len(self.calendar_ns))
+        return np.bincount(self.entry_t[mask], weights=values[mask], minlength=len(self.calendar_ns))
+
+    def sum_exits(self, values, kind):
+        # Per timestamp sum over the positions expiring or unwinding of a value given per position
+        mask = self.exit_kind == kind
+        return np.bincount(self.close_ix[mask], weights=values[mask], minlength=len(self.calendar_ns))
+
+    def previous_entries(self, t, positions):
+        # Entries at t - 1 of the given positions, -1 for positions not live at t - 1
+        if t == 0:
+            return np.full(len(positions), -1)
+        start, stop = self.live_ptr[t - 1], self.live_ptr[t]
+        previous = np.searchsorted(self.entry_pos[start:stop], positions) + start
+        found = (previous < stop) & (self.entry_pos[np.minimum(previous, len(self.entry_pos) - 1)] == positions)
+        return np.where(found, previous, -1)
+
+    def live_table(self, columns=('Strike', 'Type', 'Maturity', 'Unwind', 'Quantity', 'Mid')):
+        # One row per live (timestamp, position) entry with position attributes and market data columns
+        table = {'position': self.entry_pos, 'leg': self.leg[self.entry_pos]}
+        for column in columns:
+            if column in QUOTE_COLUMNS:
+                table[column] = self.live_data[:, QUOTE_COLUMNS.index(column)]
+            else:
+                table[column] = getattr(self, column.lower())[self.entry_pos]
+        return pd.DataFrame(table, index=pd.DatetimeIndex(self.calendar[self.entry_t], name='date'))
+
+
+class OpenBook():
+    """
+    Positions held at one timestamp with their latest market data, for runs that go through the calendar once.
+
+    Same position attributes as PositionLedger, maturities and unwind dates are kept as UTC nanoseconds. Memory
+    depends on the number of options held, not on the length of the backtest.
+    """
+
+    ATTRIBUTES = ['maturity', 'unwind', 'strike', 'type', 'quantity', 'leg']
+
+    def __init__(self, maturity=None, unwind=None, strike=None, type=None, quantity=None, leg=None, quotes=None):
+        self.maturity = np.zeros(0, dtype=np.int64) if maturity is None else maturity
+        self.unwind = np.zeros(0, dtype=np.int64) if unwind is None else unwind
+        self.strike = np.zeros(0) if strike is None else strike
+        self.type = np.zeros(0, dtype=np.int64) if type is None else type
+        self.quantity = np.zeros(0) if quantity is None else quantity
+        self.leg = np.zeros(0, dtype=np.int64) if leg is None else leg
+        self.quotes = np.full((len(self.maturity), len(QUOTE_COLUMNS)), np.nan) if quotes is None else quotes
+
+    def __len__(self):
+        return len(self.maturity)
+
+    @classmethod
+    def from_options(cls, options):
+        # Options as returned by get_new_options, without market data
+        if len(options) == 0:
+            return cls()
+        return cls(maturity=pd.to_datetime(pd.Index([option['Maturity'] for option in options], dtype=object), utc=True).asi8,
+                   unwind=pd.to_datetime(pd.Index([option['Unwind'] for option in options], dtype=object), utc=True).asi8,
+                   strike=np.array([option['Strike'] for option in options], dtype=float),
+                   type=np.array([option['Type'] for option in options], dtype=np.int64),
+                   quantity=np.array([option['Quantity'] for option in options], dtype=float),
+                   leg=np.array([option['index'] for option in options], dtype=np.int64))
+
+    @classmethod
+    def from_dict(cls, arrays):
+        return cls(**arrays)
+
+    def to_dict(self):
+        arrays = {attribute: getattr(self, attribute) for attribute in self.ATTRIBUTES}
+        arrays['quotes'] = self.quotes
+        return arrays
+
+    def take(self, mask):
+        return OpenBook(**{attribute: values[mask] for attribute, values in self.to_dict().items()})
+
+    def concat(self, other):
+        return OpenBook(**{attribute: np.concatenate([values, getattr(other, attribute)]) for attribute, values in self.to_dict().items()})
+
+    def maturity_index(self):
+        return pd.DatetimeIndex(self.maturity.view('datetime64[ns]'), tz='UTC').tz_convert(ny_tz)
+
+    def split(self, date_ns):
+        # Held, expired and unwound positions at a timestamp, same rules as PositionLedger
+        held = (self.maturity > date_ns) & (self.unwind > date_ns)
+        expired = self.maturity == date_ns
+        unwound = (self.maturity > date_ns) & (self.unwind == date_ns)
+        return self.take(held), self.take(expired), self.take(unwound)
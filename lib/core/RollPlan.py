@@ -0,0 +1,50 @@
+import os
+import pandas as pd
+import pytz
+
+from lib.helpers.rrule_helper import get_eligible_maturities
+
+ny_tz = pytz.timezone('America/New_York')
+
+
+class RollPlan():
+    """
+    Roll dates, target maturities and unwind dates of every leg, compiled once from the legs' rules.
+
+    `schedule` has one row per leg and roll date and can be inspected as is. The plan can be saved and loaded back so
+    that repeat runs skip the compilation, `key` identifies the calendar and rules it was compiled from.
+    """
+
+    def __init__(self, schedule, key):
+        self.schedule = schedule
+        self.key = key
+        self._legs = {leg: frame.set_index('roll_date') for leg, frame in schedule.groupby('leg')}
+
+    @classmethod
+    def compile(cls, calendar, roll_mask, eligible_maturities, maturity_number, unwind_dates, holding_period, close_time, key):
+        close = pd.to_timedelta(f"{close_time}:00")
+        frames = []
+        for ix in range(roll_mask.shape[1]):
+            roll_dates = calendar[roll_mask[:, ix]]
+            target_maturity = get_eligible_maturities(eligible_maturities[ix], roll_dates, maturity_number[ix])
+            unwind = (get_eligible_maturities(unwind_dates[ix], roll_dates, holding_period[ix]) + close).tz_localize(ny_tz)
+            frames.append(pd.DataFrame({'leg': ix, 'roll_date': roll_dates, 'target_maturity': target_maturity, 'unwind': unwind}))
+        schedule = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=['leg', 'roll_date', 'target_maturity', 'unwind'])
+        return cls(schedule, key)
+
+    def target_maturity(self, ix, date):
+        # Naive date of the targeted maturity
+        return self._legs[ix].at[date, 'target_maturity']
+
+    def unwind(self, ix, date):
+        return self._legs[ix].at[date, 'unwind']
+
+    def save(self, file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        self.schedule.assign(key=self.key).to_parquet(file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        schedule = pd.read_parquet(file_path)
+        key = schedule['key'].iloc[0] if len(schedule) > 0 else None
+        return cls(schedule.drop(columns='key'), key)
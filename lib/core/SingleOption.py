@@ -1,6 +1,8 @@
 import pandas as pd
 from dateutil import rrule
 from lib.helpers.rrule_helper import (get_roll_dates, get_eligible_maturity, weekdays_rule, mondays_wednesdays_fridays_rule, fridays_rule, third_fridays_rule, third_fridays_quarterly_rule)
+from lib.helpers.option_store import get_option_file_name
+from lib.helpers.chain_cache import chain_cache, load_option_month
 import os
 import pytz
 import copy
@@ -20,6 +22,9 @@ class SingleOptionRoll():
         self.start_date = pd.to_datetime(self.params['start_date']).tz_localize(ny_timezone) + pd.Timedelta(hours=16)
         self.end_date = pd.to_datetime(self.params['end_date']).tz_localize(ny_timezone) + pd.Timedelta(hours=16)
         self.data_folder = os.path.join(DATAPATH, 'Options', self.underlying_ticker, 'Pre Processed')
+        self.store_folder = os.path.join(DATAPATH, 'Options', self.underlying_ticker, 'Store')
+        # 'store' reads the columnar store and falls back to csv for missing months, 'csv' always parses csv
+        self.option_data_source = params.get('option_data_source', 'store')
 
         # Get spot close prices
         self.spot = pd.read_csv(os.path.join(DATAPATH, 'Spot', f"{self.underlying_ticker} Daily.csv"), index_col=0)['Close']
@@ -34,7 +39,9 @@ class SingleOptionRoll():
         self.roll_calendar = self.get_roll_calendar()
 
         self.opened_file = ''
+        self.opened_file_path = ''
         self.opened_data_file = None
+        self.opened_month = None
 
         self.live_portfolio = {}
         self.expired_portfolio = {}
@@ -103,16 +110,8 @@ class SingleOptionRoll():
 
     def get_new_options(self, date):
         new_options = []
-        # get today's option data and spot close
-        spot = self.spot.loc[date]
-        data = self.get_option_data(date)
-        # select closest higher or equal maturity available
-        maturity = data['Maturity'].loc[(data['Maturity'].apply(lambda x: x.date()) >= self.get_target_maturity(date).date()) & (data['Type'] == self.type)].min()
-        data = data.loc[(data['Maturity'] == maturity) & (data['Type'] == self.type)]
-        if self.type == 0:
-            strike = data['Strike'].loc[data['Strike'] <= spot * self.moneyness].max()
-        else:
-            strike = data['Strike'].loc[data['Strike'] >= spot * self.moneyness].min()
+        # select closest higher or equal maturity available, then the strike by moneyness against today's spot close
+        maturity, strike = self.get_selection_index(date).select(self.type, self.get_target_maturity(date), self.spot.loc[date], self.moneyness)
         # Select Option
         option = {'Maturity': maturity,
                   'Unwind': self.get_unwind_date(date),
@@ -149,36 +148,19 @@ class SingleOptionRoll():
             self.unwind_portfolio[date] = [option for option in copy.deepcopy(prev_portfolio) if (option['Maturity'] > date >= option['Unwind'])]
 
     def get_option_data(self, date):
-        file_name = f'{self.underlying_ticker.lower()}_eod_{date.strftime('%Y%m')}.csv'
-        file_path = os.path.join(self.data_folder, file_name)
-
-        if file_path != self.opened_file:
-            # Use new file
-            self.opened_file = file_path
-            self.opened_data_file = pd.read_csv(self.opened_file, index_col=0)
-            # Reformat index to close NY
-            self.opened_data_file.index = pd.to_datetime(self.opened_data_file.index)
-            self.opened_data_file.index = self.opened_data_file.index.normalize() + pd.Timedelta(hours=16)
-            self.opened_data_file.index = self.opened_data_file.index.tz_localize(ny_timezone)
-            # Reformat Maturity to close NY
-            self.opened_data_file.loc[:, 'Maturity'] = pd.to_datetime(self.opened_data_file['Maturity']).apply(lambda x: x.normalize().tz_localize(ny_timezone) + pd.Timedelta(hours=16))
-            # format the rest
-            self.opened_data_file.loc[:, 'Strike'] = pd.to_numeric(self.opened_data_file['Strike'], errors='coerce')
-            self.opened_data_file.loc[:, 'Bid'] = pd.to_numeric(self.opened_data_file['Bid'], errors='coerce')
-            self.opened_data_file.loc[:, 'Ask'] = pd.to_numeric(self.opened_data_file['Ask'], errors='coerce')
-            self.opened_data_file.loc[:, 'Spot'] = pd.to_numeric(self.opened_data_file['Spot'], errors='coerce')
-            self.opened_data_file.loc[:, 'Volume'] = pd.to_numeric(self.opened_data_file['Volume'], errors='coerce')
-            self.opened_data_file.loc[:, 'Implied Vol'] = pd.to_numeric(self.opened_data_file['Implied Vol'], errors='coerce')
-            self.opened_data_file.loc[:, 'Delta'] = pd.to_numeric(self.opened_data_file['Delta'], errors='coerce')
-            self.opened_data_file.loc[:, 'Gamma'] = pd.to_numeric(self.opened_data_file['Gamma'], errors='coerce')
-            self.opened_data_file.loc[:, 'Vega'] = pd.to_numeric(self.opened_data_file['Vega'], errors='coerce')
-            self.opened_data_file.loc[:, 'Theta'] = pd.to_numeric(self.opened_data_file['Theta'], errors='coerce')
-            self.opened_data_file.loc[:, 'Rho'] = pd.to_numeric(self.opened_data_file['Rho'], errors='coerce')
-            self.opened_data_file.loc[:, 'Type'] = pd.to_numeric(self.opened_data_file['Type'], errors='coerce')
-            self.opened_data_file.loc[:, 'Mid'] = (self.opened_data_file.loc[:, 'Bid'] + self.opened_data_file.loc[:, 'Ask']) / 2
-            self.opened_data_file.loc[:, 'Spread'] = self.opened_data_file.loc[:, 'Ask'] - self.opened_data_file.loc[:, 'Bid']
-
-        return self.opened_data_file.loc[date]
+        file_name = get_option_file_name(self.underlying_ticker, date)
+
+        if file_name != self.opened_file:
+            # Use new file, from the columnar store unless the csv fallback is requested, parsed months are cached for the whole process
+            self.opened_file = file_name
+            self.opened_month = load_option_month(self.underlying_ticker, date, self.store_folder, self.data_folder, use_store=self.option_data_source == 'store')
+            self.opened_file_path, self.opened_data_file = self.opened_month.file_path, self.opened_month.data
+
+        return chain_cache.get_date_slice(self.opened_month, date, dropna_mid=False)
+
+    def get_selection_index(self, date):
+        self.get_option_data(date)
+        return chain_cache.get_selection_index(self.opened_month, date, dropna_mid=False)
 
     def attach_market_data(self):
         for date in self.calendar:
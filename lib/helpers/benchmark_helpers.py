@@ -0,0 +1,13 @@
+import sys
+
+
+def peak_rss_mb():
+    # Peak resident memory of the current process in MB
+    if sys.platform == 'win32':
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
@@ -1,34 +1,98 @@
 import os
+import time
 import pandas as pd
+import pytz
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from lib.helpers.option_store import read_store_quote_dates, STORE_EXTENSION
+from lib.helpers.preprocess_raw_data import read_manifest, write_manifest, SHARED_RAW_COLUMNS
 
-def aggregate_index_values(data_path, target_path):
-    # List all files in the folder
-    files = [f for f in os.listdir(data_path) if f.endswith('.csv')]
+ny_tz = pytz.timezone('America/New_York')
 
-    # Initialize a set to store unique index values
-    unique_values = set()
+CALENDAR_NAME = 'calendar.csv'
+# Quote days of the files already scanned, kept next to the calendar
+MANIFEST_NAME = 'calendar_manifest.json'
 
-    # Iterate through each file
+
+def to_calendar(days):
+    # 'YYYY-MM-DD' quote days to the 16:00 New York timestamps read by load_calendar
+    days = pd.DatetimeIndex(sorted(set(days)))
+    return (days + pd.Timedelta(hours=16)).tz_localize(ny_tz)
+
+
+def write_calendar(calendar, file_path):
+    pd.DataFrame({'Index': calendar}).to_csv(file_path, index=False)
+
+
+def read_quote_dates(file_path, date_column=SHARED_RAW_COLUMNS['Date']):
+    # Only the quote date column is read, each distinct value is parsed once
+    values = pd.read_csv(file_path, usecols=[date_column], skipinitialspace=True, dtype=str)[date_column].dropna().unique()
+    dates = pd.DatetimeIndex(pd.to_datetime(values, errors='coerce')).dropna()
+    return sorted(dates.normalize().unique().strftime('%Y-%m-%d'))
+
+
+def scan_file(file_path, date_column):
+    stat = os.stat(file_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'dates': read_quote_dates(file_path, date_column)}
+
+
+def aggregate_index_values(data_path, target_path, date_column=SHARED_RAW_COLUMNS['Date'], max_workers=None, force=False):
+    """
+    Build the calendar of quote dates of a folder of raw csv files into `calendar.csv` in target_path.
+
+    Files are scanned on a process pool, reading their quote date column only. The quote dates of every file are kept
+    in a manifest, later runs only scan the files added or changed (by mtime and size) since, unless force.
+
+    Returns:
+        pd.DatetimeIndex: Calendar of 16:00 New York timestamps.
+    """
+    start = time.perf_counter()
+    os.makedirs(target_path, exist_ok=True)
+    manifest_path = os.path.join(target_path, MANIFEST_NAME)
+    manifest = {} if force else read_manifest(manifest_path)
+
+    files = sorted(f for f in os.listdir(data_path) if f.endswith('.csv'))
+    # Files removed from the folder no longer count
+    manifest = {file_name: entry for file_name, entry in manifest.items() if file_name in files}
+    pending = []
     for file_name in files:
-        file_path = os.path.join(data_path, file_name)
+        stat = os.stat(os.path.join(data_path, file_name))
+        entry = manifest.get(file_name)
+        if entry is None or (entry['mtime_ns'], entry['size']) != (stat.st_mtime_ns, stat.st_size):
+            pending.append(file_name)
+
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(scan_file, os.path.join(data_path, file_name), date_column): file_name for file_name in pending}
+            for future in as_completed(futures):
+                manifest[futures[future]] = future.result()
+    write_manifest(manifest, manifest_path)
+
+    calendar = to_calendar(date for entry in manifest.values() for date in entry['dates'])
+    write_calendar(calendar, os.path.join(target_path, CALENDAR_NAME))
+    print(f"{len(calendar)} quote dates, {len(pending)} files scanned, {len(files) - len(pending)} unchanged in {time.perf_counter() - start:.2f}s")
+    return calendar
 
-        # Read the CSV file, considering the index column (index_col=2)
-        df = pd.read_csv(file_path, index_col=2)
 
-        # Extract unique index values and add them to the set
-        unique_values.update(df.index.unique())
+def get_store_calendar(store_folder, target_path=None):
+    """
+    Calendar of the quote dates of a columnar chain store, from the footers of its month files without reading rows.
+    Written to `calendar.csv` in target_path if given.
 
-    # Sort the unique index values
-    sorted_values = sorted(unique_values)
+    Returns:
+        pd.DatetimeIndex: Calendar of 16:00 New York timestamps.
+    """
+    files = sorted(f for f in os.listdir(store_folder) if f.endswith(STORE_EXTENSION))
+    calendar = to_calendar(date for file_name in files for date in read_store_quote_dates(os.path.join(store_folder, file_name)))
+    if target_path is not None:
+        write_calendar(calendar, os.path.join(target_path, CALENDAR_NAME))
+    return calendar
 
-    # Write the sorted values to a new CSV file
-    target_file_path = os.path.join(target_path, 'aggregated_values.csv')
-    pd.DataFrame(sorted_values, columns=['Index']).to_csv(target_file_path, index=False)
 
+if __name__ == '__main__':
 
-# Example usage:
-data_path = r'X:\Main Folder\Options Data\QQQ\Raw'
-target_path = r'X:\Main Folder\Options Data\QQQ'
+    # Example usage:
+    data_path = r'X:\Main Folder\Options Data\QQQ\Raw'
+    target_path = r'X:\Main Folder\Options Data\QQQ'
 
-aggregate_index_values(data_path, target_path)
\ No newline at end of file
+    aggregate_index_values(data_path, target_path)
@@ -0,0 +1,191 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.helpers.option_store import get_option_month_path, read_option_file, build_contract_panel
+from lib.helpers.selection_index import SelectionIndex
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def get_nbytes(data):
+    if hasattr(data, 'memory_usage'):
+        usage = data.memory_usage(index=True, deep=False)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    return 0
+
+
+class ChainMonth():
+    # One cached month file: parsed chain, contract panel, date slices and their selection indexes
+    def __init__(self, file_path, data):
+        self.file_path = file_path
+        self.data = data
+        self.panel = None
+        self.slices = {}
+        self.selections = {}
+        self.nbytes = get_nbytes(data)
+
+
+class ChainCache():
+    """
+    Least recently used cache of parsed option chain months, shared by every backtest of the process.
+
+    Months are keyed by file path and modification time so that rewritten files are parsed again. Contract panels, date
+    slices and selection indexes are cached with their month and count towards the byte budget. Cached objects are
+    shared between callers and must be treated as read only.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.months = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.slice_hits = 0
+        self.slice_misses = 0
+        self.prefetch_hits = 0
+        self.evictions = 0
+
+    def get_month(self, key, loader):
+        # key[0] is the file path or name, loader(key[0]) parses the month on a miss
+        if key in self.months:
+            self.hits += 1
+            self.months.move_to_end(key)
+            return self.months[key]
+
+        self.misses += 1
+        month = ChainMonth(key[0], loader(key[0]))
+        self.add_month(key, month)
+        return month
+
+    def add_month(self, key, month):
+        # Insert a month parsed elsewhere, e.g. by a ChainPrefetcher
+        for stale_key in [k for k in self.months if k[0] == key[0]]:
+            self.remove(stale_key)
+        self.months[key] = month
+        self.nbytes += month.nbytes
+        self.evict()
+
+    def get_panel(self, month):
+        if month.panel is None:
+            month.panel = build_contract_panel(month.data)
+            self.add_bytes(month, get_nbytes(month.panel))
+        return month.panel
+
+    def get_date_slice(self, month, date, dropna_mid=True):
+        key = (date, dropna_mid)
+        if key in month.slices:
+            self.slice_hits += 1
+            return month.slices[key]
+
+        self.slice_misses += 1
+        data = month.data.loc[date]
+        if dropna_mid:
+            data = data.dropna(subset=['Mid'])
+        month.slices[key] = data
+        self.add_bytes(month, get_nbytes(data))
+        return data
+
+    def get_selection_index(self, month, date, dropna_mid=True):
+        key = (date, dropna_mid)
+        if key not in month.selections:
+            month.selections[key] = SelectionIndex(self.get_date_slice(month, date, dropna_mid))
+            self.add_bytes(month, month.selections[key].nbytes)
+        return month.selections[key]
+
+    def add_bytes(self, month, nbytes):
+        # Months evicted while a backtest still holds them no longer count towards the cache
+        month.nbytes += nbytes
+        if any(cached is month for cached in self.months.values()):
+            self.nbytes += nbytes
+            self.evict()
+
+    def remove(self, key):
+        month = self.months.pop(key)
+        self.nbytes -= month.nbytes
+
+    def evict(self):
+        # The most recently used month is kept even when it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self.months) > 1:
+            self.remove(next(iter(self.months)))
+            self.evictions += 1
+
+    def clear(self):
+        self.months.clear()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def stats(self):
+        return {'months': len(self.months), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                'slice_hits': self.slice_hits, 'slice_misses': self.slice_misses, 'prefetch_hits': self.prefetch_hits,
+                'evictions': self.evictions}
+
+
+chain_cache = ChainCache()
+
+
+def prefetch_month(file_path):
+    # Parse the month and build its contract panel, runs on the prefetch thread
+    month = ChainMonth(file_path, read_option_file(file_path))
+    month.panel = build_contract_panel(month.data)
+    month.nbytes += get_nbytes(month.panel)
+    return month
+
+
+class ChainPrefetcher():
+    """
+    Parses month files on a background thread ahead of the backtest.
+
+    Months are handed over to the chain cache by `load_option_month` when the backtest asks for them, waiting for the
+    parse to finish if it is still running.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+
+    def prefetch(self, ticker, date, store_folder, csv_folder, use_store=True):
+        file_path = get_option_month_path(ticker, date, store_folder, csv_folder, use_store=use_store)
+        if not os.path.exists(file_path):
+            return
+        key = (file_path, os.path.getmtime(file_path))
+        if key not in chain_cache.months and key not in self.pending:
+            self.pending[key] = self.executor.submit(prefetch_month, file_path)
+
+    def take(self, key):
+        future = self.pending.pop(key, None)
+        return future.result() if future is not None else None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending = {}
+
+
+def load_option_month(ticker, date, store_folder, csv_folder, use_store=True, prefetcher=None):
+    # Cached equivalent of read_option_month
+    file_path = get_option_month_path(ticker, date, store_folder, csv_folder, use_store=use_store)
+    key = (file_path, os.path.getmtime(file_path))
+    if prefetcher is not None and key not in chain_cache.months:
+        month = prefetcher.take(key)
+        if month is not None:
+            # Parsed by the prefetcher, neither a hit nor a miss of the cache
+            chain_cache.add_month(key, month)
+            chain_cache.prefetch_hits += 1
+            return month
+    return chain_cache.get_month(key, read_option_file)
+
+
+def set_chain_cache_budget(max_bytes):
+    chain_cache.max_bytes = max_bytes
+    chain_cache.evict()
+
+
+def get_chain_cache_stats():
+    return chain_cache.stats()
+
+
+def clear_chain_cache():
+    chain_cache.clear()
@@ -0,0 +1,49 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+CHECKPOINT_VERSION = 2
+
+
+def fingerprint(*parts):
+    # sha1 of strings and arrays
+    checksum = hashlib.sha1()
+    for part in parts:
+        checksum.update(part.encode() if isinstance(part, str) else np.ascontiguousarray(part).tobytes())
+    return checksum.hexdigest()
+
+
+def params_repr(params, ignored=()):
+    return repr(sorted((name, value) for name, value in params.items() if name not in ignored))
+
+
+def frame_fingerprint(data):
+    return fingerprint(pd.util.hash_pandas_object(data, index=True).values)
+
+
+def file_signature(file_path):
+    # Modification time and size, None for data that is not read from a file
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def write_checkpoint(file_path, checkpoint):
+    # Written next to the target then renamed, an interrupted write never leaves a truncated checkpoint
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'wb') as file:
+        pickle.dump(dict(checkpoint, version=CHECKPOINT_VERSION), file)
+    os.replace(temp_path, file_path)
+
+
+def read_checkpoint(file_path):
+    # None when there is no checkpoint or it was written by another version
+    if file_path is None or not os.path.exists(file_path):
+        return None
+    with open(file_path, 'rb') as file:
+        checkpoint = pickle.load(file)
+    return checkpoint if checkpoint.get('version') == CHECKPOINT_VERSION else None
@@ -1,64 +1,124 @@
 import os
+import time
 import pandas as pd
 import numpy as np
 
+from lib.helpers.result_writers import get_result_writer
 
-def convert_to_ny_timezone(row):
-    # Combine date and time into a single string
-    datetime_str = f"{row['<DTYYYYMMDD>']} {row['<TIME>']}"
+ny_tz = 'America/New_York'
+OHLC = ['Open', 'High', 'Low', 'Close']
+RAW_OHLC = ['<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>']
 
-    # Convert string to datetime object in GMT timezone
-    datetime_gmt = pd.to_datetime(datetime_str, format='%Y%m%d %H%M').tz_localize('GMT')
 
-    # Convert to New York timezone
-    datetime_ny = datetime_gmt.tz_convert('America/New_York')
-
-    return datetime_ny
-
-
-# Define a function to convert the timestamp
-def convert_timezone(ts):
-    # Convert to America/New_York timezone
-    ts = ts.tz_convert('America/New_York')
-    # Reset the time to 09:30
-    ts = ts.replace(hour=16, minute=00)
-    return ts
-
-# Press the green button in the gutter to run the script.
-if __name__ == '__main__':
-    file_path_eod = r"X:\Main Folder\Data\Spot\QQQ Daily.csv"
-    data_eod = pd.read_csv(file_path_eod, index_col=0, parse_dates=True)
-    data_eod.index = data_eod.index.map(convert_timezone)
+def load_eod_data(file_path):
+    # Daily bars stamped at the 16:00 New York close, with the previous day's close
+    data_eod = pd.read_csv(file_path, index_col=0)
+    data_eod.index = pd.to_datetime(data_eod.index, utc=True).tz_convert(ny_tz).normalize() + pd.Timedelta(hours=16)
+    data_eod = data_eod.loc[~data_eod.index.duplicated(keep='first')]
     data_eod['Previous Close'] = data_eod['Close'].shift(1)
+    return data_eod
+
+
+def read_intraday_chunks(file_path, chunk_rows=1000000):
+    # Bars of the regular session in New York time, chunk_rows raw rows at a time
+    for chunk in pd.read_csv(file_path, usecols=['<DTYYYYMMDD>', '<TIME>'] + RAW_OHLC, chunksize=chunk_rows):
+        # Times are HHMM integers in GMT, shorter ones are dropped
+        chunk = chunk[chunk['<TIME>'].astype(str).str.len() == 4]
+        timestamps = pd.to_datetime(chunk['<DTYYYYMMDD>'].astype(str) + chunk['<TIME>'].astype(str), format='%Y%m%d%H%M')
+        index = pd.DatetimeIndex(timestamps, name='Date').tz_localize('GMT').tz_convert(ny_tz)
+        data = pd.DataFrame(chunk[RAW_OHLC].to_numpy(dtype=float), index=index, columns=OHLC)
+        yield data.between_time('09:30', '16:00')
+
+
+def at_local_time(days, hours, minutes=0):
+    # New York wall clock time on each day
+    return (days.tz_localize(None) + pd.Timedelta(hours=hours, minutes=minutes)).tz_localize(ny_tz)
+
+
+def asof_values(series, keys):
+    # Last non missing value at or before each key, as Series.asof
+    series = series.dropna()
+    position = np.searchsorted(series.index.asi8, keys.asi8, side='right') - 1
+    return np.where(position >= 0, series.to_numpy()[np.maximum(position, 0)], np.nan)
+
+
+def rebase_intraday(data, data_eod, history):
+    """
+    Rescale intraday bars so that each day's move from the previous close to the close matches the daily bars.
+
+    Day level values are looked up once per day and broadcast to its bars. history holds the last valid opens and
+    closes before data, for the lookups that reach back to previous days.
+    """
+    codes, days = pd.factorize(data.index.normalize())
+    opens, closes = pd.concat([history['Open'], data['Open']]), pd.concat([history['Close'], data['Close']])
+
+    day_values = pd.DataFrame({'open_day': asof_values(opens, at_local_time(days, 9, 30)),
+                               'close_day': asof_values(closes, at_local_time(days, 16)),
+                               'previous_close_day': asof_values(closes, at_local_time(days, 9))})
+    eod = data_eod.reindex(at_local_time(days, 16))
+    day_values['open_eod'] = eod['Open'].to_numpy()
+    day_values['close_eod'] = eod['Close'].to_numpy()
+    day_values['previous_close_eod'] = eod['Previous Close'].to_numpy()
+
+    values = day_values.to_numpy()[codes]
+    keep = ~(np.isnan(data.to_numpy()).any(axis=1) | np.isnan(values).any(axis=1))
+    data, day_values = data.loc[keep], pd.DataFrame(values[keep], columns=day_values.columns)
+
+    day = {column: day_values[column].to_numpy()[:, None] for column in day_values.columns}
+    rebased = (data.to_numpy() - day['previous_close_day']) / (day['close_day'] - day['previous_close_day']) * (day['close_eod'] - day['previous_close_eod']) + day['previous_close_eod']
+    return pd.DataFrame(rebased, index=data.index, columns=OHLC).dropna()
+
+
+def last_valid(series):
+    return series.dropna().iloc[-1:]
+
+
+def build_intraday_series(intraday_file_path, eod_file_path, output_file_path, chunk_rows=1000000):
+    """
+    Build the '{ticker} Intraday' series from 15 minute bars rebased on the daily bars.
+
+    The intraday file is read chunk_rows rows at a time. The last day of a chunk is held back until the next chunk
+    completes it, and rebased rows are written as they are produced, so memory does not grow with the length of the
+    file. The output format follows the extension of output_file_path (.csv, .parquet or .arrow).
+
+    Returns:
+        int: Number of rows written.
+    """
+    data_eod = load_eod_data(eod_file_path)
+    writer = get_result_writer(output_file_path)
+    history = {column: pd.Series(dtype=float, index=pd.DatetimeIndex([], tz=ny_tz)) for column in ['Open', 'Close']}
+    pending = None
+    rows = 0
+
+    def write_days(data):
+        nonlocal history, rows
+        if len(data) == 0:
+            return
+        rebased = rebase_intraday(data, data_eod, history)
+        history = {column: last_valid(pd.concat([history[column], data[column]])) for column in ['Open', 'Close']}
+        if len(rebased) > 0:
+            writer.write(rebased)
+            rows += len(rebased)
+
+    try:
+        for chunk in read_intraday_chunks(intraday_file_path, chunk_rows):
+            pending = chunk if pending is None else pd.concat([pending, chunk])
+            if len(pending) == 0:
+                continue
+            last_day = pending.index[-1].normalize()
+            write_days(pending.loc[pending.index < last_day])
+            pending = pending.loc[pending.index >= last_day]
+        if pending is not None:
+            write_days(pending)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return rows
 
 
-    file_path_intraday = r"X:\Main Folder\Data\Spot\USA100_15min.csv"
-    data = pd.read_csv(file_path_intraday)
-    data = data[data['<TIME>'].apply(str).apply(len) == 4]
-    data['Date'] = data.apply(convert_to_ny_timezone, axis=1)
-    data.set_index('Date', inplace=True)
-    data = data[['<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>']]
-    data.columns = ['Open', 'High', 'Low', 'Close']
-
-    data = data.between_time('09:30', '16:00')
-
-    data['open_day'] = data.apply(lambda x: data['Open'].asof(x.name.replace(hour=9, minute=30)), axis=1)
-    data['close_day'] = data.apply(lambda x: data['Close'].asof(x.name.replace(hour=16, minute=00)), axis=1)
-    data['previous_close_day'] = data.apply(lambda x: data['Close'].asof(x.name.replace(hour=9, minute=00)), axis=1)
-
-    data['open_eod'] = data.apply(lambda x: np.nan if x.name.replace(hour=16, minute=00) not in data_eod.index else data_eod.at[x.name.replace(hour=16, minute=0), 'Open'], axis=1)
-    data['close_eod'] = data.apply(lambda x: np.nan if x.name.replace(hour=16, minute=00) not in data_eod.index else data_eod.at[x.name.replace(hour=16, minute=0), 'Close'], axis=1)
-    data['previous_close_eod'] = data.apply(lambda x: np.nan if x.name.replace(hour=16, minute=00) not in data_eod.index else data_eod.at[x.name.replace(hour=16, minute=0), 'Previous Close'], axis=1)
-    data.dropna(inplace=True)
-
-
-    data_new = pd.DataFrame(index=data.index, columns=['Open', 'High', 'Low', 'Close'])
-
-    for column in ['Open', 'High', 'Low', 'Close']:
-        data_new.loc[:, column] = data.apply(lambda x: (x[column] - x['previous_close_day']) / (x['close_day'] - x['previous_close_day']) * (x['close_eod'] - x['previous_close_eod']) + x['previous_close_eod'], axis=1)
-
-    data_new.dropna(inplace=True)
-
-    data_new.to_csv(r"X:\Main Folder\Data\Spot\QQQ Intraday.csv")
-
-    print('end')
+if __name__ == '__main__':
+    start = time.perf_counter()
+    folder = r"X:\Main Folder\Data\Spot"
+    rows = build_intraday_series(os.path.join(folder, "USA100_15min.csv"), os.path.join(folder, "QQQ Daily.csv"), os.path.join(folder, "QQQ Intraday.csv"))
+    print(f"{rows} intraday rows written in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytz
+from functools import lru_cache
+
+from lib.helpers.rate_store import read_rate_series
+
+ny_tz = pytz.timezone('America/New_York')
+
+# Loaders are cached per process so that many backtests in the same worker parse each file once.
+# The returned objects are shared between callers and must be treated as read only.
+
+
+@lru_cache(maxsize=None)
+def load_calendar(file_path):
+    calendar = pd.read_csv(file_path)['Index'].values
+    return pd.to_datetime(calendar, utc=True).tz_convert(ny_tz)
+
+
+@lru_cache(maxsize=None)
+def load_close_series(file_path):
+    close = pd.read_csv(file_path, index_col=0)['Close']
+    close.index = pd.to_datetime(close.index, utc=False)
+    return close
+
+
+@lru_cache(maxsize=None)
+def load_rate_series(file_path):
+    return read_rate_series(file_path)
+
+
+@lru_cache(maxsize=None)
+def load_rf_q_term_structure(file_path):
+    # Observation dates and maturities are stamped at the 16:00 New York close
+    if file_path.endswith('.csv'):
+        term_structure = pd.read_csv(file_path, index_col=0)
+    else:
+        term_structure = pd.read_parquet(file_path)
+    term_structure.index = pd.to_datetime(term_structure.index).normalize().tz_localize(ny_tz) + pd.Timedelta(hours=16)
+    term_structure.index.name = 'Date'
+    term_structure['Maturity'] = pd.to_datetime(term_structure['Maturity']).dt.normalize().dt.tz_localize(ny_tz) + pd.Timedelta(hours=16)
+    return term_structure
+
+
+def clear_market_data_cache():
+    for loader in [load_calendar, load_close_series, load_rate_series, load_rf_q_term_structure]:
+        loader.cache_clear()
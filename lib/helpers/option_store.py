@@ -0,0 +1,169 @@
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.helpers.benchmark_helpers import peak_rss_mb
+from lib.helpers.pricing_helpers import implied_vol_vec
+
+ny_tz = pytz.timezone('America/New_York')
+
+NUMERIC_COLUMNS = ['Strike', 'Bid', 'Ask', 'Spot', 'Volume', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho', 'Type']
+STORE_EXTENSION = '.parquet'
+
+CONTRACT_KEYS = ['Maturity', 'Type', 'Strike']
+QUOTE_COLUMNS = ['Mid', 'Spread', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']
+# Footer key of the quote days of a store file, calendars are built from it without reading rows
+QUOTE_DATES_KEY = b'quote_dates'
+
+
+def get_option_file_name(ticker, date, extension='.csv'):
+    return f"{ticker.lower()}_eod_{date.strftime('%Y%m')}{extension}"
+
+
+def normalize_option_data(data):
+    # Reformat index to close NY
+    data.index = pd.to_datetime(data.index)
+    data.index = data.index.normalize() + pd.Timedelta(hours=16)
+    data.index = data.index.tz_localize(ny_tz)
+    data.index.name = 'Date'
+    # Reformat Maturity to close NY
+    data['Maturity'] = pd.to_datetime(data['Maturity']).dt.normalize().dt.tz_localize(ny_tz) + pd.Timedelta(hours=16)
+    # format the rest
+    data[NUMERIC_COLUMNS] = data[NUMERIC_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    data['Mid'] = (data['Bid'] + data['Ask']) / 2
+    data['Spread'] = data['Ask'] - data['Bid']
+    return data
+
+
+def read_option_csv(file_path):
+    return normalize_option_data(pd.read_csv(file_path, index_col=0))
+
+
+def get_quote_dates_metadata(dates):
+    # Sorted 'YYYY-MM-DD' quote days of New York timestamps
+    days = pd.DatetimeIndex(dates).dropna().tz_localize(None).normalize().unique().sort_values()
+    return {QUOTE_DATES_KEY: json.dumps(list(days.strftime('%Y-%m-%d'))).encode()}
+
+
+def write_option_store(data, file_path):
+    # data is expected normalized, sorted by quote date so that date slices are contiguous
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    data = data.sort_index(kind='stable')
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    table = table.replace_schema_metadata({**table.schema.metadata, **get_quote_dates_metadata(data.index)})
+    pq.write_table(table, file_path)
+
+
+def read_option_store(file_path):
+    return pd.read_parquet(file_path, engine='pyarrow')
+
+
+def read_store_quote_dates(file_path):
+    # Quote days of a store file from its footer, files written before they were recorded only have their Date column read
+    metadata = pq.read_metadata(file_path).metadata or {}
+    if QUOTE_DATES_KEY in metadata:
+        return json.loads(metadata[QUOTE_DATES_KEY])
+    dates = pq.read_table(file_path, columns=['Date']).column('Date').to_pandas()
+    return json.loads(get_quote_dates_metadata(dates)[QUOTE_DATES_KEY])
+
+
+def get_option_month_path(ticker, date, store_folder, csv_folder, use_store=True):
+    # Path of the month file to read, the store file when available
+    store_path = os.path.join(store_folder, get_option_file_name(ticker, date, STORE_EXTENSION))
+    if use_store and os.path.exists(store_path):
+        return store_path
+    return os.path.join(csv_folder, get_option_file_name(ticker, date))
+
+
+def read_option_file(file_path):
+    if file_path.endswith(STORE_EXTENSION):
+        return read_option_store(file_path)
+    return read_option_csv(file_path)
+
+
+def read_option_month(ticker, date, store_folder, csv_folder, use_store=True):
+    """
+    Load one month of normalized option chains, from the columnar store when available.
+
+    Parameters:
+        ticker (str): Underlying ticker, used to build the month file name.
+        date (pd.Timestamp): Any date of the month to load.
+        store_folder (str): Folder holding the `.parquet` month files written by `process_files`.
+        csv_folder (str): Folder holding the pre processed `.csv` month files.
+        use_store (bool): If False, always parse the csv file.
+
+    Returns:
+        tuple: (file path actually read, normalized DataFrame indexed by quote date).
+    """
+    file_path = get_option_month_path(ticker, date, store_folder, csv_folder, use_store=use_store)
+    return file_path, read_option_file(file_path)
+
+
+def build_contract_panel(data):
+    # One row per (date, maturity, type, strike) quote, keeping the first one like a boolean scan + iloc[0] would
+    panel = data.dropna(subset=['Mid']).set_index(CONTRACT_KEYS, append=True)[QUOTE_COLUMNS]
+    panel = panel.loc[~panel.index.duplicated(keep='first')]
+    return panel.sort_index()
+
+
+def gather_contracts(panel, date, maturities, types, strikes):
+    """
+    Look up the quotes of many contracts on one date with a single reindex on the contract panel.
+
+    Parameters:
+        panel (pd.DataFrame): Panel returned by `build_contract_panel`.
+        date (pd.Timestamp): Quote date.
+        maturities, types, strikes (array-like): Contract keys, one entry per contract.
+
+    Returns:
+        tuple: (array of shape (n, len(QUOTE_COLUMNS)) ordered as QUOTE_COLUMNS, boolean array flagging the contracts found).
+    """
+    keys = pd.MultiIndex.from_arrays([[date] * len(strikes), maturities, types, strikes], names=panel.index.names)
+    quotes = panel.reindex(keys).to_numpy()
+    return quotes, ~pd.isna(quotes[:, 0])
+
+
+def compute_implied_vols(data, rate, div, **solver_kwargs):
+    # Implied vols of a whole normalized chain from its Mid, rate and div are scalars or arrays aligned on the rows
+    maturity = (data['Maturity'].values - data.index.values) / pd.Timedelta(days=1)
+    return pd.Series(implied_vol_vec(data['Spot'].values, data['Strike'].values, maturity, rate, div, data['Mid'].values, data['Type'].values, **solver_kwargs), index=data.index, name='Implied Vol')
+
+
+def _timed_load(loader, file_path):
+    start = time.perf_counter()
+    data = loader(file_path)
+    elapsed = time.perf_counter() - start
+    return elapsed, peak_rss_mb(), len(data)
+
+
+def benchmark_option_store(csv_path, store_path, repeat=3):
+    # Each load runs in a fresh process so that peak RSS is not polluted by the other format
+    results = []
+    for name, loader, file_path in [('csv', read_option_csv, csv_path), ('store', read_option_store, store_path)]:
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                elapsed, rss, rows = executor.submit(_timed_load, loader, file_path).result()
+            results.append({'format': name, 'seconds': elapsed, 'peak_rss_mb': rss, 'rows': rows})
+
+    results = pd.DataFrame(results)
+    return results.groupby('format').agg({'seconds': ['min', 'mean'], 'peak_rss_mb': 'max', 'rows': 'first'})
+
+
+if __name__ == '__main__':
+    # Example usage:
+    ticker = 'QQQ'
+    month = pd.Timestamp('2023-01-01')
+    csv_folder = r'X:\Main Folder\Data\Options\QQQ\Pre Processed'
+    store_folder = r'X:\Main Folder\Data\Options\QQQ\Store'
+
+    csv_path = os.path.join(csv_folder, get_option_file_name(ticker, month))
+    store_path = os.path.join(store_folder, get_option_file_name(ticker, month, STORE_EXTENSION))
+    if not os.path.exists(store_path):
+        write_option_store(read_option_csv(csv_path), store_path)
+
+    print(benchmark_option_store(csv_path, store_path))
@@ -1,85 +1,164 @@
+import hashlib
+import json
 import os
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from lib.helpers.option_store import normalize_option_data, write_option_store, STORE_EXTENSION
+
+COLUMNS = ['Date', 'Maturity', 'Strike', 'Spot', 'Bid', 'Ask', 'Volume', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho', 'Type']
+# Raw columns shared by the call and the put of a row
+SHARED_RAW_COLUMNS = {'Date': '[QUOTE_DATE]', 'Maturity': '[EXPIRE_DATE]', 'Strike': '[STRIKE]', 'Spot': '[UNDERLYING_LAST]'}
+DATE_RAW_COLUMNS = ['[QUOTE_DATE]', '[EXPIRE_DATE]']
+# Raw columns of each side, prefixed by C_ for calls and P_ for puts
+SIDE_RAW_COLUMNS = {'Bid': 'BID', 'Ask': 'ASK', 'Volume': 'VOLUME', 'Implied Vol': 'IV', 'Delta': 'DELTA', 'Gamma': 'GAMMA', 'Vega': 'VEGA', 'Theta': 'THETA', 'Rho': 'RHO'}
+SIDES = [('C', 1), ('P', 0)]
+
+# Source signatures of the files already processed, kept in the target folder
+MANIFEST_NAME = 'preprocess_manifest.json'
+
+
+def get_raw_columns():
+    return list(SHARED_RAW_COLUMNS.values()) + [f"[{side}_{column}]" for side, _ in SIDES for column in SIDE_RAW_COLUMNS.values()]
+
+
+def read_raw_file(source, columns=None):
+    # Only the columns used, numbers are parsed while reading, the spaces after the raw delimiters are skipped
+    columns = get_raw_columns() if columns is None else columns
+    numeric = [column for column in columns if column not in DATE_RAW_COLUMNS]
+    try:
+        return pd.read_csv(source, usecols=columns, skipinitialspace=True, dtype=dict.fromkeys(numeric, 'float64'))
+    except ValueError:
+        # Files with non numeric values fall back to a coercing conversion
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        raw = pd.read_csv(source, usecols=columns, skipinitialspace=True, dtype=dict.fromkeys(numeric, 'object'))
+        raw[numeric] = raw[numeric].apply(pd.to_numeric, errors='coerce')
+        return raw
+
+
+def split_sides(raw):
+    # Calls then puts of every raw row, each output column is built once from the raw arrays
+    data = {}
+    for column, raw_column in SHARED_RAW_COLUMNS.items():
+        values = pd.to_datetime(raw[raw_column]).to_numpy() if raw_column in DATE_RAW_COLUMNS else raw[raw_column].to_numpy()
+        data[column] = np.concatenate([values] * len(SIDES))
+    for column, raw_column in SIDE_RAW_COLUMNS.items():
+        data[column] = np.concatenate([raw[f"[{side}_{raw_column}]"].to_numpy() for side, _ in SIDES])
+    data['Type'] = np.repeat([option_type for _, option_type in SIDES], len(raw))
+
+    return pd.DataFrame(data, columns=COLUMNS)
 
 
 def pre_process(file_name):
-    # Read csv data and keep selected columns
-    raw_data = pd.read_csv(file_name)
-
-    call_raw_columns = [' [QUOTE_DATE]', ' [EXPIRE_DATE]', ' [STRIKE]', ' [UNDERLYING_LAST]', ' [C_BID]', ' [C_ASK]', ' [C_VOLUME]', ' [C_IV]', ' [C_DELTA]', ' [C_GAMMA]', ' [C_VEGA]', ' [C_THETA]', ' [C_RHO]']
-    call_data = raw_data.copy()
-    call_data = call_data[call_raw_columns]
-    # Rename columns
-    columns = ['Date', 'Maturity', 'Strike', 'Spot', 'Bid', 'Ask', 'Volume', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']
-    call_data.columns = columns
-    # Casting call_data
-    call_data['Date'] = pd.to_datetime(call_data['Date'])
-    call_data['Maturity'] = pd.to_datetime(call_data['Maturity'])
-    call_data.loc[:, 'Strike'] = pd.to_numeric(call_data['Strike'], errors='coerce')
-    call_data.loc[:, 'Spot'] = pd.to_numeric(call_data['Spot'], errors='coerce')
-    call_data.loc[:, 'Bid'] = pd.to_numeric(call_data['Bid'], errors='coerce')
-    call_data.loc[:, 'Ask'] = pd.to_numeric(call_data['Ask'], errors='coerce')
-    call_data.loc[:, 'Volume'] = pd.to_numeric(call_data['Volume'], errors='coerce')
-    call_data.loc[:, 'Implied Vol'] = pd.to_numeric(call_data['Implied Vol'], errors='coerce')
-    call_data.loc[:, 'Delta'] = pd.to_numeric(call_data['Delta'], errors='coerce')
-    call_data.loc[:, 'Gamma'] = pd.to_numeric(call_data['Gamma'], errors='coerce')
-    call_data.loc[:, 'Vega'] = pd.to_numeric(call_data['Vega'], errors='coerce')
-    call_data.loc[:, 'Theta'] = pd.to_numeric(call_data['Theta'], errors='coerce')
-    call_data.loc[:, 'Rho'] = pd.to_numeric(call_data['Rho'], errors='coerce')
-    call_data['Type'] = [1] * len(call_data)
-
-    call_raw_columns = [' [QUOTE_DATE]', ' [EXPIRE_DATE]', ' [STRIKE]', ' [UNDERLYING_LAST]', ' [P_BID]', ' [P_ASK]', ' [P_VOLUME]', ' [P_IV]', ' [P_DELTA]', ' [P_GAMMA]', ' [P_VEGA]', ' [P_THETA]', ' [P_RHO]']
-    put_data = raw_data.copy()
-    put_data = put_data[call_raw_columns]
-    # Rename columns
-    columns = ['Date', 'Maturity', 'Strike', 'Spot', 'Bid', 'Ask', 'Volume', 'Implied Vol', 'Delta', 'Gamma', 'Vega', 'Theta', 'Rho']
-    put_data.columns = columns
-    # Casting put_data
-    put_data['Date'] = pd.to_datetime(put_data['Date'])
-    put_data['Maturity'] = pd.to_datetime(put_data['Maturity'])
-    put_data.loc[:, 'Strike'] = pd.to_numeric(put_data['Strike'], errors='coerce')
-    put_data.loc[:, 'Spot'] = pd.to_numeric(put_data['Strike'], errors='coerce')
-    put_data.loc[:, 'Bid'] = pd.to_numeric(put_data['Bid'], errors='coerce')
-    put_data.loc[:, 'Ask'] = pd.to_numeric(put_data['Ask'], errors='coerce')
-    put_data.loc[:, 'Volume'] = pd.to_numeric(put_data['Volume'], errors='coerce')
-    put_data.loc[:, 'Implied Vol'] = pd.to_numeric(put_data['Implied Vol'], errors='coerce')
-    put_data.loc[:, 'Delta'] = pd.to_numeric(put_data['Delta'], errors='coerce')
-    put_data.loc[:, 'Gamma'] = pd.to_numeric(put_data['Gamma'], errors='coerce')
-    put_data.loc[:, 'Vega'] = pd.to_numeric(put_data['Vega'], errors='coerce')
-    put_data.loc[:, 'Theta'] = pd.to_numeric(put_data['Theta'], errors='coerce')
-    put_data.loc[:, 'Rho'] = pd.to_numeric(put_data['Rho'], errors='coerce')
-    put_data['Type'] = [0] * len(put_data)
-
-    data = pd.concat([call_data, put_data])
-
-    return data
-
-
-def process_files(folder_path, target_path):
-    # Create the target directory if it doesn't exist
-    if not os.path.exists(target_path):
-        os.makedirs(target_path)
-
-    # List all files in the folder
-    files = [f for f in os.listdir(folder_path) if f.endswith('.csv')]
-
-    # Iterate through each file
+    return split_sides(read_raw_file(file_name))
+
+
+def file_sha1(file_path, block_size=1 << 20):
+    checksum = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def read_manifest(file_path):
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as file:
+        return json.load(file)
+
+
+def write_manifest(manifest, file_path):
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temp_path, file_path)
+
+
+def is_processed(entry, input_file_path, output_file_paths):
+    # Outputs exist and the source has the same mtime and size, or the same content
+    if entry is None or not set(output_file_paths) <= set(entry['outputs']) or not all(os.path.exists(path) for path in output_file_paths):
+        return False
+    stat = os.stat(input_file_path)
+    if (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+        return True
+    if entry['sha1'] == file_sha1(input_file_path):
+        entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+        return True
+    return False
+
+
+def process_file(input_file_path, output_file_path=None, store_file_path=None):
+    # Pre process one raw month file into the csv and store outputs, returns its manifest entry and timings
+    start = time.perf_counter()
+    stat = os.stat(input_file_path)
+    sha1 = file_sha1(input_file_path)
+    data = pre_process(input_file_path)
+    read_seconds = time.perf_counter() - start
+
+    outputs = []
+    if output_file_path is not None:
+        data.to_csv(output_file_path, index=False)
+        outputs.append(output_file_path)
+    if store_file_path is not None:
+        write_option_store(normalize_option_data(data.set_index('Date')), store_file_path)
+        outputs.append(store_file_path)
+
+    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': sha1, 'outputs': outputs, 'rows': len(data)}
+    return entry, {'rows': len(data), 'read_seconds': read_seconds, 'write_seconds': time.perf_counter() - start - read_seconds}
+
+
+def process_files(folder_path, target_path, store_path=None, write_csv=True, max_workers=None, force=False):
+    """
+    Pre process every raw month file of a folder on a process pool, into csv files and/or the columnar store.
+
+    Files whose source is unchanged since the last run, by mtime and size or else by content hash, and whose outputs
+    exist are skipped unless force. Sources are tracked in a manifest in target_path.
+
+    Returns:
+        pd.DataFrame: Status, row count and read / write seconds of every file.
+    """
+    os.makedirs(target_path, exist_ok=True)
+    manifest_path = os.path.join(target_path, MANIFEST_NAME)
+    manifest = read_manifest(manifest_path)
+
+    files = sorted(f for f in os.listdir(folder_path) if f.endswith('.csv'))
+    report = []
+    pending = {}
     for file_name in files:
-        # Construct the file paths
         input_file_path = os.path.join(folder_path, file_name)
-        output_file_path = os.path.join(target_path, file_name)
+        output_file_path = os.path.join(target_path, file_name) if write_csv else None
+        store_file_path = os.path.join(store_path, os.path.splitext(file_name)[0] + STORE_EXTENSION) if store_path is not None else None
+        output_file_paths = [path for path in [output_file_path, store_file_path] if path is not None]
+        if not force and is_processed(manifest.get(file_name), input_file_path, output_file_paths):
+            report.append({'file': file_name, 'status': 'skipped', 'rows': manifest[file_name]['rows']})
+        else:
+            pending[file_name] = (input_file_path, output_file_path, store_file_path)
+
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(process_file, *paths): file_name for file_name, paths in pending.items()}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                entry, timings = future.result()
+                manifest[file_name] = entry
+                write_manifest(manifest, manifest_path)
+                report.append({'file': file_name, 'status': 'processed', **timings})
+                print(f"Processed {file_name}: {timings['rows']} rows, read {timings['read_seconds']:.2f}s, write {timings['write_seconds']:.2f}s")
+    write_manifest(manifest, manifest_path)
 
-        # Apply pre_process function to each file
-        df = pre_process(input_file_path)
+    print(f"{len(pending)} files processed, {len(files) - len(pending)} unchanged")
+    return pd.DataFrame(report, columns=['file', 'status', 'rows', 'read_seconds', 'write_seconds']).set_index('file').sort_index()
 
-        # Save the resulting DataFrame as a CSV file
-        df.to_csv(output_file_path, index=False)
-        print(f"Processed file saved: {output_file_path}")
 
 if __name__ == '__main__':
 
     # Example usage:
     folder_path = r'X:\Main Folder\Data\Options\QQQ\Raw'
     target_path = r'X:\Main Folder\Data\Options\QQQ\Pre Processed'
+    store_path = r'X:\Main Folder\Data\Options\QQQ\Store'
 
-    process_files(folder_path, target_path)
\ No newline at end of file
+    print(process_files(folder_path, target_path, store_path))
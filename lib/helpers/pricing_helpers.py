@@ -1,15 +1,32 @@
-from numba import jit
 import math
+import os
+import time
+import numpy as np
+
+try:
+    from numba import njit, vectorize
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 NUM_DAYS_PER_YEAR = 365
 
+# 'numba' compiles the pricing kernels, 'numpy' keeps plain python / numpy. Set PRICING_BACKEND=numpy to disable numba.
+USE_NUMBA = NUMBA_AVAILABLE and os.environ.get('PRICING_BACKEND', 'numba') == 'numba'
+_array_backend = 'numba' if USE_NUMBA else 'numpy'
+
+
+def compiled(func):
+    # Compile in nopython mode with the machine code cached in __pycache__, so later runs skip the JIT cost
+    return njit(cache=True)(func) if USE_NUMBA else func
 
-# @jit(nopython=True)
+
+@compiled
 def pdf(x):
     return math.exp(-0.5 * x ** 2) / math.sqrt(2 * math.pi)
 
 
-# @jit(nopython=True)
+@compiled
 def cdf(x):
     # Constants
     a1 = 0.254829592
@@ -33,7 +50,7 @@ def cdf(x):
     return 0.5 * (1.0 + sign * y)
 
 
-# @jit(nopython=True)
+@compiled
 def d1_d2(spot, strike, maturity, rate, div, vol):
     maturity = maturity / NUM_DAYS_PER_YEAR
     d1 = (math.log(spot / strike) + (rate - div + 0.5 * vol ** 2) * maturity) / (vol * math.sqrt(maturity))
@@ -41,44 +58,44 @@ def d1_d2(spot, strike, maturity, rate, div, vol):
     return d1, d2
 
 
-# @jit(nopython=True)
+@compiled
 def price_bs(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     typefac = 2.0 * op_type - 1.0
     _price = typefac * spot * math.exp(-div * maturity) * cdf(typefac * d1) - typefac * strike * math.exp(-rate * maturity) * cdf(typefac * d2)
     return _price
 
 
-# @jit(nopython=True)
+@compiled
 def delta(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     typefac = 2.0 * op_type - 1.0
     _delta = typefac * cdf(typefac * d1) * math.exp(-div * maturity)
     return _delta
 
 
-# @jit(nopython=True)
+@compiled
 def gamma(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     _gamma = (pdf(d1) * math.exp(-div * maturity) / spot / math.sqrt(maturity) / vol) * (vol > 1e-10)
     return _gamma
 
 
-# @jit(nopython=True)
+@compiled
 def vega(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     _vega = pdf(d1) * spot * math.exp(-div * maturity) * math.sqrt(maturity)
     return _vega
 
 
-# @jit(nopython=True)
+@compiled
 def theta(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     typefac = 2.0 * op_type - 1.0
     _theta = -math.exp(-div * maturity) * spot * pdf(d1) * vol / (2 * math.sqrt(maturity)) - \
              typefac * rate * strike * math.exp(-rate * maturity) * cdf(typefac * d2) + \
@@ -86,18 +103,45 @@ def theta(spot, strike, maturity, rate, div, vol, op_type):
     return _theta / NUM_DAYS_PER_YEAR
 
 
-# @jit(nopython=True)
+@compiled
 def rho(spot, strike, maturity, rate, div, vol, op_type):
-    maturity = maturity / NUM_DAYS_PER_YEAR
     d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
+    maturity = maturity / NUM_DAYS_PER_YEAR
     typefac = 2.0 * op_type - 1.0
     _rho = typefac * strike * maturity * math.exp(-rate * maturity) * cdf(typefac * d2)
     return _rho
 
 
-# @jit(nopython=True)
-def implied_vol(spot, strike, maturity, rate, div, price, op_type, low_vol=0.0, high_vol=2.0, max_iter=20, max_error=0.01):
+@compiled
+def _greeks(spot, strike, maturity, rate, div, vol, op_type):
+    # Price and greeks of one option from a single d1/d2 evaluation
+    d1, d2 = d1_d2(spot, strike, maturity, rate, div, vol)
     maturity = maturity / NUM_DAYS_PER_YEAR
+    sqrt_t = math.sqrt(maturity)
+    typefac = 2.0 * op_type - 1.0
+    div_discount = math.exp(-div * maturity)
+    rate_discount = math.exp(-rate * maturity)
+    cdf_d1 = cdf(typefac * d1)
+    cdf_d2 = cdf(typefac * d2)
+    pdf_d1 = pdf(d1)
+
+    _price = typefac * spot * div_discount * cdf_d1 - typefac * strike * rate_discount * cdf_d2
+    _delta = typefac * cdf_d1 * div_discount
+    _gamma = (pdf_d1 * div_discount / spot / sqrt_t / vol) * (vol > 1e-10)
+    _vega = pdf_d1 * spot * div_discount * sqrt_t
+    _theta = (-div_discount * spot * pdf_d1 * vol / (2 * sqrt_t) - typefac * rate * strike * rate_discount * cdf_d2 + typefac * div * spot * div_discount * cdf_d1) / NUM_DAYS_PER_YEAR
+    _rho = typefac * strike * maturity * rate_discount * cdf_d2
+    return _price, _delta, _gamma, _vega, _theta, _rho
+
+
+@compiled
+def _greeks_loop(spot, strike, maturity, rate, div, vol, op_type, out):
+    for i in range(spot.shape[0]):
+        out[0, i], out[1, i], out[2, i], out[3, i], out[4, i], out[5, i] = _greeks(spot[i], strike[i], maturity[i], rate[i], div[i], vol[i], op_type[i])
+
+
+@compiled
+def implied_vol(spot, strike, maturity, rate, div, price, op_type, low_vol=0.0, high_vol=2.0, max_iter=20, max_error=0.01):
     n = 1
     mid_vol = (low_vol + high_vol) / 2
     while n < max_iter:
@@ -110,4 +154,307 @@ def implied_vol(spot, strike, maturity, rate, div, price, op_type, low_vol=0.0,
         else:
             low_vol = mid_vol
         n += 1
-    return mid_vol
\ No newline at end of file
+    return mid_vol
+
+
+@compiled
+def _implied_vol_newton(spot, strike, maturity, rate, div, price, op_type, low_vol, high_vol, price_tol, vol_tol, max_iter):
+    # Vega guided Newton steps, falling back to bisection of the [low_vol, high_vol] bracket when a step leaves it
+    t = maturity / NUM_DAYS_PER_YEAR
+    forward_spot = spot * math.exp(-div * t)
+    discounted_strike = strike * math.exp(-rate * t)
+    lower_bound = max((2.0 * op_type - 1.0) * (forward_spot - discounted_strike), 0.0)
+    upper_bound = forward_spot if op_type == 1 else discounted_strike
+    # Within price_tol of a bound the price no longer depends on vol
+    if not (t > 0 and lower_bound + price_tol < price < upper_bound - price_tol):
+        return math.nan
+
+    vol = min(max(math.sqrt(2 * math.pi / t) * price / spot, low_vol), high_vol)
+    for _ in range(int(max_iter)):
+        diff = price_bs(spot, strike, maturity, rate, div, vol, op_type) - price
+        if abs(diff) < price_tol:
+            return vol
+        if diff > 0:
+            high_vol = vol
+        else:
+            low_vol = vol
+        _vega = vega(spot, strike, maturity, rate, div, vol, op_type)
+        new_vol = vol - diff / _vega if _vega > 1e-12 else low_vol
+        if not (low_vol < new_vol < high_vol):
+            new_vol = 0.5 * (low_vol + high_vol)
+        if abs(new_vol - vol) < vol_tol:
+            return new_vol
+        vol = new_vol
+    return math.nan
+
+
+def cdf_vec(x):
+    # Same approximation as cdf, on arrays
+    if _array_backend == 'numba':
+        return _KERNELS['cdf'](x)
+    a1 = 0.254829592
+    a2 = -0.284496736
+    a3 = 1.421413741
+    a4 = -1.453152027
+    a5 = 1.061405429
+    p = 0.3275911
+
+    x = np.asarray(x, dtype=float)
+    sign = np.where(x >= 0, 1.0, -1.0)
+    x = np.abs(x) / 2 ** 0.5
+    t = 1.0 / (1.0 + p * x)
+    y = 1.0 - (((((a5 * t + a4) * t + a3) * t + a2) * t + a1) * t * np.exp(-x * x))
+    return 0.5 * (1.0 + sign * y)
+
+
+def pdf_vec(x):
+    if _array_backend == 'numba':
+        return _KERNELS['pdf'](x)
+    return np.exp(-0.5 * np.asarray(x, dtype=float) ** 2) / math.sqrt(2 * math.pi)
+
+
+def d1_d2_vec(spot, strike, maturity, rate, div, vol):
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    vol = np.asarray(vol, dtype=float)
+    vol_sqrt_t = vol * np.sqrt(maturity)
+    d1 = (np.log(np.asarray(spot, dtype=float) / strike) + (rate - div + 0.5 * vol ** 2) * maturity) / vol_sqrt_t
+    d2 = d1 - vol_sqrt_t
+    return d1, d2
+
+
+def price_bs_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['price_bs'](spot, strike, maturity, rate, div, vol, op_type)
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    typefac = 2.0 * np.asarray(op_type, dtype=float) - 1.0
+    return typefac * spot * np.exp(-div * maturity) * cdf_vec(typefac * d1) - typefac * strike * np.exp(-rate * maturity) * cdf_vec(typefac * d2)
+
+
+def delta_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['delta'](spot, strike, maturity, rate, div, vol, op_type)
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    typefac = 2.0 * np.asarray(op_type, dtype=float) - 1.0
+    return typefac * cdf_vec(typefac * d1) * np.exp(-div * maturity)
+
+
+def gamma_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['gamma'](spot, strike, maturity, rate, div, vol, op_type)
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    vol = np.asarray(vol, dtype=float)
+    return (pdf_vec(d1) * np.exp(-div * maturity) / spot / np.sqrt(maturity) / vol) * (vol > 1e-10)
+
+
+def vega_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['vega'](spot, strike, maturity, rate, div, vol, op_type)
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    return pdf_vec(d1) * spot * np.exp(-div * maturity) * np.sqrt(maturity)
+
+
+def theta_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['theta'](spot, strike, maturity, rate, div, vol, op_type)
+    return greeks(spot, strike, maturity, rate, div, vol, op_type)[4]
+
+
+def rho_vec(spot, strike, maturity, rate, div, vol, op_type):
+    if _array_backend == 'numba':
+        return _KERNELS['rho'](spot, strike, maturity, rate, div, vol, op_type)
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    typefac = 2.0 * np.asarray(op_type, dtype=float) - 1.0
+    return typefac * strike * maturity * np.exp(-rate * maturity) * cdf_vec(typefac * d2)
+
+
+def implied_vol_vec(spot, strike, maturity, rate, div, price, op_type, low_vol=1e-4, high_vol=5.0, price_tol=1e-8, vol_tol=1e-8, max_iter=50):
+    """
+    Batch implied volatility of whole chains, inputs are broadcast NumPy arrays or scalars with maturity in days.
+
+    Each element takes vega guided Newton steps inside a [low_vol, high_vol] bracket tightened at every iteration,
+    and bisects the bracket when a step leaves it. Elements stop iterating once their price error is below price_tol
+    or their vol step below vol_tol.
+
+    Returns:
+        np.ndarray: Implied vols, NaN for prices outside no arbitrage bounds or within price_tol of them, or not
+        converged after max_iter.
+    """
+    if _array_backend == 'numba':
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            return _KERNELS['implied_vol'](spot, strike, maturity, rate, div, price, op_type, low_vol, high_vol, price_tol, vol_tol, max_iter)
+
+    spot, strike, maturity, rate, div, price, op_type = (np.array(x, dtype=float) for x in np.broadcast_arrays(spot, strike, maturity, rate, div, price, op_type))
+    t = maturity / NUM_DAYS_PER_YEAR
+    forward_spot = spot * np.exp(-div * t)
+    discounted_strike = strike * np.exp(-rate * t)
+    lower_bound = np.maximum((2.0 * op_type - 1.0) * (forward_spot - discounted_strike), 0.0)
+    upper_bound = np.where(op_type == 1, forward_spot, discounted_strike)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vol = np.clip(np.sqrt(2 * math.pi / t) * price / spot, low_vol, high_vol)
+    low = np.full(vol.shape, low_vol, dtype=float)
+    high = np.full(vol.shape, high_vol, dtype=float)
+    result = np.full(vol.shape, np.nan)
+    active = (t > 0) & (lower_bound + price_tol < price) & (price < upper_bound - price_tol)
+
+    for _ in range(int(max_iter)):
+        ix = np.flatnonzero(active)
+        if len(ix) == 0:
+            break
+        args = (spot.flat[ix], strike.flat[ix], maturity.flat[ix], rate.flat[ix], div.flat[ix])
+        current_vol = vol.flat[ix]
+        diff = price_bs_vec(*args, current_vol, op_type.flat[ix]) - price.flat[ix]
+
+        # Tighten the bracket and take a Newton step, or bisect when the step leaves the bracket
+        low.flat[ix] = np.where(diff < 0, current_vol, low.flat[ix])
+        high.flat[ix] = np.where(diff > 0, current_vol, high.flat[ix])
+        _vega = vega_vec(*args, current_vol, op_type.flat[ix])
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            new_vol = np.where(_vega > 1e-12, current_vol - diff / _vega, low.flat[ix])
+        in_bracket = (low.flat[ix] < new_vol) & (new_vol < high.flat[ix])
+        new_vol = np.where(in_bracket, new_vol, 0.5 * (low.flat[ix] + high.flat[ix]))
+
+        price_converged = np.abs(diff) < price_tol
+        vol_converged = ~price_converged & (np.abs(new_vol - current_vol) < vol_tol)
+        result.flat[ix[price_converged]] = current_vol[price_converged]
+        result.flat[ix[vol_converged]] = new_vol[vol_converged]
+        active.flat[ix[price_converged | vol_converged]] = False
+        vol.flat[ix] = new_vol
+
+    return result
+
+
+def greeks(spot, strike, maturity, rate, div, vol, op_type):
+    """
+    Black-Scholes price and greeks from a single d1/d2 evaluation, inputs are broadcast NumPy arrays or scalars.
+
+    Conventions are the ones of the scalar functions: maturity in days, theta per day, op_type 1 for calls and 0 for puts.
+
+    Returns:
+        tuple: (price, delta, gamma, vega, theta, rho) arrays.
+    """
+    if _array_backend == 'numba':
+        arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (spot, strike, maturity, rate, div, vol, op_type)))
+        out = np.empty((6,) + arrays[0].shape)
+        _greeks_loop(*(np.array(x).ravel() for x in arrays), out.reshape(6, -1))
+        return tuple(out)
+
+    spot, strike, rate, div, vol = (np.asarray(x, dtype=float) for x in (spot, strike, rate, div, vol))
+    d1, d2 = d1_d2_vec(spot, strike, maturity, rate, div, vol)
+    maturity = np.asarray(maturity, dtype=float) / NUM_DAYS_PER_YEAR
+    sqrt_t = np.sqrt(maturity)
+    typefac = 2.0 * np.asarray(op_type, dtype=float) - 1.0
+
+    div_discount = np.exp(-div * maturity)
+    rate_discount = np.exp(-rate * maturity)
+    cdf_d1 = cdf_vec(typefac * d1)
+    cdf_d2 = cdf_vec(typefac * d2)
+    pdf_d1 = pdf_vec(d1)
+
+    _price = typefac * spot * div_discount * cdf_d1 - typefac * strike * rate_discount * cdf_d2
+    _delta = typefac * cdf_d1 * div_discount
+    _gamma = (pdf_d1 * div_discount / spot / sqrt_t / vol) * (vol > 1e-10)
+    _vega = pdf_d1 * spot * div_discount * sqrt_t
+    _theta = (-div_discount * spot * pdf_d1 * vol / (2 * sqrt_t) - typefac * rate * strike * rate_discount * cdf_d2 + typefac * div * spot * div_discount * cdf_d1) / NUM_DAYS_PER_YEAR
+    _rho = typefac * strike * maturity * rate_discount * cdf_d2
+    return _price, _delta, _gamma, _vega, _theta, _rho
+
+
+def _build_kernels():
+    # numba ufuncs built from the scalar functions, they broadcast like the numpy versions
+    signature = ['float64(float64, float64, float64, float64, float64, float64, float64)']
+    kernels = {'cdf': vectorize(['float64(float64)'], cache=True)(cdf.py_func),
+               'pdf': vectorize(['float64(float64)'], cache=True)(pdf.py_func)}
+    for func in [price_bs, delta, gamma, vega, theta, rho]:
+        kernels[func.__name__] = vectorize(signature, cache=True)(func.py_func)
+    kernels['implied_vol'] = vectorize(['float64(' + ', '.join(['float64'] * 12) + ')'], cache=True)(_implied_vol_newton.py_func)
+    return kernels
+
+
+_KERNELS = _build_kernels() if USE_NUMBA else {}
+
+
+def set_pricing_backend(backend):
+    # Switch the array functions between the compiled kernels and numpy, e.g. to compare both
+    global _array_backend
+    if backend not in ('numba', 'numpy'):
+        raise ValueError(f"Unknown pricing backend {backend}")
+    if backend == 'numba' and not USE_NUMBA:
+        raise RuntimeError("numba pricing backend is not available, install numba and unset PRICING_BACKEND=numpy")
+    _array_backend = backend
+
+
+def check_backend_parity(n=10000, rtol=1e-10, atol=1e-12, iv_tol=1e-6):
+    # Compare the compiled kernels to the numpy fallback on random options, raises on any mismatch.
+    # Implied vols get iv_tol since Newton iterations amplify last digit differences between the two backends
+    rng = np.random.default_rng(0)
+    args = (rng.uniform(50, 150, n), rng.uniform(50, 150, n), rng.uniform(0.01, 730, n), rng.uniform(-0.01, 0.08, n),
+            rng.uniform(0, 0.04, n), rng.uniform(0.01, 1.5, n), rng.integers(0, 2, n))
+    functions = [cdf_vec, pdf_vec, price_bs_vec, delta_vec, gamma_vec, vega_vec, theta_vec, rho_vec]
+
+    previous_backend = _array_backend
+    try:
+        values = {}
+        for backend in ['numba', 'numpy']:
+            set_pricing_backend(backend)
+            values[backend] = [func(args[0] / 50 - 2) if func in (cdf_vec, pdf_vec) else func(*args) for func in functions]
+            values[backend].extend(greeks(*args))
+            values[backend].append(implied_vol_vec(*args[:5], price_bs_vec(*args), args[6]))
+    finally:
+        set_pricing_backend(previous_backend)
+
+    names = [func.__name__ for func in functions] + ['greeks_price', 'greeks_delta', 'greeks_gamma', 'greeks_vega', 'greeks_theta', 'greeks_rho', 'implied_vol_vec']
+    for name, compiled_values, numpy_values in zip(names, values['numba'], values['numpy']):
+        tolerance = {'rtol': iv_tol, 'atol': iv_tol} if name == 'implied_vol_vec' else {'rtol': rtol, 'atol': atol}
+        np.testing.assert_allclose(compiled_values, numpy_values, err_msg=name, equal_nan=True, **tolerance)
+
+    # Scalar compiled functions against their python source
+    for func in [price_bs, delta, gamma, vega, theta, rho]:
+        for i in range(100):
+            scalar_args = tuple(float(x[i]) for x in args)
+            np.testing.assert_allclose(func(*scalar_args), func.py_func(*scalar_args), rtol=rtol, atol=atol, err_msg=func.__name__)
+
+
+def benchmark_greeks(n=10000, repeat=3):
+    # Compare the scalar functions, called once per greek and per option, to the fused array call on each backend
+    rng = np.random.default_rng(0)
+    spot = 100.0
+    strike = rng.uniform(80, 120, n)
+    maturity = rng.uniform(1, 60, n)
+    vol = rng.uniform(0.1, 0.5, n)
+    op_type = rng.integers(0, 2, n)
+    rate, div = 0.04, 0.015
+
+    backends = ['numba', 'numpy'] if USE_NUMBA else ['numpy']
+    timings = {name: [] for name in ['scalar'] + backends}
+    previous_backend = _array_backend
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(n):
+            args = (spot, strike[i], maturity[i], rate, div, vol[i], op_type[i])
+            price_bs(*args), delta(*args), gamma(*args), vega(*args), theta(*args), rho(*args)
+        timings['scalar'].append(time.perf_counter() - start)
+
+        for backend in backends:
+            set_pricing_backend(backend)
+            start = time.perf_counter()
+            greeks(spot, strike, maturity, rate, div, vol, op_type)
+            timings[backend].append(time.perf_counter() - start)
+    set_pricing_backend(previous_backend)
+
+    return {name: min(values) for name, values in timings.items()}
+
+
+if __name__ == '__main__':
+    if USE_NUMBA:
+        check_backend_parity()
+        print('numba and numpy backends agree')
+
+    for n in [100, 10000]:
+        timings = benchmark_greeks(n)
+        print(f"{n} options: " + ', '.join(f"{name} {seconds:.4f}s" for name, seconds in timings.items()))
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import pandas as pd
+import pytz
+
+ny_tz = pytz.timezone('America/New_York')
+
+STORE_EXTENSION = '.parquet'
+# rf_q in the term structure files is expressed per business day
+BUSINESS_DAYS_PER_YEAR = 252
+
+
+def get_close_store_path(folder, ticker):
+    return os.path.join(folder, f"{ticker} Close{STORE_EXTENSION}")
+
+
+def get_dividend_store_path(folder, ticker):
+    return os.path.join(folder, f"{ticker} Dividends{STORE_EXTENSION}")
+
+
+def to_close_time(index):
+    # Daily observations are stamped at the 16:00 New York close
+    return index.tz_convert(ny_tz).normalize() + pd.Timedelta(hours=16)
+
+
+def read_rate_series(file_path):
+    return pd.read_parquet(file_path).iloc[:, 0]
+
+
+def write_rate_series(series, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    series.astype(float).rename_axis('Date').to_frame().to_parquet(file_path)
+
+
+def merge_rate_series(stored, fetched):
+    # Fetched values replace stored ones on the same dates
+    if stored is None:
+        return fetched.sort_index()
+    merged = pd.concat([stored, fetched])
+    return merged[~merged.index.duplicated(keep='last')].sort_index()
+
+
+def refresh_close_store(ticker, folder, start_date='2000-01-01', overlap_days=7):
+    """
+    Download the daily closes of a ticker from Yahoo Finance and append them to its local store.
+
+    Only the dates after the last stored close (minus a few overlapping days, which are replaced) are downloaded.
+
+    Returns:
+        pd.Series: The stored closes.
+    """
+    file_path = get_close_store_path(folder, ticker)
+    stored = read_rate_series(file_path) if os.path.exists(file_path) else None
+    if stored is not None and len(stored) > 0:
+        start_date = (stored.index[-1] - pd.Timedelta(days=overlap_days)).strftime('%Y-%m-%d')
+
+    # Only downloads need yfinance, reading the store does not
+    import yfinance as yf
+
+    close = yf.Ticker(ticker).history(start=start_date, interval='1d')['Close']
+    close.index = to_close_time(close.index)
+    close = merge_rate_series(stored, close.rename('Close'))
+    write_rate_series(close, file_path)
+    return close
+
+
+def refresh_dividend_store(ticker, folder):
+    # Yahoo Finance only serves the full dividend history, it is merged into the store
+    file_path = get_dividend_store_path(folder, ticker)
+    stored = read_rate_series(file_path) if os.path.exists(file_path) else None
+
+    import yfinance as yf
+
+    dividends = yf.Ticker(ticker).dividends
+    dividends.index = to_close_time(dividends.index)
+    dividends = merge_rate_series(stored, dividends.rename('Dividends'))
+    write_rate_series(dividends, file_path)
+    return dividends
+
+
+def refresh_rate_store(folder, rf_tickers=(), dividend_tickers=()):
+    for ticker in rf_tickers:
+        close = refresh_close_store(ticker, folder)
+        print(f"{ticker} closes stored up to {close.index[-1]}")
+    for ticker in dividend_tickers:
+        dividends = refresh_dividend_store(ticker, folder)
+        print(f"{ticker} dividends stored up to {dividends.index[-1] if len(dividends) > 0 else None}")
+
+
+def trailing_dividend_yield(dividends, spot, window_days=365):
+    """
+    Dividends paid over the trailing window divided by spot, on the index of spot.
+
+    Parameters:
+        dividends (pd.Series): Dividend amounts indexed by ex-date.
+        spot (pd.Series): Spot prices.
+        window_days (int): Length of the trailing window, the window is (t - window, t].
+
+    Returns:
+        pd.Series: Dividend yield.
+    """
+    dividends = dividends.sort_index()
+    paid = np.concatenate([[0], np.cumsum(dividends.values)])
+    ex_dates = dividends.index.asi8
+    dates = spot.index.asi8
+    window = pd.Timedelta(days=window_days).value
+    trailing = paid[np.searchsorted(ex_dates, dates, side='right')] - paid[np.searchsorted(ex_dates, dates - window, side='right')]
+    return pd.Series(trailing / spot.values, index=spot.index, name='Dividends')
+
+
+def get_rf_q_carry(term_structure, calendar, tenor_days=30):
+    """
+    Annualized rf - q implied from put call parity, taken at the maturity closest to a target tenor.
+
+    Parameters:
+        term_structure (pd.DataFrame): Output of the rf-q term structure builder, indexed by observation date with
+            'Maturity' and 'rf_q' columns.
+        calendar (pd.DatetimeIndex): Dates on which the carry is needed, values are forward filled.
+        tenor_days (int): Target tenor in calendar days.
+
+    Returns:
+        pd.Series: rf - q on the calendar.
+    """
+    curve = term_structure[['Maturity', 'rf_q']].dropna()
+    distance = ((curve['Maturity'] - curve.index).dt.days - tenor_days).abs()
+    curve = curve.assign(distance=distance.values).reset_index().sort_values(['Date', 'distance']).drop_duplicates('Date').set_index('Date')
+    carry = curve['rf_q'] * BUSINESS_DAYS_PER_YEAR
+    return carry.sort_index().reindex(calendar, method='ffill')
+
@@ -0,0 +1,341 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Timestamps are written as New York wall clock times in Excel
+EXCEL_DATE_FORMAT = '%Y-%m-%d %H:%M'
+RESULT_EXTENSIONS = {'parquet': '.parquet', 'csv': '.csv', 'arrow': '.arrow', 'excel': '.xlsx'}
+
+
+def format_timestamps(frame, date_format=EXCEL_DATE_FORMAT):
+    # Index and datetime columns formatted a whole column at a time
+    frame = frame.copy(deep=False)
+    if isinstance(frame.index, pd.DatetimeIndex):
+        frame.index = frame.index.strftime(date_format)
+    for column in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[column]):
+            frame[column] = frame[column].dt.strftime(date_format)
+    return frame
+
+
+class CsvResultWriter():
+    """
+    Appends chunks of result rows to a csv file, the header is written with the first chunk unless appending.
+
+    When appending, rows are added to a copy of the existing file that replaces it on close, the file is left as it was
+    if the run is aborted.
+    """
+
+    def __init__(self, file_path, append=False):
+        self.file_path = file_path
+        self.append = append and os.path.exists(file_path)
+        self.output_path = f"{file_path}.tmp" if self.append else file_path
+        self.rows = 0
+
+    def write(self, frame):
+        if self.rows == 0:
+            if self.append:
+                shutil.copyfile(self.file_path, self.output_path)
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+        first = self.rows == 0 and not self.append
+        frame.to_csv(self.output_path, mode='w' if first else 'a', header=first)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.append and self.rows > 0:
+            os.replace(self.output_path, self.file_path)
+
+    def abort(self):
+        if self.append and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+class ParquetResultWriter():
+    """
+    Writes every chunk of result rows as a row group of one parquet file.
+
+    Parquet files cannot be appended to: when appending, the row groups of the existing file are copied one at a time
+    to a new file that replaces it on close.
+    """
+
+    def __init__(self, file_path, append=False):
+        self.file_path = file_path
+        self.append = append and os.path.exists(file_path)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, frame):
+        table = pa.Table.from_pandas(frame)
+        if self.writer is None:
+            if self.append:
+                existing = pq.ParquetFile(self.file_path)
+                self.writer = pq.ParquetWriter(f"{self.file_path}.tmp", existing.schema_arrow)
+                for ix in range(existing.num_row_groups):
+                    self.writer.write_table(existing.read_row_group(ix))
+                existing.close()
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+                self.writer = pq.ParquetWriter(self.file_path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.append:
+                os.replace(f"{self.file_path}.tmp", self.file_path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.append:
+                os.remove(f"{self.file_path}.tmp")
+
+
+class ArrowResultWriter():
+    # Writes every chunk of result rows as a record batch of one Arrow IPC file, appends like ParquetResultWriter
+    def __init__(self, file_path, append=False):
+        self.file_path = file_path
+        self.append = append and os.path.exists(file_path)
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def write(self, frame):
+        table = pa.Table.from_pandas(frame)
+        if self.writer is None:
+            if self.append:
+                with pa.memory_map(self.file_path) as source:
+                    existing = pa.ipc.open_file(source)
+                    self.schema = existing.schema
+                    self.writer = pa.ipc.new_file(f"{self.file_path}.tmp", self.schema)
+                    for ix in range(existing.num_record_batches):
+                        self.writer.write_batch(existing.get_batch(ix))
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+                self.schema = table.schema
+                self.writer = pa.ipc.new_file(self.file_path, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.append:
+                os.replace(f"{self.file_path}.tmp", self.file_path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.append:
+                os.remove(f"{self.file_path}.tmp")
+
+
+class ExcelResultWriter():
+    """
+    Streams chunks of result rows to the sheets of a write-only openpyxl workbook, saved on close.
+
+    Rows are written as they come instead of being held by the workbook, timestamps are formatted as EXCEL_DATE_FORMAT
+    strings. Workbooks cannot be appended to.
+    """
+
+    def __init__(self, file_path, sheet_name='results', date_format=EXCEL_DATE_FORMAT):
+        from openpyxl import Workbook
+
+        self.file_path = file_path
+        self.sheet_name = sheet_name
+        self.date_format = date_format
+        self.workbook = Workbook(write_only=True)
+        self.sheets = {}
+        self.rows = 0
+
+    def write(self, frame, sheet_name=None):
+        sheet_name = self.sheet_name if sheet_name is None else sheet_name
+        frame = format_timestamps(frame, self.date_format).reset_index()
+        if sheet_name not in self.sheets:
+            self.sheets[sheet_name] = self.workbook.create_sheet(sheet_name)
+            self.sheets[sheet_name].append([str(column) for column in frame.columns])
+        sheet = self.sheets[sheet_name]
+        # Missing values are left as empty cells
+        for row in frame.astype(object).where(frame.notna(), None).values.tolist():
+            sheet.append(row)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.workbook is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+            self.workbook.save(self.file_path)
+            self.workbook = None
+
+    def abort(self):
+        self.workbook = None
+
+
+class CallbackResultWriter():
+    # Hands every chunk of result rows to a function
+    def __init__(self, callback):
+        self.callback = callback
+        self.rows = 0
+
+    def write(self, frame):
+        self.callback(frame)
+        self.rows += len(frame)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+def get_result_writer(sink, append=False):
+    """
+    Result writer of a sink: a writer (with write, close and abort), a function called with every chunk of rows, or a
+    file path whose extension (.parquet, .csv, .arrow or .xlsx) selects the format. Rows are added to an existing file
+    if append.
+    """
+    if hasattr(sink, 'write') and hasattr(sink, 'close'):
+        return sink
+    if callable(sink):
+        return CallbackResultWriter(sink)
+    extension = os.path.splitext(sink)[1].lower()
+    if extension == '.parquet':
+        return ParquetResultWriter(sink, append)
+    if extension == '.csv':
+        return CsvResultWriter(sink, append)
+    if extension == '.arrow':
+        return ArrowResultWriter(sink, append)
+    if extension == '.xlsx':
+        if append and os.path.exists(sink):
+            raise ValueError(f"Rows cannot be appended to {sink}, use a parquet, csv or arrow file")
+        return ExcelResultWriter(sink)
+    raise ValueError(f"Unknown result file format {extension}, use .parquet, .csv, .arrow or .xlsx")
+
+
+def write_result_tables(tables, folder, name, formats=('parquet',)):
+    """
+    Write named tables in each format: one file per table named '{name} {table}' for parquet, csv and arrow, one
+    workbook with a sheet per table for excel.
+
+    Returns:
+        list: Paths of the files written.
+    """
+    file_paths = []
+    for output_format in formats:
+        if output_format not in RESULT_EXTENSIONS:
+            raise ValueError(f"Unknown output format {output_format}, use one of {list(RESULT_EXTENSIONS)}")
+        if output_format == 'excel':
+            file_path = os.path.join(folder, f"{name}{RESULT_EXTENSIONS[output_format]}")
+            writer = ExcelResultWriter(file_path)
+            for table_name, frame in tables.items():
+                writer.write(frame, sheet_name=table_name)
+            writer.close()
+            file_paths.append(file_path)
+        else:
+            for table_name, frame in tables.items():
+                file_path = os.path.join(folder, f"{name} {table_name}{RESULT_EXTENSIONS[output_format]}")
+                writer = get_result_writer(file_path)
+                writer.write(frame)
+                writer.close()
+                file_paths.append(file_path)
+    return file_paths
+
+
+class RowBuffer():
+    """
+    Collects result rows one timestamp at a time and sends them to a writer in chunks of `chunk_rows`, so that only
+    one chunk is ever held in memory.
+    """
+
+    def __init__(self, writer, chunk_rows=1000, index_name='date'):
+        self.writer = writer
+        self.chunk_rows = chunk_rows
+        self.index_name = index_name
+        self.index = []
+        self.rows = []
+
+    def append(self, date, row):
+        self.index.append(date)
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        frame = pd.DataFrame(self.rows, index=pd.DatetimeIndex(self.index, name=self.index_name))
+        self.writer.write(frame)
+        self.index, self.rows = [], []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def abort(self):
+        # Rows of a failed run are not added to an existing file
+        self.writer.abort()
+
+
+def benchmark_export(tables, folder, formats=('parquet', 'csv', 'arrow', 'excel')):
+    # Seconds taken to write the tables in each format
+    timings = {}
+    for output_format in formats:
+        start = time.perf_counter()
+        write_result_tables(tables, folder, 'benchmark', [output_format])
+        timings[output_format] = time.perf_counter() - start
+        print(f"{output_format}: {timings[output_format]:.2f}s")
+    return timings
+
+
+def get_benchmark_tables(days=500, observations_per_day=14, positions_per_timestamp=6, columns=25):
+    # Result and position tables the size of an intraday backtest
+    calendar = pd.date_range('2022-01-03 09:30', periods=days * observations_per_day, freq='30min', tz='America/New_York', name='date')
+    rng = np.random.default_rng(0)
+    results = pd.DataFrame(rng.normal(size=(len(calendar), columns)), index=calendar, columns=[f"column_{ix}" for ix in range(columns)])
+    dates = calendar.repeat(positions_per_timestamp)
+    positions = pd.DataFrame({'position': np.arange(len(dates)) // (positions_per_timestamp * 3),
+                              'Strike': rng.uniform(80, 120, len(dates)).round(),
+                              'Type': rng.integers(0, 2, len(dates)),
+                              'Maturity': dates.normalize() + pd.Timedelta(days=7, hours=16),
+                              'Unwind': dates.normalize() + pd.Timedelta(days=1, hours=16),
+                              'Quantity': rng.normal(size=len(dates)),
+                              'Mid': rng.uniform(0, 5, len(dates))}, index=dates)
+    return {'results': results, 'positions': positions}
+
+
+def legacy_excel_export(tables, file_path):
+    # Previous export: element-wise string conversion of every cell, then pandas' openpyxl writer
+    def force_str(x):
+        try:
+            x = x.replace(tzinfo=None)
+            return x.strftime('%Y-%m-%d %H:%M')
+        except:
+            return x
+
+    with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
+        for table_name, frame in tables.items():
+            frame = frame.map(force_str)
+            frame.index = frame.index.map(force_str)
+            frame.to_excel(writer, sheet_name=table_name, index=True)
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tables = get_benchmark_tables(days=days)
+    print(f"{len(tables['results'])} result rows, {len(tables['positions'])} position rows")
+    with tempfile.TemporaryDirectory() as folder:
+        benchmark_export(tables, folder)
+        start = time.perf_counter()
+        legacy_excel_export(tables, os.path.join(folder, 'legacy.xlsx'))
+        print(f"legacy excel: {time.perf_counter() - start:.2f}s")
@@ -1,32 +1,60 @@
 from dateutil import rrule
+import time
+import numpy as np
+import pandas as pd
 import pytz
 ny_tz = pytz.timezone('America/New_York')
 
+def get_rule_dates(rules, start_date, end_date):
+    # Dates generated by the rule between start_date and end_date, as naive midnights
+    recurrence_rule = rrule.rrule(
+        freq=rules['freq'],
+        byweekday=rules.get('byday', None),
+        bymonth=rules.get('bymonth', None),
+        bysetpos=rules.get('bysetpos', None),
+        dtstart=pd.Timestamp(start_date).to_pydatetime(),
+        until=pd.Timestamp(end_date).to_pydatetime()
+    )
+    return pd.DatetimeIndex(list(recurrence_rule))
+
+
+def get_local_times(calendar):
+    # New York wall clock times of tz-aware timestamps, offsets may differ across the calendar
+    return pd.to_datetime(pd.Index(calendar), utc=True).tz_convert(ny_tz).tz_localize(None)
+
+
+def get_roll_mask(rules, calendar, close_time='16:00'):
+    """
+    Boolean mask of the calendar timestamps that are roll dates: the close_time observation of every date generated
+    by the rule.
+    """
+    if len(calendar) == 0:
+        return np.zeros(0, dtype=bool)
+    timestamps = pd.to_datetime(pd.Index(calendar), utc=True)
+    local_times = timestamps.tz_convert(ny_tz).tz_localize(None)
+    days = local_times.normalize()
+    # Rule dates up to the last calendar day, the roll dates of a day do not depend on the end of the calendar
+    rule_dates = get_rule_dates(rules, days.min(), days.max())
+    hour, minute = (int(x) for x in close_time.split(':'))
+    return np.asarray(days.isin(rule_dates) & (local_times.hour == hour) & (local_times.minute == minute))
+
+
 def get_roll_dates(rules, calendar, close_time='16:00'):
-    # Extract rule parameters
-    freq = rules['freq']
-    byday = rules.get('byday', None)
-    bymonth = rules.get('bymonth', None)
-    bysetpos = rules.get('bysetpos', None)
+    mask = get_roll_mask(rules, calendar, close_time)
+    return [dt for dt, is_roll in zip(calendar, mask) if is_roll]
 
-    # Define the start and end date for the calendar
-    start_date = min(calendar)
-    end_date = max(calendar)
 
-    # Generate the recurring rule based on the provided parameters
-    recurrence_rule = rrule.rrule(
-        freq=freq,
-        byweekday=byday,
-        bymonth=bymonth,
-        bysetpos=bysetpos,
-        dtstart=start_date,
-        until=end_date
-    )
-    recurrence_rule = [dt.astimezone(ny_tz).replace(hour=int(close_time.split(":")[0]), minute=int(close_time.split(":")[1])) for dt in recurrence_rule]
-    # Filter the calendar based on the recurrence rule
-    filtered_dates = [dt for dt in calendar if dt in recurrence_rule]
+def build_observation_calendar(dates, observation_times):
+    """
+    Intraday observation grid: every observation time ('HH:MM', New York) on every date of `dates`.
 
-    return filtered_dates
+    Returns:
+        pd.DatetimeIndex: Sorted unique timestamps localized to New York.
+    """
+    days = get_local_times(dates).normalize().unique()
+    offsets = pd.to_timedelta([f"{observation_time}:00" for observation_time in observation_times])
+    grid = (days.values[:, None] + offsets.values[None, :]).ravel()
+    return pd.DatetimeIndex(np.unique(grid)).tz_localize(ny_tz)
 
 
 def get_eligible_maturity(rules, start_date, count):
@@ -47,6 +75,33 @@ def get_eligible_maturity(rules, start_date, count):
     )
     return recurrence_rule[count]
 
+def get_eligible_maturities(rules, dates, count):
+    """
+    Vectorized get_eligible_maturity: the count-th date generated by the rule on or after each of `dates`, 0 being the
+    date itself when the rule generates it. Rules without byday depend on their start date and are generated per date.
+
+    Returns:
+        pd.DatetimeIndex: Naive dates.
+    """
+    days = get_local_times(dates).normalize()
+    if len(days) == 0:
+        return pd.DatetimeIndex([])
+    if rules.get('byday', None) is None:
+        # Without byday the dates of the rule follow from its dtstart, it is generated from each date like get_eligible_maturity
+        unique_days = days.unique()
+        maturities = pd.DatetimeIndex([get_eligible_maturity(rules, day.to_pydatetime(), count) for day in unique_days])
+        return maturities[unique_days.get_indexer(days)]
+    # Generate the rule far enough after the last date for every lookup to land in it
+    horizon = pd.Timedelta(days=31 * (count + 1))
+    while True:
+        rule_dates = get_rule_dates(rules, days.min(), days.max() + horizon)
+        position = np.searchsorted(rule_dates.values, days.values, side='left') + count
+        if len(rule_dates) > 0 and position.max() < len(rule_dates):
+            return rule_dates[position]
+        if horizon > pd.Timedelta(days=366 * 100):
+            raise ValueError(f"Rule {rules} does not generate {count + 1} dates after {days.max()}")
+        horizon = horizon * 2
+
 # Define rules
 weekdays_rule = {
     'freq': rrule.DAILY,
@@ -75,4 +130,36 @@ third_fridays_quarterly_rule = {
     'bymonth': [3, 6, 9, 12],  # June and December
     'byday': rrule.FR,
     'bysetpos': 3
-}
\ No newline at end of file
+}
+
+
+def benchmark_calendar(years=20, observations_per_day=10, rules=weekdays_rule):
+    # Observation grid and roll mask against the list based construction they replace, checking both agree.
+    # The reference tests membership against a set, the original list scan is too slow at this size.
+    dates = pd.bdate_range('2000-01-03', periods=252 * years, tz=ny_tz) + pd.Timedelta(hours=16)
+    observation_times = [f"{t.components.hours:02d}:{t.components.minutes:02d}" for t in pd.timedelta_range('10:00:00', '16:00:00', periods=observations_per_day)] if observations_per_day > 1 else ['16:00']
+
+    start = time.perf_counter()
+    calendar = build_observation_calendar(dates, observation_times)
+    mask = get_roll_mask(rules, calendar)
+    vectorized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = [[date.replace(hour=int(t.split(':')[0]), minute=int(t.split(':')[1])) for t in observation_times] for date in dates]
+    reference = pd.DatetimeIndex(sorted(set([item for sublist in reference for item in sublist])), tz=str(ny_tz))
+    # Rule generated on naive local days up to the last calendar day, as get_roll_mask does
+    first_day, last_day = (dt.tz_localize(None).normalize().to_pydatetime() for dt in (min(reference), max(reference)))
+    recurrence_rule = rrule.rrule(freq=rules['freq'], byweekday=rules.get('byday', None), bymonth=rules.get('bymonth', None), bysetpos=rules.get('bysetpos', None),
+                                  dtstart=first_day, until=last_day)
+    recurrence_rule = set(ny_tz.localize(dt.replace(hour=16, minute=0)) for dt in recurrence_rule)
+    reference_rolls = [dt for dt in reference if dt in recurrence_rule]
+    scan = time.perf_counter() - start
+
+    assert calendar.equals(reference) and list(calendar[mask]) == reference_rolls
+    print(f"{len(calendar)} observations, {mask.sum()} roll dates: vectorized {vectorized:.3f}s, list based {scan:.3f}s")
+
+
+if __name__ == '__main__':
+    benchmark_calendar(years=20, observations_per_day=10, rules=weekdays_rule)
+    benchmark_calendar(years=20, observations_per_day=10, rules=third_fridays_rule)
+    benchmark_calendar(years=20, observations_per_day=1, rules=weekdays_rule)
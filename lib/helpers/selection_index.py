@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+
+class SelectionIndex():
+    """
+    Sorted view of the option chain of one quote date for picking new options with binary searches.
+
+    Contracts are grouped by (type, maturity), groups are sorted by type then maturity. Within a group, strikes are
+    kept sorted for moneyness selection and deltas sorted for delta selection, with the strike of each delta and the
+    chain row order on ties. Rows without a maturity or type are left out, as are missing strikes and deltas of their
+    sorted arrays.
+    """
+
+    def __init__(self, data):
+        maturity = pd.DatetimeIndex(data['Maturity'])
+        types = data['Type'].to_numpy(dtype=float)
+        strikes = data['Strike'].to_numpy(dtype=float)
+        deltas = data['Delta'].to_numpy(dtype=float)
+        valid = ~(maturity.isna() | np.isnan(types))
+
+        # Group codes ordered by type then maturity
+        type_codes, unique_types = pd.factorize(types[valid], sort=True)
+        maturity_codes, unique_maturities = pd.factorize(maturity[valid], sort=True)
+        groups, group_codes = np.unique(type_codes * len(unique_maturities) + maturity_codes, return_inverse=True)
+        codes = np.full(len(data), -1)
+        codes[valid] = group_codes
+        self.types = np.asarray(unique_types, dtype=float)[groups // max(len(unique_maturities), 1)]
+        self.maturities = pd.DatetimeIndex(unique_maturities[groups % max(len(unique_maturities), 1)])
+        # Local maturity days, selection compares days like Timestamp.date()
+        self.maturity_days = self.maturities.tz_localize(None).normalize().asi8
+        bounds = np.arange(len(groups) + 1)
+
+        has_strike = valid & ~np.isnan(strikes)
+        order = np.lexsort((strikes[has_strike], codes[has_strike]))
+        self.strikes = strikes[has_strike][order]
+        self.strike_bounds = np.searchsorted(codes[has_strike][order], bounds)
+
+        # lexsort is stable, equal deltas keep the chain row order
+        has_delta = valid & ~np.isnan(deltas)
+        order = np.lexsort((deltas[has_delta], codes[has_delta]))
+        self.deltas = deltas[has_delta][order]
+        self.delta_strikes = strikes[has_delta][order]
+        self.delta_bounds = np.searchsorted(codes[has_delta][order], bounds)
+
+        self.nbytes = sum(array.nbytes for array in [self.types, self.maturity_days, self.strikes, self.strike_bounds, self.deltas, self.delta_strikes, self.delta_bounds])
+
+    def get_maturity_group(self, op_type, target_maturity):
+        # Group of the closest maturity of the type on or after the day of target_maturity, -1 if there is none
+        first, last = np.searchsorted(self.types, op_type, side='left'), np.searchsorted(self.types, op_type, side='right')
+        target_day = pd.Timestamp(target_maturity.date()).value
+        group = first + np.searchsorted(self.maturity_days[first:last], target_day, side='left')
+        return group if group < last else -1
+
+    def get_moneyness_strike(self, group, op_type, level):
+        # Highest put strike at or below level, lowest call strike at or above it, NaN if there is none
+        strikes = self.strikes[self.strike_bounds[group]:self.strike_bounds[group + 1]] if group >= 0 else self.strikes[:0]
+        if op_type == 0:
+            position = np.searchsorted(strikes, level, side='right') - 1
+            return strikes[position] if position >= 0 else np.nan
+        position = np.searchsorted(strikes, level, side='left')
+        return strikes[position] if position < len(strikes) else np.nan
+
+    def get_delta_strike(self, group, op_type, delta_strike):
+        # Strike of the lowest put delta or highest call delta with an absolute value at most delta_strike
+        deltas = self.deltas[self.delta_bounds[group]:self.delta_bounds[group + 1]] if group >= 0 else self.deltas[:0]
+        if op_type == 0:
+            position = np.searchsorted(deltas, -delta_strike, side='left')
+            found = position < len(deltas) and deltas[position] <= delta_strike
+        else:
+            position = np.searchsorted(deltas, delta_strike, side='right') - 1
+            found = position >= 0 and deltas[position] >= -delta_strike
+            if found:
+                # First chain row with that delta
+                position = np.searchsorted(deltas, deltas[position], side='left')
+        if not found:
+            raise IndexError(f"No option of type {op_type} with an absolute delta of at most {delta_strike}")
+        return self.delta_strikes[self.delta_bounds[group] + position]
+
+    def select(self, op_type, target_maturity, spot, moneyness=None, delta_strike=None):
+        """
+        Maturity and strike of a new option: the closest maturity of the type on or after the day of target_maturity,
+        then the strike by moneyness (relative to spot) and/or delta, delta taking precedence when both are given.
+
+        Returns:
+            tuple: (maturity, NaT if there is none; strike, NaN if there is none).
+        """
+        group = self.get_maturity_group(op_type, target_maturity)
+        maturity = self.maturities[group] if group >= 0 else pd.NaT
+        strike = np.nan
+        if moneyness is not None:
+            strike = self.get_moneyness_strike(group, op_type, spot * moneyness)
+        if delta_strike is not None:
+            strike = self.get_delta_strike(group, op_type, delta_strike)
+        return maturity, strike
@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+import pytz
+from multiprocessing import shared_memory
+
+from lib.helpers.option_store import get_option_file_name, get_option_month_path, read_option_month
+
+ny_tz = pytz.timezone('America/New_York')
+
+DATETIME_COLUMNS = ['Maturity']
+
+# Segments attached by this process, kept alive for as long as the arrays viewing them
+_attached = {}
+
+
+def _attach(name):
+    # Pool workers share the resource tracker of the publishing process, which unlinks the segments in `close`
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return _attached[name]
+
+
+def attach_array(descriptor):
+    name, shape, dtype = descriptor
+    return np.ndarray(shape, dtype=dtype, buffer=_attach(name).buf)
+
+
+def attach_datetime_index(descriptor):
+    # Timestamps are shared as UTC nanoseconds
+    return pd.DatetimeIndex(attach_array(descriptor).view('datetime64[ns]'), tz='UTC').tz_convert(ny_tz)
+
+
+def attach_series(descriptor):
+    return pd.Series(attach_array(descriptor['values']), index=attach_datetime_index(descriptor['index']), name=descriptor['name'], copy=False)
+
+
+def attach_frame(descriptor):
+    index = attach_datetime_index(descriptor['index'])
+    index.name = descriptor['index_name']
+    columns = {}
+    for column, array_descriptor in descriptor['columns'].items():
+        columns[column] = attach_datetime_index(array_descriptor) if column in DATETIME_COLUMNS else attach_array(array_descriptor)
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+class SharedMarketData():
+    """
+    Publishes the intraday spot series and parsed option chains in shared memory.
+
+    The publishing process owns the segments and must call `close` once the workers are done. `descriptor` is a small
+    picklable dict that backtests receive through params['shared_market_data'] to attach to the data without copying.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.descriptor = {'spot': {}, 'chains': {}}
+
+    def share_array(self, array):
+        array = np.ascontiguousarray(array)
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[:] = array
+        self.segments.append(segment)
+        return segment.name, array.shape, array.dtype.str
+
+    def share_datetime_index(self, index):
+        return self.share_array(index.tz_convert('UTC').asi8)
+
+    def publish_spot(self, file_path, spot):
+        # Keyed by the file path the backtests would otherwise read
+        index = pd.to_datetime(spot.index, utc=True)
+        self.descriptor['spot'][file_path] = {'values': self.share_array(spot.values.astype(float)), 'index': self.share_datetime_index(index), 'name': spot.name}
+
+    def publish_chain(self, file_name, data):
+        columns = {}
+        for column in data.columns:
+            columns[column] = self.share_datetime_index(pd.DatetimeIndex(data[column])) if column in DATETIME_COLUMNS else self.share_array(data[column].values)
+        self.descriptor['chains'][file_name] = {'index': self.share_datetime_index(data.index), 'index_name': data.index.name, 'columns': columns}
+
+    def publish_chains(self, ticker, start_date, end_date, store_folder, csv_folder, use_store=True):
+        # Publish every month file between start_date and end_date, months without a file are left to the backtests
+        for month in pd.period_range(start_date, end_date, freq='M'):
+            date = month.to_timestamp()
+            if not os.path.exists(get_option_month_path(ticker, date, store_folder, csv_folder, use_store=use_store)):
+                continue
+            file_path, data = read_option_month(ticker, date, store_folder, csv_folder, use_store=use_store)
+            self.publish_chain(get_option_file_name(ticker, date), data)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
@@ -1,7 +1,16 @@
+import io
 import os
+import time
+import pandas as pd
 import py7zr
+import pyarrow as pa
+import pyarrow.parquet as pq
+from py7zr.io import Py7zIO, WriterFactory, NullIO
 
-from lib.helpers.preprocess_raw_data import pre_process, process_files
+from lib.helpers.preprocess_raw_data import read_raw_file, split_sides
+from lib.helpers.option_store import get_option_file_name, get_quote_dates_metadata, normalize_option_data, read_option_store, write_option_store, STORE_EXTENSION
+
+RAW_EXTENSIONS = ('.txt', '.csv')
 
 def extract_7z_files(path_zip, path_target):
     # Create the target directory if it doesn't exist
@@ -42,14 +51,166 @@ def txt_to_csv(path_folder):
 
 
 
+class MonthPartitionWriter():
+    """
+    Appends normalized option chain rows to the store file of their quote month, one row group per chunk.
+
+    Files are written next to their target and replace it on close. Rows are expected in quote date order, as in the
+    raw files, a month that receives older rows than it already holds is sorted again on close.
+    """
+
+    def __init__(self, ticker, store_folder):
+        self.ticker = ticker
+        self.store_folder = store_folder
+        self.months = {}
+        self.rows = 0
+
+    def get_file_path(self, month):
+        return os.path.join(self.store_folder, get_option_file_name(self.ticker, month.to_timestamp(), STORE_EXTENSION))
+
+    def write(self, data):
+        data = data.sort_index(kind='stable')
+        for month, rows in data.groupby(data.index.tz_localize(None).to_period('M'), sort=False):
+            table = pa.Table.from_pandas(rows)
+            if month not in self.months:
+                file_path = self.get_file_path(month)
+                os.makedirs(self.store_folder, exist_ok=True)
+                self.months[month] = {'writer': pq.ParquetWriter(f"{file_path}.tmp", table.schema), 'schema': table.schema,
+                                      'file_path': file_path, 'last_date': rows.index[-1], 'sorted': True, 'rows': 0, 'days': set()}
+            partition = self.months[month]
+            partition['days'].update(rows.index.normalize().unique())
+            partition['sorted'] = partition['sorted'] and rows.index[0] >= partition['last_date']
+            partition['last_date'] = max(partition['last_date'], rows.index[-1])
+            partition['writer'].write_table(table.cast(partition['schema']))
+            partition['rows'] += len(rows)
+            self.rows += len(rows)
+
+    def close(self):
+        for partition in self.months.values():
+            partition['writer'].add_key_value_metadata(get_quote_dates_metadata(list(partition['days'])))
+            partition['writer'].close()
+            temp_path = f"{partition['file_path']}.tmp"
+            if not partition['sorted']:
+                write_option_store(read_option_store(temp_path), temp_path)
+            os.replace(temp_path, partition['file_path'])
+
+    def abort(self):
+        for partition in self.months.values():
+            partition['writer'].close()
+            os.remove(f"{partition['file_path']}.tmp")
+
+
+class RawChainParser(Py7zIO):
+    """
+    Receives a raw chain file as py7zr decompresses it and parses it chunk_bytes of complete lines at a time, so that
+    neither the file nor its decompressed text is held in memory or written to disk.
+    """
+
+    def __init__(self, store, chunk_bytes):
+        self.store = store
+        self.chunk_bytes = chunk_bytes
+        self.header = None
+        self.buffer = bytearray()
+        self.written = 0
+        self.closed = False
+
+    def write(self, s):
+        self.buffer += s
+        self.written += len(s)
+        if len(self.buffer) >= self.chunk_bytes:
+            self.parse(final=False)
+        return len(s)
+
+    def parse(self, final):
+        end = len(self.buffer) if final else self.buffer.rfind(b'\n') + 1
+        lines = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        if self.header is None:
+            header_end = lines.find(b'\n') + 1
+            if header_end == 0:
+                # Not even a full header yet
+                self.buffer[:0] = lines
+                return
+            self.header, lines = lines[:header_end], lines[header_end:]
+        if len(lines.strip()) > 0:
+            self.store.write(normalize_option_data(split_sides(read_raw_file(io.BytesIO(self.header + lines))).set_index('Date')))
+
+    def close(self):
+        # Called by py7zr at the end of the member
+        if not self.closed:
+            self.closed = True
+            self.parse(final=True)
+
+    def read(self, size=None):
+        return b''
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return self.written
+
+
+class RawChainParserFactory(WriterFactory):
+    # Raw chain members of an archive are parsed into the store, other members are discarded
+    def __init__(self, store, chunk_bytes):
+        self.store = store
+        self.chunk_bytes = chunk_bytes
+        self.parsers = []
+
+    def create(self, filename):
+        if not filename.lower().endswith(RAW_EXTENSIONS):
+            return NullIO()
+        parser = RawChainParser(self.store, self.chunk_bytes)
+        self.parsers.append(parser)
+        return parser
+
+    def finish(self):
+        # Versions of py7zr that do not call close at the end of a member
+        for parser in self.parsers:
+            parser.close()
+
+
+def ingest_7z_files(path_zip, ticker, store_folder, chunk_bytes=64 * 1024 ** 2):
+    """
+    Decompress the raw chain files of every .7z archive of a folder as a stream, straight into the month files of the
+    columnar store. No .txt or .csv file is written and memory is bounded by chunk_bytes of raw text whatever the size
+    of the archives.
+
+    Returns:
+        pd.DataFrame: Row count, month files written and seconds of every archive.
+    """
+    report = []
+    for file in sorted(f for f in os.listdir(path_zip) if f.endswith('.7z')):
+        start = time.perf_counter()
+        store = MonthPartitionWriter(ticker, store_folder)
+        factory = RawChainParserFactory(store, chunk_bytes)
+        try:
+            with py7zr.SevenZipFile(os.path.join(path_zip, file), mode='r') as archive:
+                archive.extractall(factory=factory)
+            factory.finish()
+        except BaseException:
+            store.abort()
+            raise
+        store.close()
+        report.append({'archive': file, 'rows': store.rows, 'months': len(store.months), 'seconds': time.perf_counter() - start})
+        print(f"Ingested {file}: {store.rows} rows into {len(store.months)} month files in {report[-1]['seconds']:.2f}s")
+    return pd.DataFrame(report, columns=['archive', 'rows', 'months', 'seconds']).set_index('archive')
+
+
 # Example usage:
 if __name__ == '__main__':
     dir_path = r'X:\Main Folder\Data\Options'
 
     ticker = 'SPX'
 
-    extract_7z_files(os.path.join(dir_path, ticker, 'Zip'), os.path.join(dir_path, ticker, 'Raw'))
-
-    txt_to_csv(os.path.join(dir_path, ticker, 'Raw'))
+    # Streams the archives into the store without intermediate files
+    ingest_7z_files(os.path.join(dir_path, ticker, 'Zip'), ticker, os.path.join(dir_path, ticker, 'Store'))
 
-    process_files(os.path.join(dir_path, ticker, 'Raw'), os.path.join(dir_path, ticker, 'Pre Processed'))
\ No newline at end of file
+    # Alternatively, extract the raw files then pre process them to csv with preprocess_raw_data.process_files
+    # extract_7z_files(os.path.join(dir_path, ticker, 'Zip'), os.path.join(dir_path, ticker, 'Raw'))
+    # txt_to_csv(os.path.join(dir_path, ticker, 'Raw'))
+    # preprocess_raw_data.process_files(os.path.join(dir_path, ticker, 'Raw'), os.path.join(dir_path, ticker, 'Pre Processed'))
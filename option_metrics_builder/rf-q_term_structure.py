@@ -1,6 +1,15 @@
 import pandas as pd
 import numpy as np
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.helpers.preprocess_raw_data import read_raw_file
+
+RAW_COLUMNS = {'[QUOTE_DATE]': 'Date', '[EXPIRE_DATE]': 'Maturity', '[STRIKE]': 'Strike', '[UNDERLYING_LAST]': 'Spot',
+               '[C_BID]': 'C_Bid', '[C_ASK]': 'C_Ask', '[P_BID]': 'P_Bid', '[P_ASK]': 'P_Ask'}
+# Observation dates per row group of the term structure file, readers filtering on Date skip the other row groups
+ROW_GROUP_DATES = 21
 
 
 def rf_q(S, K, c, p, t):
@@ -8,60 +17,61 @@ def rf_q(S, K, c, p, t):
 
 
 class RQTermStructure():
-    def __init__(self, path_data):
+    def __init__(self, path_data, max_workers=None):
         self.path_data = path_data
+        self.max_workers = max_workers
 
     def get_processed_data_from_file(self, file_name):
-        # Read csv data and keep selected columns
-        data = pd.read_csv(os.path.join(self.path_data, file_name), index_col=2)
-        raw_columns = [' [EXPIRE_DATE]', ' [STRIKE]', ' [UNDERLYING_LAST]', ' [C_BID]', ' [C_ASK]', ' [P_BID]', ' [P_ASK]']
-        data = data[raw_columns]
-        # Rename columns
-        columns = ['Maturity', 'Strike', 'Spot', 'C_Bid', 'C_Ask', 'P_Bid', 'P_Ask']
-        data.columns = columns
-        # Casting data
-        data.index = pd.to_datetime(data.index)
-        data.index.name = 'Date'
+        # Read the selected columns of the raw csv data, numbers are parsed while reading
+        data = read_raw_file(os.path.join(self.path_data, file_name), columns=list(RAW_COLUMNS)).rename(columns=RAW_COLUMNS)
+        data['Date'] = pd.to_datetime(data['Date'])
         data['Maturity'] = pd.to_datetime(data['Maturity'])
-        data.loc[:, 'Strike'] = pd.to_numeric(data['Strike'], errors='coerce')
-        data.loc[:, 'S_close'] = pd.to_numeric(data['Spot'], errors='coerce')
-        data.loc[:, 'C_Bid'] = pd.to_numeric(data['C_Bid'], errors='coerce')
-        data.loc[:, 'C_Ask'] = pd.to_numeric(data['C_Ask'], errors='coerce')
-        data.loc[:, 'P_Bid'] = pd.to_numeric(data['P_Bid'], errors='coerce')
-        data.loc[:, 'P_Ask'] = pd.to_numeric(data['P_Ask'], errors='coerce')
-        # Pre processing
-        data['C_Mid'] = data.apply(lambda x: (x['C_Bid'] + x['C_Ask']) / 2, axis=1)
-        data['P_Mid'] = data.apply(lambda x: (x['P_Bid'] + x['P_Ask']) / 2, axis=1)
-        data['DTM'] = data.apply(lambda x: np.busday_count(np.datetime64(x.name, 'D'), np.datetime64(x['Maturity'], 'D')), axis=1)
+        data = data.dropna(subset=['Date', 'Maturity']).set_index('Date')
+        # Pre processing, one array operation per column
+        data['C_Mid'] = (data['C_Bid'] + data['C_Ask']) / 2
+        data['P_Mid'] = (data['P_Bid'] + data['P_Ask']) / 2
+        data['DTM'] = np.busday_count(data.index.values.astype('datetime64[D]'), data['Maturity'].values.astype('datetime64[D]'))
         # Drop 0 DTM
-        data = data.loc[data['DTM'] != 0]
+        data = data.loc[data['DTM'] != 0].copy()
         # Compute distance from Spot
-        data.loc[:, 'Distance'] = data.apply(lambda x: abs(x['Spot'] - x['Strike']), axis=1)
-        # Compute rf - q
-        data.loc[:, 'rf_q'] = data.apply(lambda x: rf_q(x['Spot'], x['Strike'], x['C_Mid'], x['P_Mid'], x['DTM']), axis=1)
+        data['Distance'] = (data['Spot'] - data['Strike']).abs()
+        # Compute rf - q, per business day
+        data['rf_q'] = rf_q(data['Spot'], data['Strike'], data['C_Mid'], data['P_Mid'], data['DTM'])
         return data
 
     def get_term_structure_from_data(self, data):
-        # Creating term structure for each observation date
-        term_structure = []
-        for obs_date in data.index.unique():
-            for maturity in data.loc[obs_date, 'Maturity'].unique():
-                temp = data[(data.index == obs_date) & (data['Maturity'] == maturity)]
-                value = temp[temp['Distance'] == temp['Distance'].min()]['rf_q'].loc[obs_date]
-                term_structure.append([obs_date, maturity, value])
+        # rf - q at the strike nearest to spot of each (observation date, maturity), the first one on ties
+        data = data.reset_index().dropna(subset=['Distance'])
+        nearest = data.groupby(['Date', 'Maturity'], sort=True)['Distance'].idxmin()
+        return data.loc[nearest.values, ['Date', 'Maturity', 'rf_q']]
+
+    def get_term_structure_from_file(self, file_name):
+        start = time.perf_counter()
+        term_structure = self.get_term_structure_from_data(self.get_processed_data_from_file(file_name))
+        print(f"{file_name}: {len(term_structure)} maturities in {time.perf_counter() - start:.2f}s")
         return term_structure
 
     def get_term_structure(self):
-        term_structure = []
-        for file_name in os.listdir(self.path_data):
-            term_structure.extend(self.get_term_structure_from_data(self.get_processed_data_from_file(file_name)))
-        term_structure = pd.DataFrame(term_structure, columns=['Date', 'Maturity', 'rf_q'])
+        # Files are processed in parallel
+        files = sorted(f for f in os.listdir(self.path_data) if os.path.isfile(os.path.join(self.path_data, f)))
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            term_structure = list(executor.map(self.get_term_structure_from_file, files))
+        term_structure = pd.concat(term_structure, ignore_index=True) if len(term_structure) > 0 else pd.DataFrame(columns=['Date', 'Maturity', 'rf_q'])
+        term_structure = term_structure.sort_values(['Date', 'Maturity'], kind='stable')
         term_structure.set_index('Date', inplace=True)
         return term_structure
 
+    def save_term_structure(self, term_structure, file_path):
+        # Sorted by observation date then maturity, about ROW_GROUP_DATES observation dates per row group
+        maturities_per_date = term_structure.groupby(level='Date').size()
+        row_group_size = max(int(maturities_per_date.max() * ROW_GROUP_DATES), 1) if len(maturities_per_date) > 0 else None
+        term_structure.to_parquet(file_path, engine='pyarrow', index=True, row_group_size=row_group_size)
+
 
 if __name__ == '__main__':
-    path_data = r'X:\Main Folder\Options Data\QQQ'
-    rfq = RQTermStructure(path_data=os.path.join(path_data, 'Raw Data'))
+    # Options folder of the ticker under DATAPATH, where the backtests look for rf_q_file by default
+    path_data = r'X:\Main Folder\Data\Options\QQQ'
+    rfq = RQTermStructure(path_data=os.path.join(path_data, 'Raw'))
     term_structure = rfq.get_term_structure()
-    term_structure.to_csv(os.path.join(path_data, 'term_structure.csv'))
+    # Read by load_rf_q_term_structure, rf_q_file of the backtests
+    rfq.save_term_structure(term_structure, os.path.join(path_data, 'term_structure.parquet'))
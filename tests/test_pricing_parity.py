@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+from lib.helpers import pricing_helpers as ph
+
+if not ph.USE_NUMBA:
+    pytest.skip("numba backend disabled by PRICING_BACKEND", allow_module_level=True)
+
+N = 5000
+RTOL, ATOL = 1e-10, 1e-12
+# Newton iterations amplify last digit differences between the two backends
+IV_TOL = 1e-6
+VEC_FUNCTIONS = [ph.price_bs_vec, ph.delta_vec, ph.gamma_vec, ph.vega_vec, ph.theta_vec, ph.rho_vec]
+
+
+@pytest.fixture
+def options():
+    # spot, strike, maturity (days), rate, div, vol, op_type
+    rng = np.random.default_rng(0)
+    return (rng.uniform(50, 150, N), rng.uniform(50, 150, N), rng.uniform(0.01, 730, N), rng.uniform(-0.01, 0.08, N),
+            rng.uniform(0, 0.04, N), rng.uniform(0.01, 1.5, N), rng.integers(0, 2, N))
+
+
+def on_both_backends(func):
+    # Values of func() on the compiled kernels then on the numpy fallback
+    previous = ph._array_backend
+    try:
+        values = []
+        for backend in ['numba', 'numpy']:
+            ph.set_pricing_backend(backend)
+            values.append(func())
+    finally:
+        ph.set_pricing_backend(previous)
+    return values
+
+
+@pytest.mark.parametrize('func', [ph.cdf_vec, ph.pdf_vec])
+def test_distribution_parity(func):
+    x = np.linspace(-10, 10, N)
+    compiled, fallback = on_both_backends(lambda: func(x))
+    np.testing.assert_allclose(compiled, fallback, rtol=RTOL, atol=ATOL)
+
+
+@pytest.mark.parametrize('func', VEC_FUNCTIONS, ids=lambda func: func.__name__)
+def test_vec_parity(func, options):
+    compiled, fallback = on_both_backends(lambda: func(*options))
+    np.testing.assert_allclose(compiled, fallback, rtol=RTOL, atol=ATOL, equal_nan=True)
+
+
+def test_vec_parity_broadcast_scalars(options):
+    spot, strike, maturity = options[:3]
+    for func in VEC_FUNCTIONS:
+        compiled, fallback = on_both_backends(lambda: func(spot, strike, maturity, 0.02, 0.01, 0.2, 1))
+        np.testing.assert_allclose(compiled, fallback, rtol=RTOL, atol=ATOL, err_msg=func.__name__)
+
+
+def test_greeks_parity(options):
+    compiled, fallback = on_both_backends(lambda: ph.greeks(*options))
+    for name, compiled_values, fallback_values in zip(['price', 'delta', 'gamma', 'vega', 'theta', 'rho'], compiled, fallback):
+        np.testing.assert_allclose(compiled_values, fallback_values, rtol=RTOL, atol=ATOL, err_msg=name)
+
+
+def test_greeks_match_vec_functions(options):
+    values = ph.greeks(*options)
+    for func, greek in zip(VEC_FUNCTIONS, values):
+        np.testing.assert_allclose(greek, func(*options), rtol=RTOL, atol=ATOL, err_msg=func.__name__)
+
+
+def test_implied_vol_parity(options):
+    spot, strike, maturity, rate, div, vol, op_type = options
+    price = ph.price_bs_vec(*options)
+    compiled, fallback = on_both_backends(lambda: ph.implied_vol_vec(spot, strike, maturity, rate, div, price, op_type))
+    np.testing.assert_allclose(compiled, fallback, rtol=IV_TOL, atol=IV_TOL, equal_nan=True)
+    np.testing.assert_array_equal(np.isnan(compiled), np.isnan(fallback))
+
+
+def test_implied_vol_outside_no_arbitrage_bounds(options):
+    spot, strike, maturity, rate, div, vol, op_type = options
+    t = maturity / ph.NUM_DAYS_PER_YEAR
+    forward_spot = spot * np.exp(-div * t)
+    discounted_strike = strike * np.exp(-rate * t)
+    lower_bound = np.maximum((2.0 * op_type - 1.0) * (forward_spot - discounted_strike), 0.0)
+    upper_bound = np.where(op_type == 1, forward_spot, discounted_strike)
+
+    # Below the intrinsic bound, above the upper bound, within price_tol of a bound and with no time left
+    price = ph.price_bs_vec(*options)
+    price[0::5] = lower_bound[0::5] - 0.01
+    price[1::5] = upper_bound[1::5] + 0.01
+    price[2::5] = lower_bound[2::5] + 5e-9
+    price[3::5] = upper_bound[3::5] - 5e-9
+    maturity = maturity.copy()
+    maturity[4::5] = 0.0
+
+    compiled, fallback = on_both_backends(lambda: ph.implied_vol_vec(spot, strike, maturity, rate, div, price, op_type))
+    assert np.isnan(compiled).all()
+    assert np.isnan(fallback).all()
+
+
+@pytest.mark.parametrize('func', [ph.price_bs, ph.delta, ph.gamma, ph.vega, ph.theta, ph.rho], ids=lambda func: func.__name__)
+def test_scalar_parity(func, options):
+    for i in range(100):
+        args = tuple(float(x[i]) for x in options)
+        np.testing.assert_allclose(func(*args), func.py_func(*args), rtol=RTOL, atol=ATOL)